@@ -0,0 +1,318 @@
+'''
+Command line tool for fingering many scores at once.
+
+    python batch.py data/ results/*.mxl mozart/k545 --output fingered/ --jobs 8
+
+Each input can be a MusicXML, MXL or MIDI file, a directory (searched recursively), a glob pattern,
+or a path in the music21 corpus. Scores are fingered in a pool of worker processes, one score
+per task. The first part of each score is fingered as the right hand and the second part as
+the left hand. Any other parts are left as they are.
+
+The annotated scores are written to the output directory along with summary.csv, which has
+one row per fingered part. A score is skipped if it already has a row in the summary and its
+output is newer than its source, unless --force is given.
+
+With --no-scores, only the summary is written. Adding --cache DIR then stores the notes of
+each score in DIR, so later runs do not need to parse the score with music21 at all.
+
+MIDI files (.mid or .midi) are read with midifile, without music21. Their hands are split by
+track, channel or pitch as described in midifile.get_hands, and only their summary rows are
+written, since writing an annotated score needs music21.
+
+--chunk-cache DIR gives each worker a chunkcache.ChunkCache stored in DIR, so a chunk that
+has the same shape as one fingered before, in any score, worker or earlier run, is not
+fingered again.
+'''
+import argparse
+import concurrent.futures
+import csv
+import glob
+import os
+import sys
+import time
+
+import chunkcache
+import finger
+import midifile
+import monotonic
+import notestream
+
+EXTENSIONS = ('.mxl', '.xml', '.musicxml') + midifile.EXTENSIONS
+SUMMARY_FIELDS = ['source', 'output', 'part', 'hand', 'notes', 'score', 'seconds']
+
+# the ChunkCache of this worker process, set by init_worker
+chunk_cache = None
+
+def init_worker(chunk_cache_dir):
+    global chunk_cache
+    if chunk_cache_dir is not None:
+        chunk_cache = chunkcache.ChunkCache(cache_dir=chunk_cache_dir)
+
+def find_sources(inputs, exclude=()):
+    '''
+    Expands a list of files, directories, glob patterns and corpus paths into a list of
+    sources, in order and without duplicates. Paths that do not exist on disk are assumed
+    to be in the music21 corpus. Directories in exclude, such as the output directory, are
+    not searched when they are found inside a directory or glob pattern in inputs.
+    '''
+    def is_inside(path, directory):
+        path, directory = os.path.realpath(path), os.path.realpath(directory)
+        return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+    def is_excluded(path, base):
+        return any(is_inside(path, d) and not is_inside(base, d) for d in exclude)
+
+    sources = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not is_excluded(os.path.join(root, d), path))
+                sources.extend(os.path.join(root, f) for f in sorted(files) if f.endswith(EXTENSIONS))
+        elif any(c in path for c in '*?['):
+            base = os.path.dirname(path[:min(path.find(c) for c in '*?[' if c in path)]) or '.'
+            sources.extend(f for f in sorted(glob.glob(path, recursive=True))
+                if f.endswith(EXTENSIONS) and not is_excluded(f, base))
+        else:
+            sources.append(path)
+    return list(dict.fromkeys(sources))
+
+def get_output_path(source, output_dir):
+    '''
+    Returns where the annotated score for source is written. The directories of source are
+    kept in the file name, so data/scales/cmaj.mxl and data/arpeggios/cmaj.mxl do not clash.
+    '''
+    name = os.path.normpath(os.path.splitext(source)[0]).replace('\\', '/')
+    name = '_'.join(p for p in name.split('/') if p not in ('', '.', '..'))
+    return os.path.join(output_dir, name + '.mxl')
+
+def resolve(source):
+    '''
+    Returns the path of a file on disk, or of a path in the music21 corpus.
+    '''
+    if os.path.exists(source):
+        return source
+    from music21 import corpus
+    path = corpus.getWork(source)
+    return path[0] if isinstance(path, list) else str(path)
+
+def parse(source):
+    '''
+    Parses a file on disk, or a path in the music21 corpus if no such file exists.
+    '''
+    from music21 import converter, corpus
+    if os.path.exists(source):
+        return converter.parse(source)
+    return corpus.parse(source)
+
+def finger_source(source, output_path, rest_flag=-1, engine='chunk', cache_dir=None):
+    '''
+    Fingers a single score and writes the annotated score to output_path. If output_path
+    is None, no score is written and the notes are read through the cache in cache_dir.
+    Returns a list of summary rows, one for each fingered part.
+    '''
+    score = None
+    if source.lower().endswith(midifile.EXTENSIONS):
+        note_streams = midifile.load(source)
+    elif output_path is not None:
+        score = parse(source)
+        note_streams = notestream.from_score(score)
+    elif cache_dir is not None:
+        note_streams = notestream.load(resolve(source), cache_dir)
+    else:
+        note_streams = notestream.from_score(parse(source))
+
+    rows = []
+    for i, note_stream in enumerate(note_streams):
+        rh = i == 0
+        start = time.time()
+        result = finger.solve(note_stream, rh, rest_flag, engine, cache=chunk_cache)
+        if score is not None:
+            monotonic.annotate_score(score.parts[i], result.fingers.tolist(), rh=rh, in_place=True)
+        rows.append({
+            'source': source,
+            'output': output_path or '',
+            'part': i,
+            'hand': 'rh' if rh else 'lh',
+            'notes': len(result.fingers),
+            'score': '%.4f' % result.normalized_score,
+            'seconds': '%.3f' % (time.time() - start),
+        })
+
+    if score is not None:
+        # write to a temporary file first so an interrupted run never leaves a partial output
+        partial_path = output_path[:-len('.mxl')] + '.partial.mxl'
+        score.write('mxl', fp=partial_path)
+        os.replace(partial_path, output_path)
+    return rows
+
+def read_summary(path):
+    '''
+    Returns the rows of a summary file, or an empty list if it does not exist.
+    '''
+    if not os.path.exists(path):
+        return []
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def write_summary(path, rows):
+    rows = sorted(rows, key=lambda row: (row['source'], int(row['part'])))
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def append_summary(path, rows):
+    '''
+    Adds rows to the end of a summary file written by write_summary.
+    '''
+    with open(path, 'a', newline='') as f:
+        csv.DictWriter(f, fieldnames=SUMMARY_FIELDS).writerows(rows)
+
+def is_done(source, done_path, summarized):
+    '''
+    Returns True if source already has summary rows and done_path, which is its output or
+    the summary itself, is up to date.
+    '''
+    if source not in summarized or not os.path.exists(done_path):
+        return False
+    if os.path.exists(source):
+        return os.path.getmtime(done_path) >= os.path.getmtime(source)
+    return True
+
+def run(inputs, output_dir='results', jobs=None, rest_flag=-1, engine='chunk', force=False,
+        write_scores=True, cache_dir=None, chunk_cache_dir=None):
+    '''
+    Fingers every source in inputs using a pool of jobs worker processes (by default, one
+    per core) and updates the summary. Returns the number of sources that failed.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    summary_path = os.path.join(output_dir, 'summary.csv')
+    rows = read_summary(summary_path)
+    summarized = set(row['source'] for row in rows)
+
+    sources = find_sources(inputs, exclude=[output_dir])
+    output_paths = {source: get_output_path(source, output_dir)
+        if write_scores and not source.lower().endswith(midifile.EXTENSIONS) else None for source in sources}
+    todo = [s for s in sources if force or not is_done(s, output_paths[s] or summary_path, summarized)]
+    print('%d scores, %d already done' % (len(sources), len(sources) - len(todo)))
+
+    # drop the rows of scores that are fingered again, then add rows as each score finishes,
+    # so finished work is not lost if the run is stopped
+    redone = set(todo)
+    rows = [row for row in rows if row['source'] not in redone]
+    write_summary(summary_path, rows)
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+            initargs=(chunk_cache_dir,)) as executor:
+        futures = {executor.submit(finger_source, source, output_paths[source], rest_flag, engine, cache_dir): source
+            for source in todo}
+        for future in concurrent.futures.as_completed(futures):
+            source = futures[future]
+            try:
+                new_rows = future.result()
+            except Exception as e:
+                failures += 1
+                print('%s: failed: %s' % (source, e), file=sys.stderr)
+                continue
+            rows.extend(new_rows)
+            append_summary(summary_path, new_rows)
+            print('%s: %s' % (source, ', '.join('%s %s' % (row['hand'], row['score']) for row in new_rows)))
+
+    write_summary(summary_path, rows)
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Annotate many scores with piano fingerings.')
+    parser.add_argument('inputs', nargs='+',
+        help='MusicXML, MXL or MIDI files, directories, glob patterns or music21 corpus paths')
+    parser.add_argument('-o', '--output', default='results', help='directory for annotated scores and summary.csv')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: one per core)')
+    parser.add_argument('--rest-flag', type=float, default=-1,
+        help='minimum rest length in quarter notes to split chunks on (default: -1, never)')
+    parser.add_argument('--engine', choices=['chunk', 'viterbi'], default='chunk')
+    parser.add_argument('--force', action='store_true', help='finger scores again even if they are already done')
+    parser.add_argument('--no-scores', action='store_true', help='only write summary.csv, not annotated scores')
+    parser.add_argument('--cache', default=None,
+        help='with --no-scores, directory for cached notes so scores are not parsed again')
+    parser.add_argument('--chunk-cache', default=None,
+        help='directory for cached chunk fingerings, shared by all scores and runs')
+    args = parser.parse_args(argv)
+
+    failures = run(args.inputs, args.output, args.jobs, args.rest_flag, args.engine, args.force,
+        not args.no_scores, args.cache, args.chunk_cache)
+    return 1 if failures else 0
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_batch():
+    import tempfile
+    output_dir = tempfile.mkdtemp()
+    assert(run(['./data/scales', 'mozart/k545'], output_dir, jobs=2) == 0)
+    rows = read_summary(os.path.join(output_dir, 'summary.csv'))
+    assert(len(rows) == 10)
+    assert(all(os.path.exists(row['output']) for row in rows))
+
+    # nothing left to do on the second run
+    modified = os.path.getmtime(rows[0]['output'])
+    assert(run(['./data/scales', 'mozart/k545'], output_dir, jobs=2) == 0)
+    assert(os.path.getmtime(rows[0]['output']) == modified)
+    print(output_dir)
+
+def test_batch_output_inside_input():
+    import shutil
+    import tempfile
+    input_dir = tempfile.mkdtemp()
+    for path in glob.glob('./data/scales/*.mxl'):
+        shutil.copy(path, input_dir)
+    output_dir = os.path.join(input_dir, 'fingered')
+    assert(run([input_dir], output_dir, jobs=2) == 0)
+
+    # the annotated scores are not taken as new sources
+    assert(find_sources([input_dir], exclude=[output_dir]) == sorted(glob.glob(os.path.join(input_dir, '*.mxl'))))
+    assert(find_sources([os.path.join(input_dir, '**/*.mxl')], exclude=[output_dir])
+        == sorted(glob.glob(os.path.join(input_dir, '*.mxl'))))
+    assert(run([input_dir], output_dir, jobs=2) == 0)
+    rows = read_summary(os.path.join(output_dir, 'summary.csv'))
+    assert(len(rows) == 2 * len(glob.glob('./data/scales/*.mxl')))
+    print(output_dir)
+
+def test_batch_cache():
+    import tempfile
+    output_dir = tempfile.mkdtemp()
+    cache_dir = os.path.join(output_dir, 'cache')
+    assert(run(['./data/arpeggios', 'mozart/k545'], output_dir, jobs=2, write_scores=False, cache_dir=cache_dir) == 0)
+    assert(len(os.listdir(cache_dir)) == 6)
+    first = read_summary(os.path.join(output_dir, 'summary.csv'))
+
+    # the second run reads every score from the cache
+    assert(run(['./data/arpeggios', 'mozart/k545'], output_dir, jobs=2, force=True, write_scores=False,
+        cache_dir=cache_dir) == 0)
+    second = read_summary(os.path.join(output_dir, 'summary.csv'))
+    assert([row['score'] for row in first] == [row['score'] for row in second])
+    print(output_dir)
+
+def test_batch_midi():
+    import tempfile
+    from music21 import converter
+    output_dir = tempfile.mkdtemp()
+    midi_dir = os.path.join(output_dir, 'midi')
+    os.makedirs(midi_dir)
+    for path in glob.glob('./data/scales/*.mxl'):
+        converter.parse(path).write('midi', fp=os.path.join(midi_dir, os.path.basename(path)[:-len('.mxl')] + '.mid'))
+    assert(run([midi_dir], output_dir, jobs=2) == 0)
+    rows = read_summary(os.path.join(output_dir, 'summary.csv'))
+    assert(len(rows) == 2 * len(glob.glob('./data/scales/*.mxl')))
+    assert(all(row['output'] == '' for row in rows))
+    print(output_dir)
+
+# test_batch()
+# test_batch_output_inside_input()
+# test_batch_cache()
+# test_batch_midi()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,413 @@
+'''
+Fingers many parts at once, with every step of the dynamic programming done by NumPy over
+all of them together.
+
+    results = batchsolve.solve_batch(note_streams, rh=[True, False, ...], engine='viterbi')
+
+finger.solve loops over each part, each chunk and each note in Python, which dominates the
+time for short parts such as exercises. Here the notes of every part are concatenated into one
+array, and splitting into chunks is done on all of them at once. The notes of a block of parts
+(or of all their chunks) are then gathered into padded arrays of shape (parts, notes), and each
+step of the recurrence works on arrays of shape (parts, 5, 5). lengths arrays mask out the
+padding, so parts of any length can share a block. The results are the same as finger.solve,
+including the choice between fingerings with the same score.
+
+What is left in Python is one small loop per note position over whole blocks, and building a
+FingeringResult for each part. On the 576 scales and arpeggios of python batchsolve.py, it
+fingers 16 to 23 times as many parts per second as finger.solve with the chunk engine (about
+10,000 parts per second), and about 10 times as many with the viterbi engine (about 30,000),
+whose loop over notes was already vectorized over fingers. Most of the remaining time is the
+arithmetic of the 5x5 max-plus steps themselves, so larger batches do not gain much more.
+
+    python batchsolve.py --octaves 1 2 3 4 5 6
+
+compares the throughput of solve_batch and finger.solve on every major and harmonic minor
+scale and arpeggio, in both hands, starting in each octave given.
+'''
+import argparse
+import constants
+import finger
+import numpy as np
+import time
+
+ENGINES = ['chunk', 'viterbi']
+# indexed by [rh, distance, lower color, higher color], like the tables in constants
+TABLES = np.stack([constants.COMFORT_LH, constants.COMFORT_RH])
+IDENTITY = np.where(np.eye(5, dtype=bool), 0.0, constants.FORBIDDEN)
+
+def flatten(note_streams, rest_flag=-1):
+    '''
+    Concatenates the notes of every NoteStream, leaving out rests. Returns (ps, color, offsets,
+    lengths, note_indices, resets), where the notes of part p are at offsets[p] to
+    offsets[p] + lengths[p], note_indices has the index of each note in its NoteStream, and
+    resets[k] is True if a rest of at least rest_flag quarter notes comes between notes k and
+    k + 1. resets has one extra entry at the end, so it can be indexed by any note.
+    '''
+    sizes = np.array([len(note_stream) for note_stream in note_streams], dtype=int)
+    is_rest = np.concatenate([note_stream.is_rest for note_stream in note_streams])
+    notes = np.flatnonzero(~is_rest)
+    note_part = np.repeat(np.arange(len(note_streams)), sizes)[notes]
+    lengths = np.bincount(note_part, minlength=len(note_streams))
+    offsets = np.cumsum(lengths) - lengths
+    ps = np.concatenate([note_stream.ps for note_stream in note_streams])[notes]
+    color = np.concatenate([note_stream.color for note_stream in note_streams])[notes].astype(int)
+    note_indices = notes - (np.cumsum(sizes) - sizes)[note_part]
+
+    resets = np.zeros(len(notes), dtype=bool)
+    if rest_flag != -1:
+        duration = np.concatenate([note_stream.duration for note_stream in note_streams])
+        long_rests = np.cumsum(is_rest & (duration >= rest_flag))
+        resets[:-1] = long_rests[notes[1:]] > long_rests[notes[:-1]]
+    return (ps, color, offsets, lengths, note_indices, resets)
+
+def get_ranges(starts, lengths):
+    '''
+    Returns the concatenation of np.arange(start, start + length) for each start and length.
+    '''
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) > 0 else 0)
+
+def split_batch(ps, offsets, lengths, resets):
+    '''
+    Does what finger.split does to every part at once, given flat arrays from flatten for parts
+    with at least one note. Returns (starts, ends, parts), the positions of the first and last
+    note of each chunk and the part it belongs to, in order. Adjacent chunks of a part share a
+    note.
+    '''
+    # transition k goes from note k to note k + 1, and within[k] is False between parts
+    within = np.ones(max(len(ps) - 1, 0), dtype=bool)
+    within[(offsets + lengths - 1)[:-1]] = False
+    starts = resets[:-1].copy()
+    starts[offsets[lengths > 1]] = True
+
+    # a chunk keeps its direction through repeated notes, and a chunk that starts with a
+    # repeated note is ascending
+    signs = np.sign(np.diff(ps))
+    signs[(starts | ~within) & (signs == 0)] = 1
+    last_change = np.maximum.accumulate(np.where(signs != 0, np.arange(len(signs)), 0))
+    directions = signs[last_change]
+    starts[1:] |= directions[1:] != directions[:-1]
+    starts &= within
+
+    # a part with a single note is a single chunk
+    chunk_starts = np.sort(np.concatenate([np.flatnonzero(starts), offsets[lengths == 1]]))
+    parts = np.searchsorted(offsets, chunk_starts, side='right') - 1
+    chunk_ends = np.minimum(np.append(chunk_starts[1:], len(ps)), (offsets + lengths - 1)[parts])
+    return (chunk_starts, chunk_ends, parts)
+
+def get_table_indices(ps, color):
+    '''
+    Returns (distance, lower color, higher color, ascending) of each pair of consecutive notes
+    in the rows of ps and color, as in monotonic.get_transition_matrices.
+    '''
+    distance = np.clip(np.diff(ps, axis=-1), -13, 13).astype(int) # CLAMP DOWN TO 13
+    ascending = distance >= 0
+    lower_color = np.where(ascending, color[..., :-1], color[..., 1:])
+    higher_color = np.where(ascending, color[..., 1:], color[..., :-1])
+    return (np.abs(distance), lower_color, higher_color, ascending)
+
+def get_transition_batch(ps, color, hands):
+    '''
+    Given padded ps and color of shape (parts, notes) and hands, a boolean rh that broadcasts
+    against the transitions, such as one per part of shape (parts, 1), returns the array of
+    shape (parts, notes - 1, 5, 5) that monotonic.get_transition_matrices gives for each part.
+    Entries for padding are meaningless and must be masked.
+    '''
+    distance, lower_color, higher_color, ascending = get_table_indices(ps, color)
+    matrices = TABLES[hands.astype(int), distance, lower_color, higher_color]
+    # the compiled tables are indexed from the lower note, so flip descending pairs
+    matrices[~ascending] = matrices[~ascending].transpose(0, 2, 1)
+    return matrices
+
+def get_comfort_batch(ps, color, hands, fingers):
+    '''
+    Returns the comfort of each transition of fingers, without building the full transition
+    matrices. hands broadcasts against the transitions, as in get_transition_batch.
+    '''
+    distance, lower_color, higher_color, ascending = get_table_indices(ps, color)
+    prev_finger, next_finger = fingers[..., :-1] - 1, fingers[..., 1:] - 1
+    return TABLES[hands.astype(int), distance, lower_color, higher_color,
+        np.where(ascending, prev_finger, next_finger), np.where(ascending, next_finger, prev_finger)]
+
+def max_plus_path(matrices, lengths):
+    '''
+    Finds the best path through each row of matrices, of shape (rows, steps, 5, 5), where
+    row r only uses its first lengths[r] matrices. This is finger.viterbi when the matrices
+    are note transitions and the stitching of finger.compute_best_score when they are the
+    score matrices of chunks.
+
+    Returns (fingers, totals), where fingers of shape (rows, steps + 1) holds fingers from 1
+    to 5, repeating the last finger of each row past its length, and totals holds the best
+    total of each row, or constants.FORBIDDEN if it has no valid path.
+    '''
+    rows, steps = matrices.shape[:2]
+    best = np.zeros((rows, 5))
+    backpointers = np.empty((rows, steps, 5), dtype=np.int8)
+    for i in range(steps):
+        # scores[r, p, f] is the total when step i goes from finger p + 1 to f + 1
+        scores = best[:, :, np.newaxis] + matrices[:, i]
+        active = (i < lengths)[:, np.newaxis]
+        best = np.where(active, scores.max(axis=1), best)
+        # padding keeps the same finger, so backtracking passes through it unchanged
+        backpointers[:, i] = np.where(active, scores.argmax(axis=1), np.arange(5))
+
+    all_rows = np.arange(rows)
+    fingers = np.empty((rows, steps + 1), dtype=int)
+    fingers[:, steps] = best.argmax(axis=1)
+    totals = best[all_rows, fingers[:, steps]]
+    for i in range(steps - 1, -1, -1):
+        fingers[:, i] = backpointers[all_rows, i, fingers[:, i + 1]]
+    return (fingers + 1, totals)
+
+def get_chunk_tables_batch(ps, color, lengths, hands):
+    '''
+    Like monotonic.get_chunk_tables for many chunks at once. Returns (transitions, best),
+    where best[c, i, f, e] is the best total comfort of notes i onwards of chunk c when note i
+    is played with finger f + 1 and its last note with finger e + 1.
+    '''
+    transitions = get_transition_batch(ps, color, hands)
+    chunks, width = ps.shape
+    best = np.empty((chunks, width, 5, 5))
+    best[:, width - 1] = IDENTITY
+    for i in range(width - 2, -1, -1):
+        step = np.max(transitions[:, i, :, :, np.newaxis] + best[:, i + 1, np.newaxis, :, :], axis=2)
+        # the last note of each chunk, and the padding after it, start from the identity
+        best[:, i] = np.where((i < lengths - 1)[:, np.newaxis, np.newaxis], step, IDENTITY)
+    return (transitions, best)
+
+def trace_fingering_batch(transitions, best, lengths, start_fingers, end_fingers):
+    '''
+    Like monotonic.trace_fingering for many chunks at once. Returns an array of shape
+    (chunks, notes) with the fingering of each chunk from its start finger to its end finger,
+    taking the lowest finger that keeps the best score at each note.
+    '''
+    chunks, width = best.shape[:2]
+    all_chunks = np.arange(chunks)
+    end = end_fingers - 1
+    current = start_fingers - 1
+    fingers = np.empty((chunks, width), dtype=int)
+    fingers[:, 0] = current
+    for i in range(width - 1):
+        scores = transitions[all_chunks, i, current, :] + best[all_chunks, i + 1, :, end]
+        chosen = np.argmax(scores == best[all_chunks, i, current, end][:, np.newaxis], axis=1)
+        current = np.where(i < lengths - 1, chosen, current)
+        fingers[:, i + 1] = current
+    return fingers + 1
+
+def solve_viterbi_block(ps, color, offsets, lengths, hands):
+    '''
+    Returns (fingers, totals) for the viterbi engine, given flat arrays from flatten for parts
+    with at least one note. fingers has the finger of every note.
+    '''
+    positions = np.minimum(offsets[:, np.newaxis] + np.arange(lengths.max()), len(ps) - 1)
+    transitions = get_transition_batch(ps[positions], color[positions], hands[:, np.newaxis])
+    path, totals = max_plus_path(transitions, lengths - 1)
+    fingers = np.zeros(len(ps), dtype=int)
+    used = np.arange(positions.shape[1]) < lengths[:, np.newaxis]
+    fingers[positions[used]] = path[used]
+    return (fingers, totals)
+
+def solve_chunk_block(ps, color, offsets, lengths, hands, resets):
+    '''
+    Returns (fingers, totals, chunk starts, chunk parts) for the chunk engine, given flat arrays
+    from flatten for parts with at least one note. Every chunk of every part is fingered in one
+    batch, and then the chunks of every part are stitched in another.
+    '''
+    chunk_starts, chunk_ends, chunk_parts = split_batch(ps, offsets, lengths, resets)
+    chunk_lengths = chunk_ends - chunk_starts + 1
+    positions = np.minimum(chunk_starts[:, np.newaxis] + np.arange(chunk_lengths.max()), len(ps) - 1)
+    transitions, best = get_chunk_tables_batch(ps[positions], color[positions], chunk_lengths,
+        hands[chunk_parts][:, np.newaxis])
+    # the average comfort of the best fingering for each pair of start and end fingers
+    scores = best[:, 0] / np.maximum(chunk_lengths - 1, 1)[:, np.newaxis, np.newaxis]
+
+    chunk_counts = np.bincount(chunk_parts, minlength=len(lengths))
+    chunk_numbers = np.arange(len(chunk_starts)) - (np.cumsum(chunk_counts) - chunk_counts)[chunk_parts]
+    matrices = np.zeros((len(lengths), chunk_counts.max(), 5, 5))
+    matrices[chunk_parts, chunk_numbers] = scores
+    bounds, totals = max_plus_path(matrices, chunk_counts)
+
+    chunk_fingers = trace_fingering_batch(transitions, best, chunk_lengths,
+        bounds[chunk_parts, chunk_numbers], bounds[chunk_parts, chunk_numbers + 1])
+    # adjacent chunks share a note, and agree on its finger
+    fingers = np.zeros(len(ps), dtype=int)
+    used = np.arange(positions.shape[1]) < chunk_lengths[:, np.newaxis]
+    fingers[positions[used]] = chunk_fingers[used]
+    return (fingers, totals, chunk_starts, chunk_parts)
+
+def get_blocks(lengths, block_notes):
+    '''
+    Splits the parts with at least one note, sorted by length, into blocks whose padded arrays
+    have at most block_notes notes, or a single part if it is longer than that.
+    '''
+    order = np.argsort(lengths, kind='stable')
+    order = order[lengths[order] > 0]
+    blocks = []
+    start = 0
+    for end in range(1, len(order) + 1):
+        if end == len(order) or (end + 1 - start) * lengths[order[end]] > block_notes:
+            blocks.append(order[start:end])
+            start = end
+    return blocks
+
+def solve_batch(note_streams, rh=True, rest_flag=-1, engine='chunk', block_notes=1 << 18):
+    '''
+    Returns the FingeringResult of each NoteStream in note_streams, the same as calling
+    finger.solve on each one. rh is either a single bool for every part or one for each part.
+
+    Parts are sorted by length and solved in blocks of at most block_notes padded notes, which
+    bounds the memory used for padding when short and long parts are mixed. The chord engine is
+    not supported.
+    '''
+    if engine not in ENGINES:
+        raise ValueError("engine must be 'chunk' or 'viterbi', not %r" % (engine,))
+    if len(note_streams) == 0:
+        return []
+    hands = np.broadcast_to(np.asarray(rh, dtype=bool), (len(note_streams),))
+    ps, color, offsets, lengths, note_indices, resets = flatten(note_streams, rest_flag)
+
+    fingers = np.zeros(len(ps), dtype=int)
+    totals = np.zeros(len(note_streams))
+    chunk_starts, chunk_parts = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+    for block in get_blocks(lengths, block_notes):
+        notes = get_ranges(offsets[block], lengths[block])
+        block_offsets = np.cumsum(lengths[block]) - lengths[block]
+        if engine == 'viterbi':
+            block_fingers, totals[block] = solve_viterbi_block(ps[notes], color[notes], block_offsets,
+                lengths[block], hands[block])
+        else:
+            block_fingers, totals[block], starts, parts = solve_chunk_block(ps[notes], color[notes], block_offsets,
+                lengths[block], hands[block], resets[notes])
+            chunk_starts.append(notes[starts])
+            chunk_parts.append(block[parts])
+        fingers[notes] = block_fingers
+    comfort = get_comfort_batch(ps, color, np.repeat(hands, lengths)[:-1], fingers)
+
+    if engine == 'chunk':
+        chunk_starts = np.concatenate(chunk_starts)
+        order = np.argsort(chunk_starts)
+        chunk_parts = np.concatenate(chunk_parts)[order]
+        # positions of the chunk bounds among the notes of each part
+        chunk_starts = chunk_starts[order] - offsets[chunk_parts]
+        chunk_counts = np.bincount(chunk_parts, minlength=len(note_streams))
+        first_chunks = np.cumsum(chunk_counts) - chunk_counts
+        scales = chunk_counts * 10
+    else:
+        scales = np.maximum(lengths - 1, 1) * 10
+
+    results = []
+    for i in range(len(note_streams)):
+        start, length = offsets[i], lengths[i]
+        if length == 0:
+            results.append(finger.FingeringResult(np.zeros(0, dtype=np.int8), note_indices[start:start], np.zeros(0),
+                np.zeros(0, dtype=int), 0, 0))
+            continue
+        if engine == 'chunk':
+            chunk_bounds = np.append(chunk_starts[first_chunks[i]:first_chunks[i] + chunk_counts[i]], length - 1)
+        else:
+            chunk_bounds = np.array([0, length - 1])
+        if totals[i] == constants.FORBIDDEN:
+            results.append(finger.FingeringResult(np.zeros(0, dtype=np.int8), note_indices[start:start + length],
+                np.zeros(0), chunk_bounds, 0, 0))
+            continue
+        total_score = float(totals[i])
+        results.append(finger.FingeringResult(fingers[start:start + length].astype(np.int8),
+            note_indices[start:start + length], comfort[start:start + length - 1], chunk_bounds, total_score,
+            total_score / scales[i]))
+    return results
+
+def make_exercises(octaves=(2, 3, 4, 5)):
+    '''
+    Returns a list of (name, pitches) with every major and harmonic minor scale and arpeggio
+    over two octaves, up and down, starting in each octave given.
+    '''
+    patterns = {
+        'major scale': [2, 2, 1, 2, 2, 2, 1],
+        'minor scale': [2, 1, 2, 2, 1, 3, 1],
+        'major arpeggio': [4, 3, 5],
+        'minor arpeggio': [3, 4, 5],
+    }
+    exercises = []
+    for octave in octaves:
+        for tonic in range(12):
+            for name, steps in patterns.items():
+                up = 12 * (octave + 1) + tonic + np.concatenate([[0], np.cumsum(steps * 2)])
+                pitches = np.concatenate([up, up[-2::-1]])
+                exercises.append(('%s %d %d' % (name, tonic, octave), pitches.tolist()))
+    return exercises
+
+def main(argv=None):
+    import notestream
+    parser = argparse.ArgumentParser(description='Compare solve_batch with finger.solve on scales and arpeggios.')
+    parser.add_argument('--octaves', type=int, nargs='+', default=[1, 2, 3, 4, 5, 6])
+    parser.add_argument('--engine', choices=ENGINES, default='chunk')
+    parser.add_argument('--repeat', type=int, default=5, help='times to run each, keeping the fastest (default: 5)')
+    args = parser.parse_args(argv)
+
+    exercises = make_exercises(args.octaves)
+    note_streams = [notestream.from_pitches(pitches) for name, pitches in exercises] * 2
+    hands = [True] * len(exercises) + [False] * len(exercises)
+
+    def fastest(function):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            value = function()
+            times.append(time.perf_counter() - start)
+        return (value, min(times))
+
+    expected, loop_seconds = fastest(lambda: [finger.solve(note_stream, rh, engine=args.engine)
+        for note_stream, rh in zip(note_streams, hands)])
+    results, batch_seconds = fastest(lambda: solve_batch(note_streams, hands, engine=args.engine))
+
+    assert(all(np.array_equal(a.fingers, b.fingers) for a, b in zip(expected, results)))
+    print('%d parts' % len(note_streams))
+    print('finger.solve: %.3fs, %.0f parts/s' % (loop_seconds, len(note_streams) / loop_seconds))
+    print('solve_batch:  %.3fs, %.0f parts/s (%.1fx)' % (batch_seconds, len(note_streams) / batch_seconds,
+        loop_seconds / batch_seconds))
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_matches_solve():
+    import notestream
+    rng = np.random.default_rng(0)
+    note_streams = [notestream.from_pitches(pitches) for name, pitches in make_exercises([3])]
+    note_streams += [notestream.from_pitches((60 + np.cumsum(rng.integers(-7, 8, size=length))).tolist())
+        for length in rng.integers(1, 40, size=30)]
+    # rests, and a part with none of its notes left
+    with_rests = notestream.from_pitches([60, 62, 64, 65, 67, 65, 64])
+    with_rests.is_rest[[2, 5]] = True
+    note_streams += [with_rests, with_rests[[2]]]
+    hands = rng.integers(0, 2, size=len(note_streams)).astype(bool)
+
+    for engine in ENGINES:
+        for rest_flag in [-1, 1]:
+            results = solve_batch(note_streams, hands, rest_flag, engine, block_notes=64)
+            for note_stream, rh, result in zip(note_streams, hands, results):
+                expected = finger.solve(note_stream, rh, rest_flag, engine)
+                assert(np.array_equal(result.fingers, expected.fingers))
+                assert(np.array_equal(result.note_indices, expected.note_indices))
+                assert(np.array_equal(result.chunk_bounds, expected.chunk_bounds))
+                assert(np.allclose(result.comfort, expected.comfort))
+                assert(np.isclose(result.total_score, expected.total_score))
+                assert(np.isclose(result.normalized_score, expected.normalized_score))
+
+def test_infeasible():
+    import notestream
+    # two leaps of more than an octave, as in monotonic.test_beam
+    note_streams = [notestream.from_pitches([48, 62, 76, 77]), notestream.from_pitches([60, 62])]
+    for engine in ENGINES:
+        results = solve_batch(note_streams, engine=engine)
+        expected = [finger.solve(note_stream, engine=engine) for note_stream in note_streams]
+        for result, solved in zip(results, expected):
+            assert(np.array_equal(result.fingers, solved.fingers) and result.total_score == solved.total_score)
+
+# test_matches_solve()
+# test_infeasible()
+
+if __name__ == '__main__':
+    main()
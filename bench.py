@@ -0,0 +1,322 @@
+'''
+Benchmarks for the fingering pipeline.
+
+    python bench.py --lengths 100 1000 --output bench.json
+    python bench.py --compare old.json new.json
+
+Every case is a single-hand part that goes through the stages of finger, each timed on its
+own: parse (music21 reading the score), extract (notestream.from_part), split,
+finger_monotonic, compute_best_score and annotate_score.
+
+There are two kinds of cases. Synthetic cases are long scales, arpeggios, random walks and
+repeated-note passages with each length given by --lengths, written to MusicXML in a
+temporary directory so that parsing is timed the same way as for real scores. Fixed cases
+are the scores in data/ and the corpus pieces used by the tests in finger.py.
+
+Each stage is run --repeat times and the fastest time is kept. Then the whole case is run
+once more with tracemalloc to find the peak memory of each stage, since tracing slows down
+every allocation. finger_monotonic enumerates every fingering, so it is only run on chunks
+of at most --max-bfs-notes notes. The number of partial fingerings it would create is
+counted for every chunk with monotonic.count_partial_fingerings, which is exact.
+
+Results are written as JSON, one entry per case, so two runs can be compared with
+--compare.
+'''
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import finger
+import monotonic
+import notestream
+import numpy as np
+from music21 import converter, corpus, note, pitch, stream
+
+STAGES = ['parse', 'extract', 'split', 'finger_monotonic', 'compute_best_score', 'annotate_score']
+# the scores in data/ have a right hand part and a left hand part
+FIXED_CASES = [(path, [True, False]) for path in sorted(glob.glob('./data/*/*.mxl'))] + [
+    ('mozart/k545', [True, False]),
+    ('bach/bwv108.6.xml', [True]),
+]
+FORMAT_VERSION = 1
+
+MAJOR_SCALE = [0, 2, 4, 5, 7, 9, 11]
+MAJOR_TRIAD = [0, 4, 7]
+
+def up_and_down(steps, length, start=60, octaves=2):
+    '''
+    Returns length pitches that go up and down over octaves octaves from start, repeating
+    the pitch classes in steps in every octave.
+    '''
+    up = [start + 12 * octave + step for octave in range(octaves) for step in steps] + [start + 12 * octaves]
+    cycle = up + up[-2:0:-1]
+    return [cycle[i % len(cycle)] for i in range(length)]
+
+def scale(length, rh=True):
+    return up_and_down(MAJOR_SCALE, length, 60 if rh else 48)
+
+def arpeggio(length, rh=True):
+    return up_and_down(MAJOR_TRIAD, length, 60 if rh else 36, octaves=3)
+
+def random_walk(length, rh=True, seed=0):
+    '''
+    Returns length pitches that move by up to a fourth at a time, staying in the range of
+    the hand.
+    '''
+    low, high = (55, 96) if rh else (28, 67)
+    rng = np.random.default_rng(seed)
+    steps = rng.integers(-5, 6, size=length)
+    pitches = [(low + high) // 2]
+    for step in steps[1:]:
+        pitches.append(int(min(max(pitches[-1] + step, low), high)))
+    return pitches
+
+def repeated_notes(length, rh=True, repeats=4):
+    '''
+    Returns length pitches where each note of a scale is played repeats times.
+    '''
+    return [pitch for pitch in scale(-(-length // repeats), rh) for _ in range(repeats)][:length]
+
+WORKLOADS = {
+    'scale': scale,
+    'arpeggio': arpeggio,
+    'random_walk': random_walk,
+    'repeated_notes': repeated_notes,
+}
+
+def write_synthetic(pitches, path):
+    '''
+    Writes pitches as a part of quarter notes to a MusicXML file at path.
+    '''
+    part = stream.Part()
+    for ps in pitches:
+        part.append(note.Note(pitch.Pitch(ps=ps)))
+    part.write('musicxml', fp=path)
+
+def parse(source):
+    if os.path.exists(source):
+        return converter.parse(source)
+    return corpus.parse(source)
+
+def run_stages(source, part_index, rh, rest_flag=-1, max_bfs_notes=10, clock=time.perf_counter, on_stage=None):
+    '''
+    Runs every stage once for a part of source. on_stage(name) is called before each stage
+    and the time it took is stored under name. Returns (seconds, counts), where seconds maps
+    each stage to its time and counts has the sizes of the case.
+    '''
+    seconds = dict()
+    def start(name):
+        if on_stage is not None:
+            on_stage(name)
+        return clock()
+
+    t = start('parse')
+    part = parse(source)
+    if isinstance(part, stream.Score):
+        part = part.parts[part_index]
+    seconds['parse'] = clock() - t
+
+    t = start('extract')
+    note_stream = notestream.from_part(part, rh)
+    seconds['extract'] = clock() - t
+
+    t = start('split')
+    chunk_indices = finger.split(note_stream, rest_flag=rest_flag)
+    seconds['split'] = clock() - t
+    chunks = [note_stream[chunk] for chunk in chunk_indices]
+
+    t = start('finger_monotonic')
+    for chunk in chunks:
+        if 1 < len(chunk) <= max_bfs_notes:
+            monotonic.finger_monotonic(chunk_to_notes(chunk), rh)
+    seconds['finger_monotonic'] = clock() - t
+
+    t = start('compute_best_score')
+    fingering, score = finger.compute_best_score(chunks, rh)
+    seconds['compute_best_score'] = clock() - t
+
+    t = start('annotate_score')
+    monotonic.annotate_score(part, fingering, rh=rh)
+    seconds['annotate_score'] = clock() - t
+    if on_stage is not None:
+        on_stage(None)
+
+    lengths = [len(chunk) for chunk in chunks]
+    counts = {
+        'notes': len(note_stream.note_indices()),
+        'chunks': len(chunks),
+        'max_chunk_notes': max(lengths),
+        'bfs_chunks': sum(1 < length <= max_bfs_notes for length in lengths),
+        'partial_fingerings': sum(monotonic.count_partial_fingerings(chunk, rh) for chunk in chunks),
+        'normalized_score': score / (len(chunks) * 10),
+    }
+    return (seconds, counts)
+
+def chunk_to_notes(chunk):
+    # finger_monotonic takes music21 Notes, as in the tests in monotonic.py
+    return [note.Note(pitch.Pitch(ps=ps)) for ps in chunk.ps]
+
+def measure_memory(source, part_index, rh, rest_flag=-1, max_bfs_notes=10):
+    '''
+    Runs every stage once with tracemalloc and returns the peak memory of each stage in
+    bytes, above what was allocated when the stage started.
+    '''
+    peaks = dict()
+    current = [None, 0]
+    def on_stage(name):
+        if current[0] is not None:
+            peaks[current[0]] = tracemalloc.get_traced_memory()[1] - current[1]
+        tracemalloc.reset_peak()
+        current[0] = name
+        current[1] = tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.start()
+    try:
+        run_stages(source, part_index, rh, rest_flag, max_bfs_notes, on_stage=on_stage)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+def run_case(name, source, part_index, rh, repeat=3, rest_flag=-1, max_bfs_notes=10):
+    '''
+    Benchmarks one part and returns its entry in the results.
+    '''
+    runs = [run_stages(source, part_index, rh, rest_flag, max_bfs_notes) for _ in range(repeat)]
+    counts = runs[0][1]
+    peaks = measure_memory(source, part_index, rh, rest_flag, max_bfs_notes)
+    stages = {stage: {'seconds': min(seconds[stage] for seconds, _ in runs), 'peak_bytes': peaks[stage]}
+        for stage in STAGES}
+    return dict(name=name, hand='rh' if rh else 'lh', stages=stages, **counts)
+
+def get_cases(lengths, workloads=None, fixed=True, directory=None):
+    '''
+    Returns a list of (name, source, part index, rh) for every case, writing the synthetic
+    ones to MusicXML files in directory.
+    '''
+    cases = []
+    for workload in workloads or sorted(WORKLOADS):
+        for length in lengths:
+            for rh in [True, False]:
+                path = os.path.join(directory, '%s_%d_%s.musicxml' % (workload, length, 'rh' if rh else 'lh'))
+                write_synthetic(WORKLOADS[workload](length, rh), path)
+                cases.append(('%s/%d' % (workload, length), path, 0, rh))
+    if fixed:
+        for source, hands in FIXED_CASES:
+            cases.extend((source, source, i, rh) for i, rh in enumerate(hands))
+    return cases
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(lengths=(100, 1000), workloads=None, fixed=True, repeat=3, rest_flag=-1, max_bfs_notes=10):
+    '''
+    Benchmarks every case and returns the results as a dictionary.
+    '''
+    results = {
+        'format': FORMAT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'settings': {'lengths': list(lengths), 'repeat': repeat, 'rest_flag': rest_flag, 'max_bfs_notes': max_bfs_notes},
+        'cases': [],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for name, source, part_index, rh in get_cases(lengths, workloads, fixed, directory):
+            case = run_case(name, source, part_index, rh, repeat, rest_flag, max_bfs_notes)
+            results['cases'].append(case)
+            print('%-28s %s %6d notes  %s' % (name, case['hand'], case['notes'],
+                '  '.join('%s %.4f' % (stage, case['stages'][stage]['seconds']) for stage in STAGES)))
+    return results
+
+def compare(old, new):
+    '''
+    Returns lines comparing two results, with the ratio of new to old time and peak memory for
+    every stage of every case that is in both.
+    '''
+    old_cases = {(case['name'], case['hand']): case for case in old['cases']}
+    lines = ['%-28s %-4s %-20s %10s %10s %8s %8s' % ('case', 'hand', 'stage', 'old s', 'new s', 'time', 'memory')]
+    for case in new['cases']:
+        key = (case['name'], case['hand'])
+        if key not in old_cases:
+            continue
+        for stage in STAGES:
+            before, after = old_cases[key]['stages'][stage], case['stages'][stage]
+            lines.append('%-28s %-4s %-20s %10.4f %10.4f %7.2fx %7.2fx' % (key + (stage, before['seconds'],
+                after['seconds'], ratio(after['seconds'], before['seconds']), ratio(after['peak_bytes'], before['peak_bytes']))))
+    return lines
+
+def ratio(new, old):
+    return new / old if old > 0 else float('nan')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the fingering pipeline.')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[100, 1000],
+        help='number of notes in each synthetic case (default: 100 1000)')
+    parser.add_argument('--workloads', nargs='+', choices=sorted(WORKLOADS), default=None,
+        help='synthetic workloads to run (default: all)')
+    parser.add_argument('--no-fixed', action='store_true', help='skip the scores in data/ and the corpus')
+    parser.add_argument('--repeat', type=int, default=3, help='times to run each stage, keeping the fastest')
+    parser.add_argument('--rest-flag', type=float, default=-1,
+        help='minimum rest length in quarter notes to split chunks on (default: -1, never)')
+    parser.add_argument('--max-bfs-notes', type=int, default=10,
+        help='longest chunk to run finger_monotonic on (default: 10)')
+    parser.add_argument('-o', '--output', default=None, help='file to write the results to as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            print('\n'.join(compare(json.load(old), json.load(new))))
+        return 0
+
+    results = run(args.lengths, args.workloads, not args.no_fixed, args.repeat, args.rest_flag, args.max_bfs_notes)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_workloads():
+    for workload, generate in WORKLOADS.items():
+        for rh in [True, False]:
+            pitches = generate(250, rh)
+            assert(len(pitches) == 250)
+            assert(max(pitches) - min(pitches) <= 48)
+    assert(scale(16)[:9] == [60, 62, 64, 65, 67, 69, 71, 72, 74])
+    assert(repeated_notes(8)[:5] == [60, 60, 60, 60, 62])
+
+def test_bench():
+    results = run(lengths=[50], workloads=['scale', 'repeated_notes'], fixed=False, repeat=1)
+    assert(len(results['cases']) == 4)
+    for case in results['cases']:
+        assert(case['notes'] == 50)
+        assert(set(case['stages']) == set(STAGES))
+        assert(case['partial_fingerings'] >= 5 * case['chunks'])
+    # a run compared with itself has a ratio of 1 everywhere
+    lines = compare(results, json.loads(json.dumps(results)))
+    assert(len(lines) == 1 + 4 * len(STAGES))
+    assert(all(value in ('1.00x', 'nanx') for line in lines[1:] for value in line.split()[-2:]))
+
+# test_workloads()
+# test_bench()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,289 @@
+import constants
+import copy
+import itertools
+import numpy as np
+
+# largest chords whose hand shapes are all found when the index is built. Shapes of larger
+# chords are added to the index the first time they are needed.
+INDEXED_NOTES = 3
+
+class ChordStream:
+    '''
+    A compact, array-backed view of the notes and chords of a single-hand part, keeping every
+    chord tone. Each note or chord is an event, and the tones of event e are at positions
+    bounds[e] to bounds[e + 1] of the tone arrays, from lowest to highest.
+
+    Tone arrays, with one entry per chord tone:
+        ps: pitch space value
+        color: index of the key color in constants.COLORS
+        order: position of the tone in chord.notes, so fingerings can be written back
+    Event arrays:
+        bounds: start of each event in the tone arrays, followed by the number of tones
+        index: position of the event in part.flat.notes
+    '''
+    def __init__(self, ps, color, order, bounds, index):
+        self.ps = ps
+        self.color = color
+        self.order = order
+        self.bounds = bounds
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def tones(self, event):
+        '''
+        Returns the slice of the tone arrays that holds event.
+        '''
+        return slice(self.bounds[event], self.bounds[event + 1])
+
+def from_part(part, rh=True):
+    '''
+    Given a single-hand piano part, returns a ChordStream of its notes and chords, flattening
+    the part only once. Rests are left out.
+    '''
+    from music21 import chord
+    pitches = []
+    for element in part.flat.notes:
+        if isinstance(element, chord.Chord):
+            pitches.append([n.pitch.ps for n in element.notes])
+        else:
+            pitches.append([element.pitch.ps])
+    return from_chords(pitches)
+
+def from_chords(events):
+    '''
+    Given a list with the pitch space values of each note or chord, returns a ChordStream
+    with one event for each. index is the position in the list.
+    '''
+    ps, order, lengths = [], [], []
+    for pitches in events:
+        positions = np.argsort(pitches, kind='stable')
+        ps.extend(np.asarray(pitches, dtype=float)[positions])
+        order.extend(positions)
+        lengths.append(len(pitches))
+    ps = np.array(ps, dtype=float)
+    pitch_class = np.mod(np.round(ps), 12)
+    color = np.where(np.isin(pitch_class, constants.BLACK_PITCH_CLASSES), constants.COLORS.index('black'),
+        constants.COLORS.index('white')).astype(np.int8)
+    bounds = np.concatenate([[0], np.cumsum(lengths, dtype=int)])
+    return ChordStream(ps, color, np.array(order, dtype=int), bounds, np.arange(len(events)))
+
+def get_shapes(intervals, colors, rh=True):
+    '''
+    Returns (fingers, comfort) for the valid hand shapes of a chord, where intervals are the
+    distances between its adjacent tones from lowest to highest, clamped to 13 half steps,
+    and colors are the color indices of its tones. fingers[s] holds the finger on each tone
+    of shape s, from the lowest tone, and comfort[s] is its total comfort.
+
+    A shape gives each tone its own finger, in order across the hand, so fingers go up with
+    pitch for the right hand and down for the left hand. Every pair of adjacent tones, and
+    the two outer tones, must be an acceptable finger pair in COMFORT, and the comfort of a
+    shape is the sum over the adjacent pairs. Chords with more than 5 tones have no shapes.
+
+    Shapes are looked up in an index keyed by the hand, intervals and colors, which holds
+    every chord of up to INDEXED_NOTES tones once it is first used.
+    '''
+    index = get_shape_index(rh)
+    key = (tuple(intervals), tuple(colors))
+    if key not in index:
+        index[key] = compute_shapes(key[0], key[1], rh)
+    return index[key]
+
+def compute_shapes(intervals, colors, rh=True):
+    '''
+    Finds the shapes returned by get_shapes, without the index.
+    '''
+    table = constants.COMFORT_RH if rh else constants.COMFORT_LH
+    span = min(sum(intervals), 13)
+    shapes, comfort = [], []
+    for fingers in itertools.combinations(range(5), len(colors)):
+        if not rh:
+            fingers = fingers[::-1]
+        scores = [table[intervals[i], colors[i], colors[i+1], fingers[i], fingers[i+1]] for i in range(len(intervals))]
+        if len(colors) > 2:
+            scores.append(table[span, colors[0], colors[-1], fingers[0], fingers[-1]])
+        if all(score != constants.FORBIDDEN for score in scores):
+            shapes.append(fingers)
+            comfort.append(sum(scores[:len(intervals)]))
+    return (np.array(shapes, dtype=np.int8).reshape(len(shapes), len(colors)), np.array(comfort, dtype=float))
+
+SHAPE_INDEX = {True: None, False: None}
+
+def get_shape_index(rh=True):
+    '''
+    Returns the index used by get_shapes for one hand, building it the first time.
+    '''
+    if SHAPE_INDEX[rh] is None:
+        index = dict()
+        for size in range(1, INDEXED_NOTES + 1):
+            for intervals in itertools.product(range(14), repeat=size - 1):
+                for colors in itertools.product(range(len(constants.COLORS)), repeat=size):
+                    index[(intervals, colors)] = compute_shapes(intervals, colors, rh)
+        SHAPE_INDEX[rh] = index
+    return SHAPE_INDEX[rh]
+
+def get_event_shapes(chord_stream, event, rh=True):
+    '''
+    Returns (tones, fingers, comfort) for an event, where tones are the positions in the tone
+    arrays of the tones that are fingered and fingers and comfort are their shapes from
+    get_shapes. If the hand cannot play the whole chord, only its top tone is fingered for the
+    right hand and its bottom tone for the left hand, like notestream.from_part does.
+    '''
+    tones = np.arange(chord_stream.bounds[event], chord_stream.bounds[event + 1])
+    intervals = np.clip(np.diff(chord_stream.ps[tones]), 0, 13).astype(int)
+    fingers, comfort = get_shapes(intervals.tolist(), chord_stream.color[tones].tolist(), rh)
+    if len(fingers) == 0:
+        tones = tones[-1:] if rh else tones[:1]
+        fingers, comfort = get_shapes([], chord_stream.color[tones].tolist(), rh)
+    return (tones, fingers, comfort)
+
+def get_transition_scores(chord_stream, prev_tones, prev_fingers, tones, fingers, rh=True):
+    '''
+    Returns an array where entry [p, s] is the comfort of moving from shape p of the previous
+    event to shape s of the next one. This is the best comfort in COMFORT of playing any tone
+    of the previous event followed by any tone of the next one with the fingers of the two
+    shapes, so for single notes it is the same as the comfort of the two notes. Shapes that
+    no pair connects are constants.FORBIDDEN.
+    '''
+    distance = np.clip(chord_stream.ps[tones][np.newaxis, :] - chord_stream.ps[prev_tones][:, np.newaxis], -13, 13).astype(int)
+    prev_color = chord_stream.color[prev_tones][:, np.newaxis]
+    color = chord_stream.color[tones][np.newaxis, :]
+    ascending = distance >= 0
+    lower_color = np.where(ascending, prev_color, color)
+    higher_color = np.where(ascending, color, prev_color)
+    table = constants.COMFORT_RH if rh else constants.COMFORT_LH
+
+    # matrices[i, j] is the 5x5 matrix for previous tone i and tone j, as in
+    # monotonic.get_transition_matrices
+    matrices = table[np.abs(distance), lower_color, higher_color]
+    matrices[~ascending] = matrices[~ascending].transpose(0, 2, 1)
+    i = np.arange(len(prev_tones))[np.newaxis, np.newaxis, :, np.newaxis]
+    j = np.arange(len(tones))[np.newaxis, np.newaxis, np.newaxis, :]
+    scores = matrices[i, j, prev_fingers[:, np.newaxis, :, np.newaxis], fingers[np.newaxis, :, np.newaxis, :]]
+    return scores.max(axis=(2, 3))
+
+def viterbi(chord_stream, rh=True):
+    '''
+    Computes the best fingering of a ChordStream like finger.viterbi, except that the state
+    of each event is a hand shape from get_shapes instead of a single finger. The score of a
+    fingering is the comfort of every transition from get_transition_scores plus the comfort
+    of every shape.
+
+    Returns (fingering, total score, transition comfort), where fingering has one finger for
+    each tone, or 0 for tones that are not fingered, and transition comfort has the comfort of
+    each transition between events. If there is no valid fingering, returns ([], 0, []).
+    '''
+    if len(chord_stream) == 0:
+        return ([], 0, [])
+
+    prev_tones, prev_fingers, best = get_event_shapes(chord_stream, 0, rh)
+    shapes = [(prev_tones, prev_fingers)]
+    backpointers = []
+    transitions = []
+    for event in range(1, len(chord_stream)):
+        tones, fingers, comfort = get_event_shapes(chord_stream, event, rh)
+        transition = get_transition_scores(chord_stream, prev_tones, prev_fingers, tones, fingers, rh)
+        scores = best[:, np.newaxis] + transition + comfort[np.newaxis, :]
+        best = scores.max(axis=0)
+        if np.all(best == constants.FORBIDDEN):
+            return ([], 0, [])
+        backpointers.append(scores.argmax(axis=0))
+        transitions.append(transition)
+        shapes.append((tones, fingers))
+        prev_tones, prev_fingers = tones, fingers
+
+    # backtrack from the best last shape
+    choices = [int(np.argmax(best))]
+    for pointers in reversed(backpointers):
+        choices.append(int(pointers[choices[-1]]))
+    choices.reverse()
+
+    fingering = np.zeros(len(chord_stream.ps), dtype=int)
+    for (tones, fingers), choice in zip(shapes, choices):
+        fingering[tones] = fingers[choice] + 1
+    comfort = [float(transitions[e][choices[e], choices[e + 1]]) for e in range(len(transitions))]
+    return (fingering.tolist(), float(best[choices[-1]]), comfort)
+
+def annotate_score(score, chord_stream, fingering, in_place=False):
+    '''
+    Adds fingering numbers to a score, given its ChordStream and a fingering with one finger
+    for each tone, as from viterbi. A chord with every tone fingered gets one Fingering for
+    each of its notes, in the order of chord.notes. A chord with only one tone fingered is
+    replaced by that note, as in monotonic.annotate_score.
+
+    Returns a new score with the fingerings, unless in_place is True. In that case score itself
+    is annotated and returned. If fingering is empty, as when there is no valid fingering, the
+    score is returned without any.
+    '''
+    from music21 import articulations, chord
+    if not in_place:
+        score = copy.deepcopy(score)
+    if len(fingering) == 0:
+        return score
+    fingering = np.asarray(fingering)
+    # flat has to stay referenced, since it is the activeSite used to replace chords
+    flat = score.flat
+    elements = list(flat.notes)
+    for event in range(len(chord_stream)):
+        element = elements[chord_stream.index[event]]
+        tones = chord_stream.tones(event)
+        fingers = fingering[tones]
+        order = chord_stream.order[tones]
+        if not isinstance(element, chord.Chord):
+            element.articulations.append(articulations.Fingering(int(fingers[0])))
+        elif np.all(fingers > 0):
+            for finger in fingers[np.argsort(order)]:
+                element.articulations.append(articulations.Fingering(int(finger)))
+        else:
+            fingered = int(np.flatnonzero(fingers)[0])
+            replacement = element.notes[order[fingered]]
+            element.activeSite.replace(element, replacement)
+            replacement.articulations.append(articulations.Fingering(int(fingers[fingered])))
+    return score
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_shapes():
+    white = constants.COLORS.index('white')
+    # C major triad in root position
+    rh_fingers, rh_comfort = get_shapes([4, 3], [white] * 3, True)
+    lh_fingers, lh_comfort = get_shapes([4, 3], [white] * 3, False)
+    assert([0, 2, 4] in rh_fingers.tolist() and [4, 2, 0] in lh_fingers.tolist())
+    # the left hand mirrors the right hand, so it plays C E G like the right hand plays A C E
+    mirrored_fingers, mirrored_comfort = get_shapes([3, 4], [white] * 3, True)
+    assert(sorted(map(tuple, lh_fingers[:, ::-1].tolist())) == sorted(map(tuple, mirrored_fingers.tolist())))
+    # single notes can be played with any finger, and six notes with none
+    assert(len(get_shapes([], [white])[0]) == 5)
+    assert(len(get_shapes([2] * 5, [white] * 6)[0]) == 0)
+    # the index agrees with computing shapes directly
+    for key, (fingers, comfort) in list(get_shape_index(True).items())[::97]:
+        expected_fingers, expected_comfort = compute_shapes(key[0], key[1], True)
+        assert(np.array_equal(fingers, expected_fingers) and np.array_equal(comfort, expected_comfort))
+
+def test_from_chords():
+    chord_stream = from_chords([[60], [67, 60, 64], [62]])
+    assert(len(chord_stream) == 3)
+    assert(chord_stream.ps.tolist() == [60, 60, 64, 67, 62])
+    assert(chord_stream.order.tolist() == [0, 1, 2, 0, 0])
+    assert(chord_stream.ps[chord_stream.tones(1)].tolist() == [60, 64, 67])
+
+def test_viterbi():
+    fingering, score, comfort = viterbi(from_chords([[60, 64, 67], [62, 65, 69], [64, 67, 72]]))
+    assert(len(fingering) == 9 and all(f > 0 for f in fingering))
+    # every chord is played across the hand, from the thumb up
+    for event in range(3):
+        assert(fingering[3 * event:3 * event + 3] == sorted(fingering[3 * event:3 * event + 3]))
+    assert(len(comfort) == 2)
+
+    # a chord of six notes cannot be played by one hand, so only its top note is fingered
+    fingering, score, comfort = viterbi(from_chords([[48, 52, 55, 60, 64, 67], [65]]))
+    assert(fingering[:5] == [0] * 5 and fingering[5] > 0)
+
+# test_shapes()
+# test_from_chords()
+# test_viterbi()
@@ -0,0 +1,193 @@
+import collections
+import constants
+import finger
+import hashlib
+import monotonic
+import notestream
+import numpy as np
+import os
+import threading
+
+# Change this whenever the fingerings of a chunk would be found by different rules, so that
+# cache files written by the old rules are no longer used. Changes to COMFORT are picked up
+# automatically, since the file names include a hash of the compiled table.
+SOLVER_VERSION = 1
+
+class ChunkCache:
+    '''
+    A bounded cache of chunk fingerings, shared by every chunk and piece it is used for.
+
+    Fingering a chunk only depends on the hand, the distance between consecutive notes
+    (clamped to 13 half steps, as in monotonic.get_transition_matrices) and the color of each
+    key. So the same shape in another octave or another piece has the same fingerings, and
+    get_signature uses exactly these as the key.
+
+    Up to maxsize chunks are kept in memory, and the least recently used chunk is dropped
+    first. If cache_dir is given, every chunk that is fingered is also written there, and
+    chunks missing from memory are read from there before being fingered. Cache files are
+    named after a hash of the signature, SOLVER_VERSION and the comfort table, so they are
+    safe to share between runs and processes.
+
+    hits counts chunks found in memory or on disk, and disk_hits the ones found on disk.
+    misses counts chunks that had to be fingered.
+
+    A ChunkCache can be shared by threads. Only looking up and adding entries is locked, so
+    threads finger chunks at the same time, and two threads may both finger a chunk that
+    neither has added yet.
+    '''
+    def __init__(self, maxsize=4096, cache_dir=None):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # locks cannot be pickled, such as when the cache is sent to a worker process
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, chunk, rh=True):
+        '''
+        Returns the TransitionScores of chunk, a NoteStream without rests, fingering it only
+        if no chunk with the same signature has been fingered before.
+        '''
+        signature = get_signature(chunk, rh)
+        with self.lock:
+            fingerings = self.entries.get(signature)
+            if fingerings is not None:
+                self.entries.move_to_end(signature)
+                self.hits += 1
+                return finger.TransitionScores(chunk, rh, fingerings)
+
+        fingerings = self.read(signature)
+        from_disk = fingerings is not None
+        if not from_disk:
+            fingerings = monotonic.best_fingerings(chunk, rh)
+            self.write(signature, fingerings)
+        with self.lock:
+            if from_disk:
+                self.hits += 1
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+            self.entries[signature] = fingerings
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return finger.TransitionScores(chunk, rh, fingerings)
+
+    def get_stats(self):
+        '''
+        Returns the counters as a dictionary, along with the number of chunks in memory.
+        '''
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'size': len(self.entries)}
+
+    def get_path(self, signature):
+        key = hashlib.sha256(signature)
+        key.update(b'chunk-%d' % SOLVER_VERSION)
+        key.update(COMFORT_HASH)
+        return os.path.join(self.cache_dir, key.hexdigest() + '.npz')
+
+    def read(self, signature):
+        '''
+        Returns the fingerings stored on disk for signature, or None if there are none. An
+        unreadable file is treated as missing.
+        '''
+        if self.cache_dir is None:
+            return None
+        path = self.get_path(signature)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as arrays:
+                return [(fingering.tolist(), float(score)) for fingering, score in zip(arrays['fingerings'], arrays['scores'])]
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def write(self, signature, fingerings):
+        if self.cache_dir is None:
+            return
+        path = self.get_path(signature)
+        length = len(signature) // 2
+        arrays = np.array([fingering for fingering, score in fingerings], dtype=np.int8).reshape(len(fingerings), length)
+        # write to a temporary file first so other processes never read a partial file
+        partial_path = '%s.%d.%d.partial.npz' % (path[:-len('.npz')], os.getpid(), threading.get_ident())
+        np.savez(partial_path, fingerings=arrays, scores=np.array([score for fingering, score in fingerings]))
+        os.replace(partial_path, path)
+
+def get_signature(chunk, rh=True):
+    '''
+    Returns the key of a chunk in a ChunkCache, as bytes: the hand, the color of each note and
+    the clamped distance between consecutive notes. Chunks with the same signature have the
+    same fingerings, wherever they are on the keyboard.
+    '''
+    distance = np.clip(np.diff(chunk.ps), -13, 13).astype(np.int8) # CLAMP DOWN TO 13
+    return bytes([int(bool(rh))]) + chunk.color.astype(np.int8).tobytes() + distance.tobytes()
+
+COMFORT_HASH = hashlib.sha256(constants.COMFORT_RH.tobytes()).digest()
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_transposed_chunks():
+    # a C major scale in every octave has the same chunks
+    cache = ChunkCache()
+    scale = [60, 62, 64, 65, 67, 69, 71, 72, 71, 69, 67, 65, 64, 62, 60]
+    fingerings = []
+    for octave in range(-2, 3):
+        note_stream = notestream.from_pitches(np.array(scale) + 12 * octave)
+        fingerings.append(finger.solve(note_stream, cache=cache).fingers.tolist())
+    assert(all(fingering == fingerings[0] for fingering in fingerings))
+    assert(fingerings[0] == finger.solve(notestream.from_pitches(scale)).fingers.tolist())
+    assert(cache.get_stats() == {'hits': 8, 'disk_hits': 0, 'misses': 2, 'size': 2})
+
+    # D major has different colors, and the left hand is a different hand
+    finger.solve(notestream.from_pitches(np.array(scale) + 2), cache=cache)
+    finger.solve(notestream.from_pitches(scale), False, cache=cache)
+    assert(cache.misses == 6)
+
+    # hands from a NumPy array share entries with the same Python bools
+    finger.solve(notestream.from_pitches(scale), np.array([False])[0], cache=cache)
+    assert(cache.misses == 6)
+
+def test_lru_and_disk():
+    import shutil
+    import tempfile
+    cache_dir = tempfile.mkdtemp()
+    cache = ChunkCache(maxsize=1, cache_dir=cache_dir)
+    up = notestream.from_pitches([60, 62, 64, 65])
+    down = notestream.from_pitches([65, 64, 62, 60])
+    scores = cache.get(up).get_score_matrix()
+    cache.get(down)
+    assert(len(cache) == 1 and len(os.listdir(cache_dir)) == 2)
+
+    # up was dropped from memory, but is still on disk
+    assert(np.array_equal(cache.get(up).get_score_matrix(), scores))
+    assert((cache.hits, cache.disk_hits, cache.misses) == (1, 1, 2))
+
+    # another cache reads the same files
+    other = ChunkCache(cache_dir=cache_dir)
+    assert(np.array_equal(other.get(notestream.from_pitches([72, 74, 76, 77])).get_score_matrix(), scores))
+    assert(other.misses == 0)
+    shutil.rmtree(cache_dir)
+
+# test_transposed_chunks()
+# test_lru_and_disk()
@@ -35,6 +35,8 @@ following principles are followed:
 		comfort scores should be the same. For example, C4 and E4 have the same physical
 		distance as D4 and F4, but more half steps between them.
 '''
+import numpy as np
+
 COMFORT = {
 	(0, 'white', 'white'): {
 		(1, 1): 10,
@@ -584,4 +586,36 @@ COMFORT = {
 	(13, 'black', 'black'): {
 		(1, 5): 10,
 	},
-}
\ No newline at end of file
+}
+
+'''
+COMFORT compiled into dense arrays, so that a solver can fetch the 5x5 matrix of comfort scores
+for a note transition with one indexing operation. They are built once, when this module is
+first imported.
+
+COMFORT_RH[distance, color 1, color 2, finger 1 - 1, finger 2 - 1] is equal to
+COMFORT[(distance, color 1, color 2)][(finger 1, finger 2)], where colors are indexed by their
+position in COLORS. Unacceptable finger pairs, and combinations of distance and colors that are
+not in COMFORT, are set to FORBIDDEN.
+
+COMFORT_LH is the same table mirrored for the left hand. For both hands, the indices are
+(distance, color of lower note, color of higher note, finger on lower note, finger on higher note).
+'''
+COLORS = ['white', 'black']
+BLACK_PITCH_CLASSES = [1, 3, 6, 8, 10]
+FORBIDDEN = -np.inf
+
+def compile_comfort(comfort):
+	'''
+	Converts a comfort table in the format of COMFORT into a [14, 2, 2, 5, 5] array.
+	'''
+	table = np.full((14, len(COLORS), len(COLORS), 5, 5), FORBIDDEN)
+	for (distance, color_1, color_2), finger_pairs in comfort.items():
+		for (finger_1, finger_2), score in finger_pairs.items():
+			table[distance, COLORS.index(color_1), COLORS.index(color_2), finger_1 - 1, finger_2 - 1] = score
+	table.setflags(write=False)
+	return table
+
+COMFORT_RH = compile_comfort(COMFORT)
+# mirroring the hand swaps the colors and the fingers of the two notes
+COMFORT_LH = COMFORT_RH.transpose(0, 2, 1, 4, 3)
@@ -1,12 +1,21 @@
 import monotonic
+import chords
+import concurrent.futures
+import constants
 import copy
-from music21 import *
+import glob
+import instrument
+import itertools
+import notestream
+import numpy as np
+import os
 
 def split(part, rh=True, rest_flag=-1):
     '''
     Split a given piano part (for a single hand) into ascending and descending chunks.
-    Returns a list of lists each representing a monotonic chunk of notes.
-    Adjacent chunks share a note.
+    part can be a music21 part or a NoteStream made by notestream.from_part.
+    Returns a list of arrays, each holding the indices of a monotonic chunk of notes in the
+    NoteStream of part. Adjacent chunks share a note.
 
     rest_flag is used to decide which (if any) rests should be used as moments to split into a chunk.
     If rest_flag is -1, rests will not be used as rests.
@@ -22,151 +31,481 @@ def split(part, rh=True, rest_flag=-1):
     the top note. Otherwise, we choose the bottom note.
     
     '''
-    chunks = []
-    note_1 = part.flat.notes[0]
-    if isinstance(note_1, chord.Chord):
-        if rh:
-            note_w = note_w.notes[-1] # set current note to highest note in chord
-        else:
-            note_w = note_w.notes[0] # set current note to lowest note in chord
-    note_2 = part.flat.notes[1]
-    if isinstance(note_2, chord.Chord):
-        if rh:
-            note_2 = note_2.notes[-1] # set current note to highest note in chord
-        else:
-            note_2 = note_2.notes[0] # set current note to lowest note in chord
-    current_chunk = [note_1, note_2]
-    is_ascending = current_chunk[1].pitch.ps >= current_chunk[0].pitch.ps           # true if the 2nd note is weakly higher than 1st note
-
-    for i in range(2, len(part.flat.notesAndRests)):
-        prev_note = current_chunk[-1]
-        current_note = part.flat.notesAndRests[i]
-
-        if isinstance(current_note, note.Rest):     
-            if i == len(part.flat.notesAndRests)-1:         # if part ends on rest
-                break
-
-            if rest_flag != -1 and current_note.duration.quarterLength >= rest_flag:
-                if len(current_chunk) != 1:
-                    chunks.append(current_chunk)
+    if not isinstance(part, notestream.NoteStream):
+        part = notestream.from_part(part, rh)
+    notes = part.note_indices()
+    if len(notes) < 2:
+        return [notes]
+
+    # starts[k] is True if the transition from notes[k] to notes[k+1] begins a new chunk
+    starts = np.zeros(len(notes) - 1, dtype=bool)
+    starts[0] = True
+    if rest_flag != -1:
+        # a long enough rest resets the hand before the next note
+        resets = np.flatnonzero(part.is_rest & (part.duration >= rest_flag))
+        transitions = np.searchsorted(notes, resets) - 1
+        starts[transitions[(transitions >= 0) & (transitions < len(notes) - 1)]] = True
+
+    # a chunk keeps its direction through repeated notes, and a chunk that starts with a
+    # repeated note is ascending
+    signs = np.sign(np.diff(part.ps[notes]))
+    signs[starts & (signs == 0)] = 1
+    last_change = np.maximum.accumulate(np.where(signs != 0, np.arange(len(signs)), 0))
+    directions = signs[last_change]
+    starts[1:] |= directions[1:] != directions[:-1]
+
+    bounds = np.append(np.flatnonzero(starts), len(notes) - 1)
+    return [notes[bounds[i]:bounds[i+1] + 1] for i in range(len(bounds) - 1)]
+
+def finger_both(score, rest_flag=-1, engine='chunk', in_place=False, parallel=False, hands=None, cache=None,
+        stats=None):
+    '''
+    Given a piano score, returns a score with annotated fingerings for both hands.
 
-                current_chunk = [prev_note]
-                # Assumes ascending, changes later if this guess is wrong
-                is_ascending = True        
-            continue
+    By default, parts alternate between hands: the first part is fingered with the right
+    hand, the second with the left, and so on for scores with more parts, such as pieces for
+    four hands. hands can instead be a list with True for each right-hand part and False for
+    each left-hand part. Parts after the end of hands are not fingered.
 
+    If parallel is True, the parts are fingered at the same time in a pool of processes, and
+    each part is annotated as soon as its fingering is done. Starting the processes takes
+    a moment, so this only pays off for long parts.
 
-        elif isinstance(current_note, chord.Chord):
-            if rh:
-                current_note = current_note.notes[-1] # set current note to highest note in chord
-            else:
-                current_note = current_note.notes[0] # set current note to lowest note in chord
-        if is_ascending:
-            if current_note.pitch.ps >= prev_note.pitch.ps:
-                current_chunk.append(current_note)
-            elif len(current_chunk) == 1:
-                # if we just left a chord and guessed incorrectly
-                current_chunk.append(current_note)
-                is_ascending = False
-            else:
-                # switch to descending now                               
-                chunks.append(current_chunk)
-                current_chunk = [prev_note, current_note]
-                is_ascending = False
-        else:
-            if current_note.pitch.ps <= prev_note.pitch.ps:
-                current_chunk.append(current_note)
-            else:
-                # switch to ascending now
-                chunks.append(current_chunk)
-                current_chunk = [prev_note, current_note]
-                is_ascending = True
-    chunks.append(current_chunk)
-    return chunks
+    Unless in_place is True, the annotations are added to a copy of score. cache is passed
+    to solve. In parallel mode, each process works on its own copy of it, so only chunks
+    that it stores on disk are shared between parts.
 
-def finger_both(score, rest_flag=-1):
+    stats can be an instrument.Stats, which collects measurements of every part, including
+    those fingered in other processes.
     '''
-    Given a piano score, returns a score with annotated fingerings for both hands.
-    '''
-    annotated_rh = finger(score.parts[0], rest_flag=rest_flag)
-    annotated_lh = finger(score.parts[1], False, rest_flag=rest_flag)
-
-    annotated_score = copy.deepcopy(score)
-
+    annotated_score = score if in_place else copy.deepcopy(score)
+    parts = list(annotated_score.parts)
+    if hands is None:
+        hands = [i % 2 == 0 for i in range(len(parts))]
+    hands = hands[:len(parts)]
+    with instrument.stage(stats, 'extract'):
+        note_streams = [extract(part, rh, engine) for part, rh in zip(parts, hands)]
+
+    def annotate(i, result):
+        with instrument.stage(stats, 'annotate'):
+            if engine == 'chord':
+                chords.annotate_score(parts[i], note_streams[i], result.fingers, in_place=True)
+            else:
+                monotonic.annotate_score(parts[i], result.fingers.tolist(), rh=hands[i], in_place=True)
+        print(result.normalized_score)
+
+    if parallel and note_streams:
+        # send NoteStreams rather than music21 parts, since they are much cheaper to pickle
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(note_streams)) as executor:
+            futures = {executor.submit(solve_measured, note_stream, rh, rest_flag, engine, cache, stats is not None): i
+                for i, (note_stream, rh) in enumerate(zip(note_streams, hands))}
+            for future in concurrent.futures.as_completed(futures):
+                result, part_stats = future.result()
+                if stats is not None:
+                    stats.merge(part_stats)
+                annotate(futures[future], result)
+    else:
+        for i, (note_stream, rh) in enumerate(zip(note_streams, hands)):
+            annotate(i, solve(note_stream, rh, rest_flag, engine, cache=cache, stats=stats))
     return annotated_score
 
-def finger(score, rh=True, rest_flag=-1):
+def finger(score, rh=True, rest_flag=-1, engine='chunk', in_place=False, k=None, cache=None, stats=None):
     '''
     Given a single-hand piano score, returns a score with an annotated fingering. If rh is True, generate
     a right-handed fingering. Otherwise, generate a left-handed fingering.
-    '''    
-    chunks = split(score, rh, rest_flag=rest_flag)
 
-    # keep memo tables to avoid repeat calculations
-    memo_table = dict() 
-    transition_table = dict()
+    engine, cache and stats are passed to solve. Unless in_place is True, the
+    annotations are added to a copy of score. To get the fingering without building a score
+    or printing, use solve instead.
 
-    best_score = 0
-    best_fingering = []
+    If k is given, returns a list of up to k copies of score annotated with the k best
+    distinct fingerings, best first, as found by solve_k_best. in_place is ignored then.
+    '''
+    with instrument.stage(stats, 'extract'):
+        note_stream = extract(score, rh, engine)
+
+    if k is not None:
+        annotated_scores = []
+        for result in itertools.islice(solve_k_best(note_stream, rh, rest_flag, engine, stats), k):
+            with instrument.stage(stats, 'annotate'):
+                annotated_scores.append(monotonic.annotate_score(score, result.fingers.tolist(), rh=rh))
+            print(result.normalized_score)
+        return annotated_scores
+
+    result = solve(note_stream, rh, rest_flag, engine, cache=cache, stats=stats)
+    with instrument.stage(stats, 'annotate'):
+        if engine == 'chord':
+            annotated_score = chords.annotate_score(score, note_stream, result.fingers, in_place=in_place)
+        else:
+            annotated_score = monotonic.annotate_score(score, result.fingers.tolist(), rh=rh, in_place=in_place)
 
-    # try ending on every finger
-    for j in range(1, 6):
-        fingering, points = compute_best_score(chunks, len(chunks) - 1, j, memo_table, transition_table, rh)
-        if points > best_score:
-            best_score = points
-            best_fingering = fingering
+    print(result.normalized_score)
+    return annotated_score
 
-    annotated_score = monotonic.annotate_score(score, best_fingering, rh=rh)
+def solve(note_stream, rh=True, rest_flag=-1, engine='chunk', jobs=1, cache=None, stats=None):
+    '''
+    Given the NoteStream of a single-hand part, returns its FingeringResult.
+
+    engine chooses the algorithm:
+        'chunk' splits the part into monotonic chunks, fingers each chunk and stitches them
+            together, maximizing the sum of the average comfort of each chunk.
+        'viterbi' skips chunking and maximizes the total comfort over every note transition
+            in one pass. rest_flag has no effect, since it only changes where chunks split.
+        'chord' is like 'viterbi', but fingers every tone of each chord. note_stream must be
+            a chords.ChordStream, as made by extract. See solve_chords.
+
+    With the chunk engine, jobs greater than 1 stitches the chunks in that many processes
+    using compute_best_score_parallel, which is worth it for very long parts. Otherwise, cache
+    can be a chunkcache.ChunkCache, so chunks with the same shape as chunks fingered before,
+    in this part or any other, are not fingered again.
+
+    If stats is an instrument.Stats, the time of each stage, the number of notes and the
+    length of each chunk are added to it.
+    '''
+    if engine == 'chord':
+        return solve_chords(note_stream, rh, stats)
+    note_indices = note_stream.note_indices()
+    notes = note_stream[note_indices]
+    if stats is not None:
+        stats.count('notes', len(notes))
+    if len(notes) == 0:
+        return FingeringResult(np.zeros(0, dtype=np.int8), note_indices, np.zeros(0), np.zeros(0, dtype=int), 0, 0)
+
+    if engine == 'chunk':
+        with instrument.stage(stats, 'split'):
+            chunk_indices = split(note_stream, rest_flag=rest_flag)
+        chunks = [note_stream[chunk] for chunk in chunk_indices]
+        if stats is not None:
+            stats.add_chunks([len(chunk) for chunk in chunk_indices])
+        with instrument.stage(stats, 'compute_best_score'):
+            if jobs > 1:
+                best_fingering, best_score = compute_best_score_parallel(chunks, rh, jobs)
+            else:
+                best_fingering, best_score = compute_best_score(chunks, rh, cache=cache, stats=stats)
+        normalized_score = best_score / (len(chunk_indices) * 10)
+        # positions of the chunk bounds among the notes
+        chunk_bounds = np.searchsorted(note_indices, [chunk[0] for chunk in chunk_indices] + [note_indices[-1]])
+    elif engine == 'viterbi':
+        with instrument.stage(stats, 'viterbi'):
+            best_fingering, best_score = viterbi(notes, rh)
+        normalized_score = best_score / (max(len(notes) - 1, 1) * 10)
+        chunk_bounds = np.array([0, len(notes) - 1])
+    else:
+        raise ValueError("engine must be 'chunk', 'viterbi' or 'chord', not %r" % (engine,))
 
-    print( best_score / (len(chunks) * 10))
-    return annotated_score
+    fingers = np.array(best_fingering, dtype=np.int8)
+    comfort = np.zeros(0)
+    if len(fingers) > 1:
+        transitions = monotonic.get_transition_matrices(notes, rh)
+        comfort = transitions[np.arange(len(fingers) - 1), fingers[:-1] - 1, fingers[1:] - 1]
+    return FingeringResult(fingers, note_indices, comfort, chunk_bounds, best_score, normalized_score)
 
+def solve_chords(chord_stream, rh=True, stats=None):
+    '''
+    Given the ChordStream of a single-hand part, returns its FingeringResult from
+    chords.viterbi. fingers then has one finger for each chord tone, or 0 for tones that the
+    hand cannot reach, and note_indices has the event of each tone. The normalized score
+    divides by 10 times the number of pairs of fingered tones that were scored, which are
+    the transitions between events and the adjacent tones of each chord.
+    '''
+    if stats is not None:
+        stats.count('notes', len(chord_stream))
+    with instrument.stage(stats, 'chords'):
+        fingering, best_score, comfort = chords.viterbi(chord_stream, rh)
+    fingers = np.array(fingering, dtype=np.int8)
+    note_indices = np.repeat(np.arange(len(chord_stream)), np.diff(chord_stream.bounds))
+    normalized_score = best_score / (max(np.count_nonzero(fingers) - 1, 1) * 10)
+    chunk_bounds = np.array([0, max(len(chord_stream) - 1, 0)])
+    return FingeringResult(fingers, note_indices, np.array(comfort), chunk_bounds, best_score, normalized_score)
+
+def extract(part, rh=True, engine='chunk'):
+    '''
+    Returns what solve takes for a part with engine: a chords.ChordStream for the chord engine,
+    or a NoteStream for the others.
+    '''
+    if engine == 'chord':
+        return chords.from_part(part, rh)
+    return notestream.from_part(part, rh)
 
-def compute_best_score(chunks, i, j, memo_table, transition_table, rh=True):
+def solve_measured(note_stream, rh=True, rest_flag=-1, engine='chunk', cache=None, measure=True):
     '''
-    Computes best score for all chunks up to chunks[i] where chunk i ends with finger j
-    Returns (fingering, total score)
+    Returns (result, stats), where result is from solve and stats is an instrument.Stats of
+    what it measured, or None if measure is False. This sends the measurements back from
+    another process.
     '''
-    possible_fingers = [1,2,3,4,5]
+    stats = instrument.Stats() if measure else None
+    return (solve(note_stream, rh, rest_flag, engine, cache=cache, stats=stats), stats)
 
-    # store TransitionScores to avoid calling finger_monotonic multiple times
-    if i in transition_table:
-        transition_score = transition_table[i]
+def solve_k_best(note_stream, rh=True, rest_flag=-1, engine='chunk', stats=None):
+    '''
+    Generates a FingeringResult for each distinct fingering of a single-hand part, from best
+    to worst by the total score that engine maximizes (see solve). The first result has the
+    same total score as solve, though it may be a different fingering when several tie.
+
+    Both engines add up a score for each note transition. The chunk engine adds the average
+    comfort of each chunk, which is the comfort of each transition divided by the number of
+    transitions in its chunk. So fingerings are found one at a time by
+    monotonic.k_best_paths, and taking the first k costs time proportional to k and the
+    length of the part. If stats is an instrument.Stats, the peak number of partial
+    fingerings that the search keeps is added to it. The chord engine is not supported.
+    '''
+    if engine not in ['chunk', 'viterbi']:
+        raise ValueError("engine must be 'chunk' or 'viterbi', not %r" % (engine,))
+    note_indices = note_stream.note_indices()
+    notes = note_stream[note_indices]
+    if len(notes) == 0:
+        return
+
+    transitions = monotonic.get_transition_matrices(notes, rh)
+    if engine == 'chunk':
+        chunk_indices = split(note_stream, rest_flag=rest_flag)
+        chunk_bounds = np.searchsorted(note_indices, [chunk[0] for chunk in chunk_indices] + [note_indices[-1]])
+        lengths = np.repeat(np.diff(chunk_bounds), np.diff(chunk_bounds))
+        weights = transitions / lengths[:, np.newaxis, np.newaxis]
+        scale = len(chunk_indices) * 10
     else:
-        transition_score = TransitionScores(chunks[i], rh)
-        transition_table[i] = transition_score
-
-    # base case
-    if i == 0:
-        # find best starting finger
-        best_start = max(possible_fingers, key=lambda start: transition_score.get_fingering_option(start, j)[1])
-        fingering, score = transition_score.get_fingering_option(best_start, j)
-        memo_table[(i, j)] = fingering, score
-        return (fingering, score)
-
-    score = 0
-    fingering = []
-    # try every possible end finger for this chunk
-    for e in possible_fingers:
-        # see if subproblem is in memo_table
-        if (i-1, e) in memo_table:
-            prev_fingering, prev_score = memo_table[(i-1, e)]
-        else:
-            prev_fingering, prev_score = compute_best_score(chunks, i-1, e, memo_table, transition_table, rh)
-        possible_fingering, possible_score = transition_score.get_fingering_option(e, j)
+        chunk_bounds = np.array([0, len(notes) - 1])
+        weights = transitions
+        scale = max(len(notes) - 1, 1) * 10
+
+    for fingering, total_score in monotonic.k_best_paths(weights, stats):
+        fingers = np.array(fingering, dtype=np.int8)
+        comfort = transitions[np.arange(len(fingers) - 1), fingers[:-1] - 1, fingers[1:] - 1]
+        yield FingeringResult(fingers, note_indices, comfort, chunk_bounds, total_score, total_score / scale)
+
+class FingeringResult:
+    '''
+    The fingering of a single-hand part, as arrays rather than an annotated score.
+
+    fingers: int8 array with a finger from 1 to 5 for each note, or empty if there is no
+        valid fingering. With the chord engine, there is one for each chord tone instead.
+    note_indices: index in the NoteStream of each note, so fingers[i] belongs to the element
+        at note_indices[i]
+    comfort: comfort score of each transition between consecutive notes
+    chunk_bounds: position in fingers of the first note of each chunk, followed by the
+        position of the last note. The viterbi engine treats the whole part as one chunk.
+    total_score: the total score that the engine maximized
+    normalized_score: total_score scaled to be from 0 to 1
+    '''
+    def __init__(self, fingers, note_indices, comfort, chunk_bounds, total_score, normalized_score):
+        self.fingers = fingers
+        self.note_indices = note_indices
+        self.comfort = comfort
+        self.chunk_bounds = chunk_bounds
+        self.total_score = total_score
+        self.normalized_score = normalized_score
+
+def viterbi(notes, rh=True):
+    '''
+    Computes the best fingering over every note transition of a NoteStream without rests in
+    a single forward pass, without splitting into chunks.
+
+    best[f] is the best total comfort of the notes so far where the current note is played
+    with finger f + 1. For each note we store which previous finger gave that score, then
+    backtrack from the best last finger.
+    Returns (fingering, total score). If there is no valid fingering, returns ([], 0)
+    '''
+    if len(notes) == 0:
+        return ([], 0)
+
+    transitions = monotonic.get_transition_matrices(notes, rh)
+    best = np.zeros(5)
+    backpointers = []
+    for i in range(1, len(notes)):
+        # scores[p, f] is the total when the previous note is played with p and this note with f
+        scores = best[:, np.newaxis] + transitions[i-1]
+        best = scores.max(axis=0)
+        if np.all(best == constants.FORBIDDEN):
+            return ([], 0)
+        backpointers.append(scores.argmax(axis=0))
+
+    # backtrack from the best last finger
+    last_finger = int(np.argmax(best))
+    fingering = [last_finger]
+    for pointers in reversed(backpointers):
+        fingering.append(int(pointers[fingering[-1]]))
+    fingering.reverse()
+    return ([f + 1 for f in fingering], float(best[last_finger]))
+
+
+def compute_best_score(chunks, rh=True, transition_table=None, cache=None, stats=None):
+    '''
+    Computes the best fingering for all chunks, where each chunk starts with the finger
+    that the previous chunk ends with.
+
+    Works bottom-up: best[j] is the best score for all chunks up to chunk i where chunk i
+    ends with finger j + 1, and backpointers[i][j] is e where chunk i starts with finger e + 1
+    in that fingering. Each chunk is a single max-plus step with its 5x5 score matrix. The full
+    fingering is only rebuilt once, at the end.
+
+    transition_table maps chunk indices to their TransitionScores. Any chunks missing from
+    it are fingered and added to it, or looked up in cache if it is a chunkcache.ChunkCache.
+    If stats is an instrument.Stats, the time spent fingering chunks is added as the stage
+    finger_chunks, and lookups in cache as chunk_cache_hits and chunk_cache_misses.
+    Returns (fingering, total score). If there is no valid fingering, returns ([], 0)
+    '''
+    if transition_table is None:
+        transition_table = dict()
+
+    best = np.zeros(5)
+    backpointers = []
+    for i in range(len(chunks)):
+        # store TransitionScores to avoid calling finger_monotonic multiple times
+        if i not in transition_table:
+            with instrument.stage(stats, 'finger_chunks'):
+                if cache is None:
+                    transition_table[i] = TransitionScores(chunks[i], rh)
+                else:
+                    misses = cache.misses
+                    transition_table[i] = cache.get(chunks[i], rh)
+                    if stats is not None:
+                        stats.count('chunk_cache_misses' if cache.misses > misses else 'chunk_cache_hits')
+
+        # scores[e, j] is the total when the last chunk ends on e + 1 and this chunk
+        # starts on e + 1 and ends on j + 1
+        scores = best[:, np.newaxis] + transition_table[i].get_score_matrix()
+        best = scores.max(axis=0)
+        if np.all(best == constants.FORBIDDEN):
+            return ([], 0)
+        backpointers.append(scores.argmax(axis=0))
+
+    # rebuild the fingering backwards from the best last finger
+    j = int(np.argmax(best))
+    total_score = float(best[j])
+    pieces = []
+    for i in range(len(chunks) - 1, -1, -1):
+        e = int(backpointers[i][j])
+        possible_fingering = transition_table[i].get_fingering_option(e + 1, j + 1)[0]
+        # adjacent chunks share a note
+        pieces.append(possible_fingering if i == 0 else possible_fingering[1:])
+        j = e
+    fingering = [f for piece in reversed(pieces) for f in piece]
+    return (fingering, total_score)
+
+def compute_best_score_parallel(chunks, rh=True, jobs=None):
+    '''
+    Computes the same best score as compute_best_score for very long parts, by splitting
+    the chunks into blocks and working on each block in a separate process.
+
+    Stitching chunks is a chain of max-plus products of their 5x5 score matrices, and
+    max-plus products are associative. So each process reduces its block to one 5x5 matrix,
+    the product of its chunks' matrices. The block matrices are stitched like chunks, which
+    gives the finger at every block boundary. Then each process rebuilds the fingering of its
+    block between those fingers, from the chunk tables that reducing the block built, so no
+    chunk is fingered twice. Rebuilding only needs one fingering per chunk, instead of the
+    25 that TransitionScores keeps, so this is also faster with a single process.
+
+    jobs is the number of blocks and processes (by default, one per core). When several
+    fingerings share the best score, the fingering may differ from compute_best_score.
+    Returns (fingering, total score). If there is no valid fingering, returns ([], 0)
+    '''
+    if len(chunks) == 0:
+        return ([], 0)
+    jobs = min(jobs or os.cpu_count() or 1, len(chunks))
+    size = -(-len(chunks) // jobs)
+    blocks = [chunks[i:i + size] for i in range(0, len(chunks), size)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(blocks)) as executor:
+        reduced = list(executor.map(reduce_block, blocks, [rh] * len(blocks)))
+
+        # stitch the blocks as in compute_best_score
+        best = np.zeros(5)
+        backpointers = []
+        for tables, matrices, product in reduced:
+            scores = best[:, np.newaxis] + product
+            best = scores.max(axis=0)
+            if np.all(best == constants.FORBIDDEN):
+                return ([], 0)
+            backpointers.append(scores.argmax(axis=0))
+
+        # the fingers at the start and end of each block
+        j = int(np.argmax(best))
+        total_score = float(best[j])
+        block_fingers = [None] * len(blocks)
+        for b in range(len(blocks) - 1, -1, -1):
+            e = int(backpointers[b][j])
+            block_fingers[b] = (e, j)
+            j = e
+
+        pieces = executor.map(finger_block, [tables for tables, matrices, product in reduced],
+            [matrices for tables, matrices, product in reduced], *zip(*block_fingers))
+        # adjacent blocks share a note
+        fingering = [f for b, piece in enumerate(pieces) for f in (piece if b == 0 else piece[1:])]
+    return (fingering, total_score)
+
+def get_chunk_score_matrix(best):
+    '''
+    Given the best table from monotonic.get_chunk_tables, returns the score matrix that
+    TransitionScores.get_score_matrix would return for the same chunk.
+    '''
+    return best[0] / max(len(best) - 1, 1)
 
-        # if this new fingering works, update
-        if possible_fingering != [] and prev_score + possible_score > score:
-            score = prev_score + possible_score
-            fingering = prev_fingering + possible_fingering[1:]
-    #store in table
-    memo_table[(i, j)] = fingering, score
-    return (fingering, score)
+def reduce_block(chunks, rh=True):
+    '''
+    Returns (tables, matrices, product) for a block of chunks, where tables holds the
+    tables from monotonic.get_chunk_tables of every chunk, matrices holds the score matrix of
+    each chunk and product is their max-plus product. product[s, e] is the best total score
+    of the block when it starts with finger s + 1 and ends with finger e + 1.
+
+    tables is (transitions, best, starts), with the tables of all chunks stacked into two
+    arrays, since a few large arrays are much cheaper to send between processes than many
+    small ones. The tables of chunk i start at starts[i] - i in transitions and at starts[i]
+    in best.
+    '''
+    chunk_tables = [monotonic.get_chunk_tables(chunk, rh) for chunk in chunks]
+    matrices = np.array([get_chunk_score_matrix(best) for transitions, best in chunk_tables])
+    starts = np.cumsum([0] + [len(best) for transitions, best in chunk_tables])
+    tables = (np.concatenate([transitions for transitions, best in chunk_tables]),
+        np.concatenate([best for transitions, best in chunk_tables]), starts)
+    product = matrices[0]
+    for matrix in matrices[1:]:
+        product = np.max(product[:, :, np.newaxis] + matrix[np.newaxis, :, :], axis=1)
+    return (tables, matrices, product)
+
+def finger_block(tables, matrices, start, end):
+    '''
+    Returns the best fingering of a block of chunks that starts with finger start + 1 and
+    ends with finger end + 1, given the tables and matrices from reduce_block.
+    '''
+    best = np.where(np.arange(5) == start, 0.0, constants.FORBIDDEN)
+    backpointers = []
+    for matrix in matrices:
+        scores = best[:, np.newaxis] + matrix
+        best = scores.max(axis=0)
+        backpointers.append(scores.argmax(axis=0))
+
+    pieces = []
+    j = end
+    transitions, chunk_best, starts = tables
+    for i in range(len(matrices) - 1, -1, -1):
+        e = int(backpointers[i][j])
+        possible_fingering = monotonic.trace_fingering(transitions[starts[i] - i:starts[i + 1] - i - 1],
+            chunk_best[starts[i]:starts[i + 1]], e + 1, j + 1)
+        pieces.append(possible_fingering if i == 0 else possible_fingering[1:])
+        j = e
+    return [f for piece in reversed(pieces) for f in piece]
 
 class TransitionScores:
-    def __init__(self,  chunk, rh=True):
+    def __init__(self, chunk, rh=True, fingerings=None):
+        '''
+        chunk is a NoteStream (or list of Notes) for a single monotonic chunk.
+
+        Indexes the best fingering option for each (start, end) pair, so lookups do not
+        scan the list of fingerings. fingerings can be given in the format of
+        monotonic.best_fingerings, such as when they come from a chunkcache.ChunkCache, so
+        the chunk is not fingered again.
+        '''
         self.chunk = chunk
-        self.fingerings = monotonic.finger_monotonic(self.chunk, rh)
+        self.fingerings = monotonic.best_fingerings(self.chunk, rh) if fingerings is None else fingerings
+
+        self.options = dict()
+        self.scores = np.full((5, 5), constants.FORBIDDEN)
+        for fingering, score in self.fingerings:
+            start_finger, end_finger = fingering[0], fingering[-1]
+            # fingerings are sorted by score, so the first one for each pair is the best
+            if (start_finger, end_finger) not in self.options:
+                self.options[(start_finger, end_finger)] = (fingering, score)
+                self.scores[start_finger - 1, end_finger - 1] = score
 
     def get_fingering_option(self, start_finger, end_finger):
         '''
@@ -174,11 +513,15 @@ class TransitionScores:
         and ends on end_finger.
         Returns (fingering, score). If not found, returns ([], 0)
         '''
-        for fingering, score in self.fingerings:
-            if fingering[0] == start_finger and fingering[-1] == end_finger:
-                return (fingering, score)
+        return self.options.get((start_finger, end_finger), ([], 0))
 
-        return ([], 0)
+    def get_score_matrix(self):
+        '''
+        Returns a 5x5 array where entry [start_finger - 1, end_finger - 1] is the score of the
+        best fingering that starts on start_finger and ends on end_finger, or
+        constants.FORBIDDEN if there is no such fingering.
+        '''
+        return self.scores
 
 
 ################################################################################
@@ -188,31 +531,249 @@ class TransitionScores:
 ################################################################################
 
 def test_c_maj_scale():
+    from music21 import converter
     c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
     result = finger(c_maj_scale.parts[0])
     result.show()
 
 def test_b_maj_scale():
+    from music21 import converter
     b_maj_scale = converter.parse('./data/scales/bmaj.mxl')
     result = finger(b_maj_scale.parts[0])
     result.show()
 
 def test_c_maj_arpeggio():
+    from music21 import converter
     c_maj_arpeggio = converter.parse('./data/arpeggios/cmaj.mxl')
     result = finger(c_maj_arpeggio.parts[0])
     result.show()
 
 def test_bwv108_soprano():
+    from music21 import corpus
     bach = corpus.parse('bach/bwv108.6.xml')
     result = finger(bach.parts[0])
     result.show()
 
+def test_best_fingerings_match_bfs():
+    from music21 import converter, note, pitch
+    for path in glob.glob('./data/*/*.mxl'):
+        parsed = converter.parse(path)
+        for part, rh in [(parsed.parts[0], True), (parsed.parts[1], False)]:
+            note_stream = notestream.from_part(part, rh)
+            for chunk in split(note_stream):
+                notes = [note.Note(pitch.Pitch(ps=ps)) for ps in note_stream.ps[chunk]]
+                all_fingerings = monotonic.finger_monotonic(notes, rh)
+                best = monotonic.best_fingerings(note_stream[chunk], rh)
+                for start in range(1, 6):
+                    for end in range(1, 6):
+                        expected = next((f for f in all_fingerings if f[0][0] == start and f[0][-1] == end), None)
+                        found = next((f for f in best if f[0][0] == start and f[0][-1] == end), None)
+                        assert(expected == found)
+        print(path, 'ok')
+
+def test_viterbi_beats_chunks():
+    # viterbi maximizes total comfort over all transitions, so it can never do worse than
+    # the stitched chunk fingering by that measure
+    from music21 import converter
+    for path in glob.glob('./data/*/*.mxl'):
+        parsed = converter.parse(path)
+        for part, rh in [(parsed.parts[0], True), (parsed.parts[1], False)]:
+            note_stream = notestream.from_part(part, rh)
+            notes = note_stream.without_rests()
+            fingering, viterbi_score = viterbi(notes, rh)
+            chunks = [note_stream[chunk] for chunk in split(note_stream)]
+            chunk_fingering = compute_best_score(chunks, rh)[0]
+            transitions = monotonic.get_transition_matrices(notes, rh)
+            chunk_score = sum(transitions[i, chunk_fingering[i] - 1, chunk_fingering[i+1] - 1] for i in range(len(notes) - 1))
+            assert(len(fingering) == len(notes))
+            assert(viterbi_score >= chunk_score)
+            print(path, rh, viterbi_score, chunk_score)
+
+def test_c_maj_scale_viterbi():
+    from music21 import converter
+    c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
+    result = finger(c_maj_scale.parts[0], engine='viterbi')
+    result.show()
+
+def test_k545_viterbi():
+    from music21 import corpus
+    k545 = corpus.parse('mozart/k545')
+    result = finger_both(k545, engine='viterbi')
+    result.show()
+
+def test_split_mary():
+    from music21 import note, stream
+    mary = stream.Part([note.Note(p) for p in 'E D C D E E E D D D E G G E D C D E E E E D D D E D C'.split()])
+    notes = mary.flat.notes
+    assert([''.join(notes[i].name for i in chunk) for chunk in split(mary)] == \
+        ['EDC', 'CDEEE', 'EDDD', 'DEGG', 'GEDC', 'CDEEEE', 'EDDD', 'DE', 'EDC'])
+
+def test_split_with_rests():
+    from music21 import note, stream
+    part = stream.Part([note.Note('C4'), note.Note('D4'), note.Rest(quarterLength=2), note.Note('E4'),
+        note.Note('F4'), note.Rest(quarterLength=0.5), note.Note('D4'), note.Rest()])
+    assert([list(chunk) for chunk in split(part)] == [[0, 1, 3, 4], [4, 6]])
+    # the long rest starts a new chunk, but a rest at the end does not
+    assert([list(chunk) for chunk in split(part, rest_flag=1.0)] == [[0, 1], [1, 3, 4], [4, 6]])
+
+def test_compute_best_score_long_part():
+    # more chunks than the recursion limit
+    from music21 import converter
+    c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
+    note_stream = notestream.from_part(c_maj_scale.parts[0])
+    chunks = [note_stream[chunk] for chunk in split(note_stream)] * 1000
+    fingering, score = compute_best_score(chunks)
+    assert(len(fingering) == sum(len(chunk) - 1 for chunk in chunks) + 1)
+    print(score / (len(chunks) * 10))
+
+def test_compute_best_score_parallel():
+    from music21 import converter, corpus
+    import time
+    for path in glob.glob('./data/*/*.mxl'):
+        note_stream = notestream.from_part(converter.parse(path).parts[0])
+        chunks = [note_stream[chunk] for chunk in split(note_stream)]
+        for jobs in [1, 2, 3]:
+            fingering, score = compute_best_score_parallel(chunks, jobs=jobs)
+            assert(abs(score - compute_best_score(chunks)[1]) < 1e-9)
+            assert(len(fingering) == len(note_stream))
+
+    k545 = notestream.from_part(corpus.parse('mozart/k545').parts[0])
+    chunks = [k545[chunk] for chunk in split(k545)] * 20
+    start = time.time()
+    fingering, score = compute_best_score(chunks)
+    print('sequential: %.2f seconds' % (time.time() - start))
+    start = time.time()
+    parallel_fingering, parallel_score = compute_best_score_parallel(chunks, jobs=4)
+    print('parallel: %.2f seconds' % (time.time() - start))
+    assert(abs(score - parallel_score) < 1e-6)
+    # adjacent chunks share a note
+    pitches = np.concatenate([chunk.ps[:-1] for chunk in chunks] + [chunks[-1].ps[-1:]])
+    transitions = monotonic.get_transition_matrices(notestream.from_pitches(pitches))
+    assert(all(transitions[i, parallel_fingering[i] - 1, parallel_fingering[i+1] - 1] != constants.FORBIDDEN
+        for i in range(len(parallel_fingering) - 1)))
+
+def test_finger_both_annotates_both_hands():
+    from music21 import articulations, corpus
+    k545 = corpus.parse('mozart/k545')
+    result = finger_both(k545)
+    for part in result.parts[:2]:
+        notes = part.flat.notes
+        assert(all(len([a for a in n.articulations if isinstance(a, articulations.Fingering)]) == 1 for n in notes))
+    # the original score is left alone
+    assert(all(len(n.articulations) == 0 for n in k545.parts[0].flat.notes))
+
+def test_solve_result():
+    from music21 import converter
+    b_maj_scale = converter.parse('./data/scales/bmaj.mxl')
+    note_stream = notestream.from_part(b_maj_scale.parts[0])
+    for engine in ['chunk', 'viterbi']:
+        result = solve(note_stream, engine=engine)
+        assert(result.fingers.dtype == np.int8)
+        assert(len(result.fingers) == len(result.note_indices) == len(result.comfort) + 1)
+        assert(result.chunk_bounds[0] == 0 and result.chunk_bounds[-1] == len(result.fingers) - 1)
+        assert(0 < result.normalized_score <= 1)
+    # the viterbi engine maximizes the total comfort of all transitions
+    assert(result.comfort.sum() == result.total_score)
+
+def test_chord_engine():
+    # without chords, the chord engine finds the same total as the viterbi engine
+    from music21 import articulations, chord, converter, corpus
+    for path in glob.glob('./data/*/*.mxl'):
+        part = converter.parse(path).parts[0]
+        if any(isinstance(n, chord.Chord) for n in part.flat.notes):
+            continue
+        chord_result = solve(extract(part, engine='chord'), engine='chord')
+        viterbi_result = solve(extract(part), engine='viterbi')
+        assert(abs(chord_result.total_score - viterbi_result.total_score) < 1e-9)
+
+    # every tone of the left hand of K. 545 gets a finger
+    k545 = corpus.parse('mozart/k545')
+    annotated = finger_both(k545, engine='chord')
+    for n in annotated.parts[1].flat.notes:
+        tones = len(n.notes) if isinstance(n, chord.Chord) else 1
+        assert(len([a for a in n.articulations if isinstance(a, articulations.Fingering)]) == tones)
+
+    # two leaps of more than an octave cannot be fingered, and leave the part as it is
+    from music21 import note, stream
+    part = stream.Part([note.Note('C3'), note.Note('D4'), note.Note('E5')])
+    fingered = finger(part, engine='chord')
+    assert(not any(isinstance(a, articulations.Fingering) for n in fingered.flat.notes for a in n.articulations))
+
+def test_solve_k_best():
+    from music21 import converter, corpus
+    for path in glob.glob('./data/*/*.mxl'):
+        note_stream = notestream.from_part(converter.parse(path).parts[0])
+        for engine in ['chunk', 'viterbi']:
+            results = list(itertools.islice(solve_k_best(note_stream, engine=engine), 20))
+            assert(abs(results[0].total_score - solve(note_stream, engine=engine).total_score) < 1e-9)
+            scores = [result.total_score for result in results]
+            # up to rounding, since fingerings that tie may add up in a different order
+            assert(np.all(np.diff(scores) < 1e-9))
+            assert(len(set(tuple(result.fingers) for result in results)) == len(results))
+
+    # only the requested fingerings are found, even for long parts
+    k545 = corpus.parse('mozart/k545')
+    alternatives = finger(k545.parts[0], k=5)
+    assert(len(alternatives) == 5)
+
+def test_finger_both_parallel():
+    from music21 import corpus
+    k545 = corpus.parse('mozart/k545')
+    sequential = finger_both(k545)
+    parallel = finger_both(k545, parallel=True)
+    for sequential_part, parallel_part in zip(sequential.parts, parallel.parts):
+        assert([a.fingerNumber for n in sequential_part.flat.notes for a in n.articulations] == \
+            [a.fingerNumber for n in parallel_part.flat.notes for a in n.articulations])
+
+    # a score without parts has nothing to finger
+    from music21 import stream
+    assert(len(finger_both(stream.Score(), parallel=True).parts) == 0)
+
+def test_stats():
+    from music21 import corpus
+    k545 = corpus.parse('mozart/k545')
+    stats = instrument.Stats()
+    finger_both(k545, stats=stats)
+    note_streams = notestream.from_score(k545)
+    chunks = [split(note_stream) for note_stream in note_streams]
+    assert(stats.counts['chunks'] == sum(len(c) for c in chunks))
+    assert(sum(stats.chunk_lengths.values()) == stats.counts['chunks'])
+    assert(all(stats.seconds[name] > 0 for name in ['extract', 'split', 'compute_best_score', 'finger_chunks', 'annotate']))
+
+    # measurements from other processes are sent back
+    parallel_stats = instrument.Stats()
+    finger_both(k545, parallel=True, stats=parallel_stats)
+    assert(parallel_stats.counts == stats.counts)
+    assert(parallel_stats.chunk_lengths == stats.chunk_lengths)
+
+    # lookups in a chunk cache are counted
+    import chunkcache
+    cache = chunkcache.ChunkCache()
+    cached_stats = instrument.Stats()
+    finger_both(k545, cache=cache, stats=cached_stats)
+    assert(cached_stats.counts['chunk_cache_hits'] == cache.hits and cached_stats.counts['chunk_cache_misses'] == cache.misses)
+    assert(cache.hits + cache.misses == stats.counts['chunks'] and 'chunk_cache_hits' not in stats.counts)
+
+    k_best_stats = instrument.Stats()
+    finger(k545.parts[0], k=3, stats=k_best_stats)
+    assert(k_best_stats.peaks['partial_fingerings'] > 0)
+
+def test_core_imports_without_music21():
+    import subprocess
+    import sys
+    code = ('import sys, chords, chunkcache, finger, incremental, instrument, streaming\n'
+        'finger.solve(finger.notestream.from_pitches([60, 62, 64, 62, 60]))\n'
+        'assert "music21" not in sys.modules')
+    subprocess.run([sys.executable, '-c', code], check=True)
+
 def test_k545():
+    from music21 import corpus
     k545 = corpus.parse('mozart/k545')
     result = finger_both(k545)
     result.show()
 
 def test_k545_with_split():
+    from music21 import corpus
     k545 = corpus.parse('mozart/k545')
     result = finger_both(k545,rest_flag=1.0)
     result.show()
@@ -222,5 +783,20 @@ def test_k545_with_split():
 # test_c_maj_arpeggio()
 # test_c_maj_arpeggio()
 # test_bwv108_soprano()
+# test_split_mary()
+# test_split_with_rests()
+# test_best_fingerings_match_bfs()
+# test_viterbi_beats_chunks()
+# test_compute_best_score_parallel()
+# test_compute_best_score_long_part()
+# test_finger_both_annotates_both_hands()
+# test_solve_result()
+# test_solve_k_best()
+# test_chord_engine()
+# test_finger_both_parallel()
+# test_stats()
+# test_core_imports_without_music21()
+# test_c_maj_scale_viterbi()
+# test_k545_viterbi()
 # test_k545()
 # test_k545_with_split()
@@ -0,0 +1,282 @@
+'''
+Refits the comfort table in constants.py from scores that already have fingerings.
+
+    python fitcomfort.py fingered/ corpus/*.mxl --output comfort_fit.py --jobs 8
+
+Each input can be anything batch.py accepts, except MIDI files, which have no fingering
+marks. Every score is parsed in a pool of worker processes, and its fingering marks
+(articulations.Fingering, as written by annotate_score) are read from its first two parts as
+the right and left hand. For each pair of consecutive notes that both have a finger, the
+worker counts the (distance, color 1, color 2, finger 1, finger 2) combination in the layout
+of constants.COMFORT_RH, mirroring left hand pairs as COMFORT_LH does. Only the counts are
+sent back, so memory stays constant no matter how many scores there are, and only a few scores
+are handed to the pool at a time.
+
+The counts are turned into scores from 1 to 10 by fit_table, and written as a Python module
+with a COMFORT dictionary in the same structure as constants.COMFORT. Rests are skipped over,
+as in the solvers, and chords count their top note in the right hand and their bottom note in
+the left hand.
+'''
+import argparse
+import concurrent.futures
+import os
+import runpy
+import sys
+
+import batch
+import constants
+import midifile
+import notestream
+import numpy as np
+
+SHAPE = constants.COMFORT_RH.shape
+
+def get_fingers(part, rh=True):
+    '''
+    Returns an int8 array with the finger marked on each note or rest of part, in the order of
+    notestream.from_part, or 0 if there is none. For chords, the mark of the top note is used
+    if rh is True, and of the bottom note otherwise.
+    '''
+    from music21 import articulations, chord, note
+    elements = part.flat.notesAndRests
+    fingers = np.zeros(len(elements), dtype=np.int8)
+    for i, element in enumerate(elements):
+        if isinstance(element, note.Rest):
+            continue
+        marks = [a for a in element.articulations if isinstance(a, articulations.Fingering)]
+        if isinstance(element, chord.Chord):
+            index = -1 if rh else 0
+            chosen = element.notes[index]
+            chosen_marks = [a for a in chosen.articulations if isinstance(a, articulations.Fingering)]
+            # the marks of a chord belong to its notes in order, bottom to top
+            if chosen_marks:
+                marks = chosen_marks
+            elif len(marks) == len(element.notes):
+                marks = [marks[index]]
+            else:
+                marks = []
+        if marks:
+            fingers[i] = read_finger(marks[0].fingerNumber)
+    return fingers
+
+def read_finger(finger_number):
+    '''
+    Returns a finger from 1 to 5 for the number of a fingering mark, or 0 if it is not one.
+    Substitutions such as '3-1' count as the first finger.
+    '''
+    try:
+        finger = int(str(finger_number).strip().split('-')[0])
+    except ValueError:
+        return 0
+    return finger if 1 <= finger <= 5 else 0
+
+def count_transitions(note_stream, fingers, rh=True):
+    '''
+    Given a NoteStream and the finger of each of its elements (0 if unknown), returns an
+    int64 array with the shape of constants.COMFORT_RH counting each fingered pair of
+    consecutive notes at its index in the table.
+    '''
+    notes = note_stream.note_indices()
+    ps, color, fingers = note_stream.ps[notes], note_stream.color[notes], fingers[notes].astype(int)
+    distance = np.clip(np.diff(ps), -13, 13).astype(int) # CLAMP DOWN TO 13
+    ascending = distance >= 0
+    lower_color = np.where(ascending, color[:-1], color[1:])
+    higher_color = np.where(ascending, color[1:], color[:-1])
+    lower_finger = np.where(ascending, fingers[:-1], fingers[1:])
+    higher_finger = np.where(ascending, fingers[1:], fingers[:-1])
+    if not rh:
+        # COMFORT_LH is COMFORT_RH with the colors and fingers of the two notes swapped
+        lower_color, higher_color = higher_color, lower_color
+        lower_finger, higher_finger = higher_finger, lower_finger
+
+    fingered = (fingers[:-1] > 0) & (fingers[1:] > 0)
+    indices = np.ravel_multi_index((np.abs(distance)[fingered], lower_color[fingered], higher_color[fingered],
+        lower_finger[fingered] - 1, higher_finger[fingered] - 1), SHAPE)
+    return np.bincount(indices, minlength=np.prod(SHAPE)).reshape(SHAPE)
+
+def count_source(source):
+    '''
+    Parses a score and returns (counts, number of fingered transitions) over its first two
+    parts.
+    '''
+    score = batch.parse(source)
+    counts = np.zeros(SHAPE, dtype=np.int64)
+    for i, part in enumerate(score.parts[:2]):
+        rh = i == 0
+        counts += count_transitions(notestream.from_part(part, rh), get_fingers(part, rh), rh)
+    return (counts, int(counts.sum()))
+
+def count_sources(sources, jobs=None, in_flight=None):
+    '''
+    Returns (counts, number of scores with fingerings, number that failed) summed over every
+    source, counted in a pool of jobs worker processes (by default, one per core). At most
+    in_flight scores (by default, twice the number of workers) are handed to the pool at once.
+    '''
+    jobs = jobs or os.cpu_count() or 1
+    in_flight = in_flight or 2 * jobs
+    counts = np.zeros(SHAPE, dtype=np.int64)
+    fingered = 0
+    failures = 0
+    sources = iter(sources)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = dict()
+        while True:
+            for source in sources:
+                pending[executor.submit(count_source, source)] = source
+                if len(pending) >= in_flight:
+                    break
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                source = pending.pop(future)
+                try:
+                    source_counts, transitions = future.result()
+                except Exception as e:
+                    failures += 1
+                    print('%s: failed: %s' % (source, e), file=sys.stderr)
+                    continue
+                counts += source_counts
+                if transitions > 0:
+                    fingered += 1
+                print('%s: %d fingered transitions' % (source, transitions))
+    return (counts, fingered, failures)
+
+def fit_table(counts, prior=constants.COMFORT_RH, prior_weight=1.0, min_count=1):
+    '''
+    Turns counts from count_transitions into a table of scores in the layout of
+    constants.COMFORT_RH.
+
+    For each distance and pair of colors, the counts of its finger pairs are smoothed by adding
+    prior_weight pseudo-counts, shared among the pairs allowed by prior in proportion to their
+    scores. So pairs that were never seen keep a low score rather than becoming forbidden, and
+    distances that were never seen keep the shape of prior. Pairs that prior forbids need at
+    least min_count observations to be allowed. Each remaining pair scores from 1 to 10 in
+    proportion to how often it is used, rounded to a whole number, with the most used pair
+    scoring 10. Everything else is constants.FORBIDDEN.
+    '''
+    allowed = prior != constants.FORBIDDEN
+    prior_scores = np.where(allowed, prior, 0)
+    totals = prior_scores.sum(axis=(3, 4), keepdims=True)
+    pseudo_counts = prior_weight * np.divide(prior_scores, totals, out=np.zeros(SHAPE), where=totals > 0)
+
+    smoothed = np.where(allowed | (counts >= min_count), counts, 0) + pseudo_counts
+    most = smoothed.max(axis=(3, 4), keepdims=True)
+    scores = np.rint(1 + 9 * np.divide(smoothed, most, out=np.zeros(SHAPE), where=most > 0))
+    return np.where(smoothed > 0, scores, constants.FORBIDDEN)
+
+def to_comfort(table):
+    '''
+    Converts a table in the layout of constants.COMFORT_RH back into a dictionary in the
+    format of constants.COMFORT. Distances and colors without any allowed pair are left out.
+    '''
+    comfort = dict()
+    for distance, color_1, color_2 in np.ndindex(SHAPE[:3]):
+        pairs = table[distance, color_1, color_2]
+        allowed = np.argwhere(pairs != constants.FORBIDDEN)
+        if len(allowed) > 0:
+            comfort[(distance, constants.COLORS[color_1], constants.COLORS[color_2])] = {
+                (int(f1) + 1, int(f2) + 1): int(pairs[f1, f2]) for f1, f2 in allowed}
+    return comfort
+
+def write_comfort(comfort, path, description=''):
+    '''
+    Writes a dictionary in the format of constants.COMFORT to path as a Python module that
+    defines COMFORT, laid out like constants.py.
+    '''
+    lines = ["'''", 'Comfort scores refit by fitcomfort.py. ' + description, "'''", 'COMFORT = {']
+    for key, finger_pairs in comfort.items():
+        lines.append('\t%r: {' % (key,))
+        lines.extend('\t\t%r: %d,' % (pair, score) for pair, score in sorted(finger_pairs.items()))
+        lines.append('\t},')
+    lines.append('}')
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def read_comfort(path):
+    '''
+    Returns the COMFORT dictionary of a module written by write_comfort.
+    '''
+    return runpy.run_path(path)['COMFORT']
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Refit the comfort table from fingered scores.')
+    parser.add_argument('inputs', nargs='+',
+        help='MusicXML or MXL files, directories, glob patterns or music21 corpus paths')
+    parser.add_argument('-o', '--output', default='comfort_fit.py', help='Python module to write COMFORT to')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: one per core)')
+    parser.add_argument('--prior-weight', type=float, default=1.0,
+        help='pseudo-counts from the current table for each distance and pair of colors (default: 1)')
+    parser.add_argument('--min-count', type=int, default=1,
+        help='observations needed to allow a pair the current table forbids (default: 1)')
+    parser.add_argument('--save-counts', default=None, help='also save the raw counts to this .npy file')
+    args = parser.parse_args(argv)
+
+    sources = [s for s in batch.find_sources(args.inputs) if not s.lower().endswith(midifile.EXTENSIONS)]
+    counts, fingered, failures = count_sources(sources, args.jobs)
+    if args.save_counts is not None:
+        np.save(args.save_counts, counts)
+    description = '%d fingered transitions from %d of %d scores.' % (counts.sum(), fingered, len(sources))
+    write_comfort(to_comfort(fit_table(counts, prior_weight=args.prior_weight, min_count=args.min_count)),
+        args.output, description)
+    print(description)
+    return 1 if failures else 0
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_count_transitions():
+    # C D E, with a rest between D and E
+    note_stream = notestream.from_pitches([60, 62, 0, 64])
+    note_stream.is_rest[2] = True
+    right = count_transitions(note_stream, np.array([1, 2, 0, 3]), True)
+    assert(right.sum() == 2 and right[2, 0, 0, 0, 1] == 1 and right[2, 0, 0, 1, 2] == 1)
+    # the left hand plays C D E with 3 2 1, the mirror of the right hand
+    left = count_transitions(note_stream, np.array([3, 2, 0, 1]), False)
+    assert(left[2, 0, 0, 0, 1] == 1 and left[2, 0, 0, 1, 2] == 1)
+    # unknown fingers are not counted
+    assert(count_transitions(note_stream, np.array([1, 0, 0, 3]), True).sum() == 0)
+
+def test_fit_table():
+    import tempfile
+    # with no prior, every counted pair is allowed and the most common pair scores 10
+    counts = np.zeros(SHAPE, dtype=np.int64)
+    counts[2, 0, 0, 0, 1] = 8
+    counts[2, 0, 0, 0, 2] = 4
+    table = fit_table(counts, prior_weight=0)
+    assert(table[2, 0, 0, 0, 1] == 10 and table[2, 0, 0, 0, 2] == 6)
+    assert(np.count_nonzero(table != constants.FORBIDDEN) == 2)
+
+    # with no counts, the prior keeps its allowed pairs and their order
+    table = fit_table(np.zeros(SHAPE, dtype=np.int64))
+    assert(np.array_equal(table == constants.FORBIDDEN, constants.COMFORT_RH == constants.FORBIDDEN))
+
+    path = os.path.join(tempfile.mkdtemp(), 'comfort_fit.py')
+    write_comfort(to_comfort(table), path)
+    assert(np.array_equal(constants.compile_comfort(read_comfort(path)), table))
+
+def test_refit_annotated():
+    import finger
+    from music21 import converter
+    score = converter.parse('./data/scales/cmaj.mxl')
+    fingered = finger.finger_both(score)
+    counts = np.zeros(SHAPE, dtype=np.int64)
+    for i, part in enumerate(fingered.parts[:2]):
+        rh = i == 0
+        fingers = get_fingers(part, rh)
+        note_stream = notestream.from_part(part, rh)
+        assert(np.array_equal(fingers[note_stream.note_indices()], finger.solve(note_stream, rh).fingers))
+        counts += count_transitions(note_stream, fingers, rh)
+    # every fingering the solver chose is allowed in the refit table
+    table = fit_table(counts)
+    assert(np.all(table[counts > 0] != constants.FORBIDDEN))
+
+# test_count_transitions()
+# test_fit_table()
+# test_refit_annotated()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,210 @@
+import constants
+import finger
+import notestream
+import numpy as np
+
+class IncrementalFingering:
+    '''
+    Keeps the chunk engine's solution for a single-hand list of pitches, and updates it when
+    notes are edited instead of fingering the whole part again.
+
+    For each chunk it stores its TransitionScores and its row of the stitching table from
+    finger.compute_best_score. The table is kept normalized, so that each row has a best score
+    of 0 and increments[i] holds the amount that was subtracted. This way, a row that only
+    changed by a constant is equal to the old one.
+
+    On an edit, only the chunks around the edited notes are split and fingered again. The
+    stitching table is then recomputed from the first changed chunk until a row and its
+    backpointers match the old ones, since every row after that is unchanged. Finally the
+    fingering is rebuilt backwards until it joins the previous fingering. The cost of an edit
+    depends on how far its effect reaches, not on the length of the part.
+
+    Rests are not represented, so chunks are never split on rests.
+    '''
+    def __init__(self, pitches, rh=True):
+        self.rh = rh
+        self.ps = np.asarray(pitches, dtype=float)
+        self.solve_all()
+
+    def solve_all(self):
+        '''
+        Splits and fingers the whole part from scratch.
+        '''
+        chunks = finger.split(notestream.from_pitches(self.ps)) if len(self.ps) > 0 else []
+        self.bounds = np.array([chunk[0] for chunk in chunks] + [max(len(self.ps) - 1, 0)], dtype=int)
+        self.scores = [self.make_scores(chunk) for chunk in chunks]
+        self.directions = [self.get_direction(chunk) for chunk in chunks]
+        self.forward = [None] * len(chunks)
+        self.pointers = [None] * len(chunks)
+        self.increments = [0.0] * len(chunks)
+        self.choices = [None] * len(chunks)
+        self.fingerings = [None] * len(chunks)
+        end = self.update_forward(0, len(chunks))
+        self.update_choices(0, end)
+
+    def make_scores(self, chunk):
+        return finger.TransitionScores(notestream.from_pitches(self.ps[chunk]), self.rh)
+
+    def get_direction(self, chunk):
+        # chunks of repeated notes count as ascending, as in split
+        return 1 if self.ps[chunk[-1]] >= self.ps[chunk[0]] else -1
+
+    def replace(self, start, stop, pitches):
+        '''
+        Replaces the notes from start up to (but not including) stop with pitches. This can
+        change, insert or delete notes.
+        Returns (first, last), the range of notes whose fingers may have changed.
+        '''
+        pitches = np.asarray(pitches, dtype=float)
+        old_length = len(self.ps)
+        delta = len(pitches) - (stop - start)
+        self.ps = np.concatenate([self.ps[:start], pitches, self.ps[stop:]])
+        if old_length < 3 or len(self.ps) < 3:
+            self.solve_all()
+            return (0, len(self.ps) - 1)
+
+        starts = self.bounds[:-1]
+        # the chunk holding the last transition before the edit keeps its start, since the
+        # direction there only depends on notes before the edit
+        k0 = 0 if start < 2 else int(np.searchsorted(starts, start - 2, side='right')) - 1
+        lo = int(starts[k0])
+
+        # split again from lo until the new chunks end on an old chunk boundary with the
+        # same direction as before. After that, the old chunks are still correct.
+        k1 = int(np.searchsorted(starts, min(stop, old_length - 2), side='right')) - 1
+        while True:
+            hi = int(self.bounds[k1 + 1]) + delta
+            window = [chunk + lo for chunk in finger.split(notestream.from_pitches(self.ps[lo:hi + 1]))]
+            if k1 == len(starts) - 1 or self.get_direction(window[-1]) == self.directions[k1]:
+                break
+            k1 += 1
+
+        new_bounds = [chunk[0] for chunk in window] + [hi]
+        self.bounds = np.concatenate([self.bounds[:k0], new_bounds, self.bounds[k1 + 2:] + delta])
+        self.scores[k0:k1 + 1] = [self.make_scores(chunk) for chunk in window]
+        self.directions[k0:k1 + 1] = [self.get_direction(chunk) for chunk in window]
+        for table in [self.forward, self.pointers, self.increments, self.choices, self.fingerings]:
+            table[k0:k1 + 1] = [None] * len(window)
+
+        end = self.update_forward(k0, k0 + len(window))
+        first = self.update_choices(k0, end)
+        return (int(self.bounds[first]), int(self.bounds[end]))
+
+    def update_forward(self, begin, must_end):
+        '''
+        Recomputes rows of the stitching table from chunk begin. Rows before must_end are
+        always recomputed, and after that it stops at the first row that did not change.
+        Returns the index of the first chunk that was not recomputed.
+        '''
+        prev = np.zeros(5) if begin == 0 else self.forward[begin - 1]
+        i = begin
+        while i < len(self.scores):
+            scores = prev[:, np.newaxis] + self.scores[i].get_score_matrix()
+            best = scores.max(axis=0)
+            pointers = scores.argmax(axis=0)
+            increment = best.max()
+            if increment != constants.FORBIDDEN:
+                best = best - increment
+            if i >= must_end and np.array_equal(best, self.forward[i]) and np.array_equal(pointers, self.pointers[i]):
+                # the rows after this one are unchanged, but the total up to here may not be
+                self.increments[i] = increment
+                break
+            self.forward[i] = best
+            self.pointers[i] = pointers
+            self.increments[i] = increment
+            prev = best
+            i += 1
+        return i
+
+    def update_choices(self, begin, end):
+        '''
+        Rebuilds the fingering backwards from chunk end - 1, where chunks from end on are
+        unchanged. Below begin, it stops once it reaches the finger the old fingering used.
+        Returns the index of the first chunk whose fingering was rebuilt.
+        '''
+        if len(self.scores) == 0:
+            return 0
+        if end == len(self.scores):
+            e = int(np.argmax(self.forward[-1]))
+        else:
+            e = self.choices[end][0]
+        i = end - 1
+        while i >= 0:
+            if i < begin and self.choices[i][1] == e:
+                break
+            s = int(self.pointers[i][e])
+            self.choices[i] = (s, e)
+            self.fingerings[i] = self.scores[i].get_fingering_option(s + 1, e + 1)[0]
+            e = s
+            i -= 1
+        return i + 1
+
+    def get_fingering(self):
+        '''
+        Returns the current fingering, with one finger for each note, or [] if there is no
+        valid fingering.
+        '''
+        if len(self.scores) == 0 or constants.FORBIDDEN in self.increments:
+            return []
+        # adjacent chunks share a note
+        return self.fingerings[0] + [f for fingering in self.fingerings[1:] for f in fingering[1:]]
+
+    def get_score(self):
+        '''
+        Returns the total score of the current fingering, as in finger.compute_best_score.
+        '''
+        if len(self.scores) == 0 or constants.FORBIDDEN in self.increments:
+            return 0
+        return float(sum(self.increments))
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_matches_compute_best_score():
+    import glob
+    from music21 import converter
+    for path in glob.glob('./data/*/*.mxl'):
+        for note_stream, rh in zip(notestream.from_score(converter.parse(path)), [True, False]):
+            notes = note_stream.without_rests()
+            fingering, score = finger.compute_best_score([notes[chunk] for chunk in finger.split(notes)], rh)
+            incremental = IncrementalFingering(notes.ps, rh)
+            assert(incremental.get_fingering() == fingering)
+            assert(abs(incremental.get_score() - score) < 1e-9)
+
+def test_random_edits():
+    import random
+    import time
+    random.seed(0)
+    pitches = [60]
+    for i in range(5000):
+        pitches.append(min(max(pitches[-1] + random.choice([-4, -2, -1, 0, 1, 2, 4]), 40), 84))
+    start = time.time()
+    incremental = IncrementalFingering(pitches)
+    print('full solve: %.3f seconds' % (time.time() - start))
+
+    elapsed = 0
+    for trial in range(100):
+        i = random.randrange(len(pitches) - 3)
+        size = random.randint(0, 3)
+        new_pitches = [random.randint(50, 70) for _ in range(random.randint(0, 3))]
+        pitches[i:i + size] = new_pitches
+        start = time.time()
+        incremental.replace(i, i + size, new_pitches)
+        elapsed += time.time() - start
+        expected = IncrementalFingering(pitches)
+        assert(incremental.get_fingering() == expected.get_fingering())
+        assert(list(incremental.bounds) == list(expected.bounds))
+        assert(abs(incremental.get_score() - expected.get_score()) < 1e-6)
+    print('edit: %.2f milliseconds' % (elapsed / 100 * 1000))
+
+    # an edit whose first unchanged row still changes the total
+    incremental = IncrementalFingering([66, 65, 65, 65, 68, 56], False)
+    incremental.replace(3, 3, [69])
+    expected = IncrementalFingering([66, 65, 65, 69, 65, 68, 56], False)
+    assert(abs(incremental.get_score() - expected.get_score()) < 1e-6)
+
+# test_matches_compute_best_score()
+# test_random_edits()
@@ -0,0 +1,130 @@
+import collections
+import contextlib
+import time
+
+class Stats:
+    '''
+    Collects measurements of the fingering pipeline. Pass one as stats= to finger.finger,
+    finger.finger_both or finger.solve. Functions given stats=None measure nothing, so the
+    pipeline only pays for instrumentation when it is asked for.
+
+    seconds: wall time spent in each stage, added up over every call. Stages can be nested,
+        so compute_best_score includes finger_chunks.
+    counts: counters such as chunks, notes, chunk_cache_hits and chunk_cache_misses
+    peaks: the largest value seen for measurements such as partial_fingerings
+    chunk_lengths: histogram of chunk lengths in notes, mapping each length to its count
+
+    If on_stage is given, on_stage(name, seconds) is called as each stage ends, so a slow
+    stage can be reported while the pipeline is still running.
+    '''
+    def __init__(self, on_stage=None):
+        self.on_stage = on_stage
+        self.seconds = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.peaks = dict()
+        self.chunk_lengths = collections.Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Adds the time spent in a with block to the stage name.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] += elapsed
+            if self.on_stage is not None:
+                self.on_stage(name, elapsed)
+
+    def count(self, name, amount=1):
+        self.counts[name] += amount
+
+    def peak(self, name, value):
+        if value > self.peaks.get(name, value - 1):
+            self.peaks[name] = value
+
+    def add_chunks(self, lengths):
+        '''
+        Records the length of every chunk in a part.
+        '''
+        self.counts['chunks'] += len(lengths)
+        self.chunk_lengths.update(int(length) for length in lengths)
+
+    def merge(self, other):
+        '''
+        Adds the measurements of other, such as Stats collected in another process.
+        '''
+        for name, seconds in other.seconds.items():
+            self.seconds[name] += seconds
+        self.counts.update(other.counts)
+        for name, value in other.peaks.items():
+            self.peak(name, value)
+        self.chunk_lengths.update(other.chunk_lengths)
+
+    def as_dict(self):
+        '''
+        Returns every measurement as a flat dictionary of numbers, with names such as
+        'seconds.split', 'chunk_cache_hits', 'peak.partial_fingerings' and 'chunk_length.4'.
+        '''
+        metrics = dict()
+        metrics.update(('seconds.%s' % name, seconds) for name, seconds in self.seconds.items())
+        metrics.update(self.counts)
+        metrics.update(('peak.%s' % name, value) for name, value in self.peaks.items())
+        metrics.update(('chunk_length.%d' % length, count) for length, count in sorted(self.chunk_lengths.items()))
+        return metrics
+
+    def export(self, sink, prefix='fingering.'):
+        '''
+        Sends every measurement to a metrics sink by calling sink(name, value) for each entry
+        of as_dict, with prefix added to its name. For example, sink can be the gauge method of
+        a StatsD client.
+        '''
+        for name, value in self.as_dict().items():
+            sink(prefix + name, value)
+
+def stage(stats, name):
+    '''
+    Returns stats.stage(name), or a context manager that does nothing if stats is None.
+    '''
+    if stats is None:
+        return contextlib.nullcontext()
+    return stats.stage(name)
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_stats():
+    ended = []
+    stats = Stats(on_stage=lambda name, seconds: ended.append(name))
+    with stats.stage('split'):
+        with stage(stats, 'inner'):
+            pass
+    with stage(None, 'ignored'):
+        pass
+    stats.count('chunk_cache_hits', 3)
+    stats.peak('partial_fingerings', 10)
+    stats.peak('partial_fingerings', 4)
+    stats.add_chunks([3, 3, 5])
+    assert(ended == ['inner', 'split'])
+    assert(stats.seconds['split'] >= stats.seconds['inner'])
+
+    other = Stats()
+    other.count('chunk_cache_hits')
+    other.peak('partial_fingerings', 12)
+    other.add_chunks([3])
+    stats.merge(other)
+    metrics = stats.as_dict()
+    assert(metrics['chunk_cache_hits'] == 4 and metrics['chunks'] == 4)
+    assert(metrics['peak.partial_fingerings'] == 12)
+    assert(metrics['chunk_length.3'] == 3 and metrics['chunk_length.5'] == 1)
+
+    exported = dict()
+    stats.export(exported.__setitem__)
+    assert(exported['fingering.seconds.split'] == metrics['seconds.split'])
+
+# test_stats()
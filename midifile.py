@@ -0,0 +1,312 @@
+'''
+Reads Standard MIDI Files straight into the arrays that the solvers use, without music21.
+
+    right, left = midifile.load('piece.mid')
+    result = finger.solve(right)
+
+Note-on and note-off events are paired as they are read, giving one entry per note in a
+MidiNotes. Notes whose onsets are within tolerance ticks of each other are grouped into
+chords, and each hand is then turned into a NoteStream (with load) or a ChordStream (with
+load_chords).
+'''
+import chords
+import notestream
+import numpy as np
+import struct
+
+EXTENSIONS = ('.mid', '.midi')
+HAND_RULES = ['auto', 'track', 'channel', 'pitch']
+
+class MidiNotes:
+    '''
+    The notes of a MIDI file, as NumPy arrays with one entry per note, sorted by onset and
+    then by pitch:
+        onset: start of the note in ticks
+        end: end of the note in ticks
+        pitch: MIDI note number
+        velocity: note-on velocity
+        channel: MIDI channel, from 0 to 15
+        track: position of the track in the file
+    ticks_per_quarter converts ticks to quarter notes.
+    '''
+    def __init__(self, onset, end, pitch, velocity, channel, track, ticks_per_quarter):
+        self.onset = onset
+        self.end = end
+        self.pitch = pitch
+        self.velocity = velocity
+        self.channel = channel
+        self.track = track
+        self.ticks_per_quarter = ticks_per_quarter
+
+    def __len__(self):
+        return len(self.onset)
+
+def read(path):
+    '''
+    Returns the MidiNotes of the MIDI file at path.
+    '''
+    with open(path, 'rb') as f:
+        return parse(f.read())
+
+def parse(data):
+    '''
+    Returns the MidiNotes of the bytes of a MIDI file. Raises ValueError if data is not a
+    MIDI file, or uses SMPTE time, which has no quarter notes.
+    '''
+    if data[:4] != b'MThd':
+        raise ValueError('not a MIDI file')
+    length = int.from_bytes(data[4:8], 'big')
+    file_format, track_count, division = struct.unpack('>HHH', data[8:14])
+    if division & 0x8000:
+        raise ValueError('MIDI files with SMPTE time are not supported')
+
+    notes = [[] for _ in range(6)]
+    position = 8 + length
+    track = 0
+    while track < track_count and position + 8 <= len(data):
+        chunk_type = data[position:position + 4]
+        length = int.from_bytes(data[position + 4:position + 8], 'big')
+        start = position + 8
+        position = start + length
+        # other chunk types are allowed, and must be skipped
+        if chunk_type == b'MTrk':
+            read_track(data, start, min(position, len(data)), track, notes)
+            track += 1
+
+    onset, end, pitch, velocity, channel, tracks = [np.array(values, dtype=int) for values in notes]
+    order = np.lexsort((pitch, onset))
+    return MidiNotes(onset[order], end[order], pitch[order], velocity[order], channel[order], tracks[order], division)
+
+def read_track(data, position, stop, track, notes):
+    '''
+    Reads the events of one track from data[position:stop], and appends the onset, end,
+    pitch, velocity, channel and track of each note to the lists in notes. A note-on is
+    ended by the next note-off (or note-on with velocity 0) of the same pitch and channel,
+    and notes still sounding at the end of the track end there.
+    '''
+    tick = 0
+    status = None
+    sounding = dict()   # maps (channel, pitch) to the (onset, velocity) of each note-on, oldest first
+    while position < stop:
+        delta, position = read_variable_length(data, position)
+        tick += delta
+        byte = data[position]
+        if byte == 0xFF:
+            meta_type = data[position + 1]
+            length, position = read_variable_length(data, position + 2)
+            position += length
+            status = None
+            if meta_type == 0x2F: # end of track
+                break
+            continue
+        if byte in (0xF0, 0xF7):
+            length, position = read_variable_length(data, position + 1)
+            position += length
+            status = None
+            continue
+
+        if byte & 0x80:
+            status = byte
+            position += 1
+        elif status is None:
+            raise ValueError('MIDI data byte without a status byte')
+        kind, channel = status & 0xF0, status & 0x0F
+        if kind in (0xC0, 0xD0):
+            position += 1
+            continue
+        key, value = data[position], data[position + 1]
+        position += 2
+
+        if kind == 0x90 and value > 0:
+            sounding.setdefault((channel, key), []).append((tick, value))
+        elif kind == 0x80 or kind == 0x90:
+            started = sounding.get((channel, key))
+            if started:
+                add_note(notes, started.pop(0), tick, key, channel, track)
+
+    for (channel, key), started in sounding.items():
+        for note_on in started:
+            add_note(notes, note_on, tick, key, channel, track)
+
+def add_note(notes, note_on, end, pitch, channel, track):
+    onset, velocity = note_on
+    for values, value in zip(notes, [onset, end, pitch, velocity, channel, track]):
+        values.append(value)
+
+def read_variable_length(data, position):
+    '''
+    Returns (value, position after it) for the variable-length quantity at position.
+    '''
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return (value, position)
+
+def get_hands(midi_notes, rule='auto', split_point=60):
+    '''
+    Returns (right, left), boolean arrays that select the notes of each hand.
+
+    rule is one of:
+        'track': the first track with notes is the right hand and the second the left hand,
+            as with the parts of a score. Notes in other tracks are left out.
+        'channel': the same, with the first two channels that have notes
+        'pitch': notes from split_point up are the right hand and the rest the left hand
+        'auto': 'track' if two tracks have notes, else 'channel' if two channels do, else
+            'pitch'. This suits both piano files with a track per hand and single-track files.
+    '''
+    if rule not in HAND_RULES:
+        raise ValueError('rule must be one of %s, not %r' % (', '.join(HAND_RULES), rule))
+    if rule == 'auto':
+        if len(np.unique(midi_notes.track)) >= 2:
+            rule = 'track'
+        elif len(np.unique(midi_notes.channel)) >= 2:
+            rule = 'channel'
+        else:
+            rule = 'pitch'
+
+    if rule == 'pitch':
+        right = midi_notes.pitch >= split_point
+        return (right, ~right)
+    values = midi_notes.track if rule == 'track' else midi_notes.channel
+    used = np.unique(values)
+    right = values == used[0] if len(used) > 0 else np.zeros(len(values), dtype=bool)
+    left = values == used[1] if len(used) > 1 else np.zeros(len(values), dtype=bool)
+    return (right, left)
+
+def group_onsets(onset, tolerance=0):
+    '''
+    Given sorted onsets, returns the position where each group of notes that are played
+    together starts. A note joins the group of the previous note if it starts within
+    tolerance ticks of it.
+    '''
+    if len(onset) == 0:
+        return np.zeros(0, dtype=int)
+    return np.flatnonzero(np.concatenate([[True], np.diff(onset) > tolerance]))
+
+def to_note_stream(midi_notes, selected, rh=True, tolerance=0):
+    '''
+    Returns a NoteStream of the notes in selected, a boolean array. Each group of notes played
+    together becomes a single note, the top note if rh is True and the bottom note otherwise,
+    as notestream.from_part does with chords. Silences between groups become rests.
+    '''
+    indices = np.flatnonzero(selected)
+    starts = group_onsets(midi_notes.onset[indices], tolerance)
+    if len(starts) == 0:
+        return notestream.from_pitches([])
+    lengths = np.diff(np.append(starts, len(indices)))
+
+    # order each group by pitch and take its last or first note
+    group = np.repeat(np.arange(len(starts)), lengths)
+    by_pitch = indices[np.lexsort((midi_notes.pitch[indices], group))]
+    chosen = by_pitch[starts + lengths - 1] if rh else by_pitch[starts]
+
+    onset = midi_notes.onset[chosen]
+    end = np.maximum.reduceat(midi_notes.end[indices], starts)
+    # a rest fills any silence after everything played so far has ended
+    latest_end = np.maximum.accumulate(end)[:-1]
+    gap = onset[1:] - latest_end
+    has_rest = np.concatenate([[False], gap > 0])
+    positions = np.arange(len(starts)) + np.cumsum(has_rest)
+    rests = positions[has_rest] - 1
+
+    size = len(starts) + len(rests)
+    ps = np.full(size, np.nan)
+    duration = np.zeros(size)
+    offset = np.zeros(size)
+    is_rest = np.ones(size, dtype=bool)
+    ticks = float(midi_notes.ticks_per_quarter)
+    ps[positions] = midi_notes.pitch[chosen]
+    duration[positions] = (midi_notes.end[chosen] - onset) / ticks
+    offset[positions] = onset / ticks
+    is_rest[positions] = False
+    duration[rests] = gap[has_rest[1:]] / ticks
+    offset[rests] = latest_end[has_rest[1:]] / ticks
+    return notestream.NoteStream(ps, notestream.get_colors(ps, is_rest), duration, offset, is_rest, np.arange(size))
+
+def to_chord_stream(midi_notes, selected, tolerance=0):
+    '''
+    Returns a chords.ChordStream of the notes in selected, a boolean array, with one event for
+    each group of notes played together.
+    '''
+    indices = np.flatnonzero(selected)
+    starts = group_onsets(midi_notes.onset[indices], tolerance)
+    return chords.from_chords([pitches.tolist() for pitches in np.split(midi_notes.pitch[indices], starts[1:])]
+        if len(starts) > 0 else [])
+
+def load(path, rule='auto', split_point=60, tolerance=0):
+    '''
+    Returns the NoteStreams of the right and left hand of the MIDI file at path, like
+    notestream.from_score. See get_hands for rule and split_point and group_onsets for
+    tolerance.
+    '''
+    midi_notes = read(path)
+    right, left = get_hands(midi_notes, rule, split_point)
+    return [to_note_stream(midi_notes, right, True, tolerance), to_note_stream(midi_notes, left, False, tolerance)]
+
+def load_chords(path, rule='auto', split_point=60, tolerance=0):
+    '''
+    Like load, but returns ChordStreams for the chord engine.
+    '''
+    midi_notes = read(path)
+    return [to_chord_stream(midi_notes, selected, tolerance) for selected in get_hands(midi_notes, rule, split_point)]
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def make_track(events):
+    '''
+    Returns an MTrk chunk of (delta ticks, event bytes) pairs, for tests.
+    '''
+    body = b''
+    for delta, event in events + [(0, b'\xff\x2f\x00')]:
+        quantity = [delta & 0x7F]
+        while delta > 0x7F:
+            delta >>= 7
+            quantity.insert(0, (delta & 0x7F) | 0x80)
+        body += bytes(quantity) + event
+    return b'MTrk' + len(body).to_bytes(4, 'big') + body
+
+def test_parse():
+    # C E G together, then a rest, then D with running status, on one track
+    track = make_track([
+        (0, b'\x90\x3c\x40'), (0, b'\x40\x40'), (0, b'\x43\x40'),
+        (480, b'\x80\x3c\x00'), (0, b'\x80\x40\x00'), (0, b'\x80\x43\x00'),
+        (240, b'\x90\x3e\x40'), (480, b'\x3e\x00'),
+    ])
+    data = b'MThd' + struct.pack('>IHHH', 6, 0, 1, 480) + track
+    midi_notes = parse(data)
+    assert(midi_notes.pitch.tolist() == [60, 64, 67, 62])
+    assert(midi_notes.onset.tolist() == [0, 0, 0, 720] and midi_notes.end.tolist() == [480, 480, 480, 1200])
+
+    note_stream = to_note_stream(midi_notes, np.ones(4, dtype=bool))
+    assert(note_stream.ps[~note_stream.is_rest].tolist() == [67, 62])
+    assert(note_stream.is_rest.tolist() == [False, True, False])
+    assert(note_stream.duration.tolist() == [1, 0.5, 1] and note_stream.offset.tolist() == [0, 1, 1.5])
+    chord_stream = to_chord_stream(midi_notes, np.ones(4, dtype=bool))
+    assert(len(chord_stream) == 2 and chord_stream.ps.tolist() == [60, 64, 67, 62])
+
+    # one track, so the hands are split by pitch
+    right, left = get_hands(midi_notes)
+    assert(right.tolist() == [True, True, True, True] and not left.any())
+
+def test_matches_music21():
+    import os
+    import tempfile
+    from music21 import converter
+    directory = tempfile.mkdtemp()
+    for name in ['scales/cmaj', 'scales/bmaj', 'arpeggios/bflatmin']:
+        path = os.path.join(directory, name.replace('/', '_') + '.mid')
+        score = converter.parse('./data/%s.mxl' % name)
+        score.write('midi', fp=path)
+        for from_midi, from_score in zip(load(path), notestream.from_score(score)):
+            assert(np.array_equal(from_midi.ps[~from_midi.is_rest], from_score.ps[~from_score.is_rest]))
+            assert(np.array_equal(from_midi.color[~from_midi.is_rest], from_score.color[~from_score.is_rest]))
+
+# test_parse()
+# test_matches_music21()
@@ -1,8 +1,10 @@
-from music21 import *
 import constants
 import copy
+import heapq
+import notestream
+import numpy as np
 
-def finger_monotonic(notes, rh=True):
+def finger_monotonic(notes, rh=True, stats=None, beam=None):
 	'''
 	Given a monotonic list of Notes (either ascending or descending), produces a list of
 	potential fingerings, with a comfort score for each.
@@ -14,54 +16,261 @@ def finger_monotonic(notes, rh=True):
 	(ints from 1 to 5) with the same length as notes and score is the average comfort
 	of note transitions.
 
-	Future work:
-		- Replace BFS with a more efficient algorithm
-		- Tailor algorithm to take advantage of monotonicity
+	This enumerates every valid fingering, so it grows exponentially with the length of the
+	chunk. Use best_fingerings if only the best fingering per start and end finger is needed.
+	If stats is an instrument.Stats, the peak number of partial fingerings is added to it.
+
+	If beam is a number B, only the B best partial fingerings that end on each finger are
+	kept after each note, so there are never more than 5 * B of them. Returns (fingerings,
+	complete) instead. The best fingering is always kept, since it starts with the best
+	fingering of every note so far that ends on its finger. For the same reason, the beam
+	never drops the last partial fingering that can reach a note, so complete is only False
+	if the chunk cannot be fingered at all. fingerings then holds the fingerings of the
+	longest part of the chunk that can be, which are shorter than notes.
 	'''
 	# initialize with all possible fingers on the first note
 	fingerings = [([1], 0), ([2], 0), ([3], 0), ([4], 0), ([5], 0)]
 	prev_note = notes[0]
-	prev_color = get_color(prev_note)
 
 	for note in notes[1:]:
 		new_fingerings = []
-
-		distance = max(min(note.pitch.ps - prev_note.pitch.ps, 13), -13) # CLAMP DOWN TO 13
-		color = get_color(note)
 		# get valid finger pairs from the comfort score table
-		if rh:
-			if distance >= 0:
-				finger_pairs = constants.COMFORT[(distance, prev_color, color)]
-			else:
-				finger_pairs = constants.COMFORT[(-distance, color, prev_color)]
-		else:
-			if distance >= 0:
-				finger_pairs = constants.COMFORT[(distance, color, prev_color)]
-			else:
-				finger_pairs = constants.COMFORT[(-distance, prev_color, color)]
+		finger_pairs = get_transition_scores(prev_note, note, rh)
 
 		# for each partial fingering, try possible next fingers
 		for fingering, score in fingerings:
 			prev_finger = fingering[-1]
 			for finger in [1, 2, 3, 4, 5]:
-				if (rh and distance >= 0) or (not rh and distance < 0):
-					finger_pair = (prev_finger, finger)
-				else:
-					finger_pair = (finger, prev_finger)
-
 				# if finger transition is valid, add to new fingerings and update score
-				if finger_pair in finger_pairs:
-					comfort_score = finger_pairs[finger_pair]
+				if (prev_finger, finger) in finger_pairs:
+					comfort_score = finger_pairs[(prev_finger, finger)]
 					new_fingerings.append((fingering + [finger], score + comfort_score))
 
+		if beam is not None:
+			if len(new_fingerings) == 0:
+				# keep what could be fingered, rather than returning nothing
+				break
+			new_fingerings = prune(new_fingerings, beam)
 		fingerings = new_fingerings
 		prev_note = note
-		prev_color = color
+		if stats is not None:
+			stats.peak('partial_fingerings', len(fingerings))
 	
 	# calculate average comfort score for each fingering
-	fingerings = [(f[0], f[1] / (len(notes) - 1)) for f in fingerings]
+	fingerings = [(f[0], f[1] / max(len(f[0]) - 1, 1)) for f in fingerings]
+	fingerings = sorted(fingerings, key=lambda f: f[1], reverse=True)
+	if beam is not None:
+		return (fingerings, len(fingerings) > 0 and len(fingerings[0][0]) == len(notes))
+	return fingerings
+
+def prune(fingerings, beam):
+	'''
+	Returns the beam best partial fingerings that end on each finger, in the order they
+	appear in fingerings. Of fingerings with the same score, the first ones are kept.
+	'''
+	kept = set()
+	counts = [0] * 5
+	for i in sorted(range(len(fingerings)), key=lambda i: -fingerings[i][1]):
+		last = fingerings[i][0][-1] - 1
+		if counts[last] < beam:
+			counts[last] += 1
+			kept.add(i)
+	return [fingering for i, fingering in enumerate(fingerings) if i in kept]
+
+def count_partial_fingerings(notes, rh=True):
+	'''
+	Given a monotonic NoteStream or list of Notes, returns the number of partial fingerings
+	that finger_monotonic creates for it, including the five it starts with, without creating
+	any of them. This is exact, so it can be very large for long chunks.
+	'''
+	if not isinstance(notes, notestream.NoteStream):
+		notes = notestream.from_notes(notes)
+	valid = get_transition_matrices(notes, rh) != constants.FORBIDDEN
+	# counts[g] is the number of partial fingerings of the notes so far that end on finger g + 1
+	counts = [1] * 5
+	total = 5
+	for i in range(len(valid)):
+		counts = [sum(counts[f] for f in range(5) if valid[i][f, g]) for g in range(5)]
+		total += sum(counts)
+	return total
+
+def best_fingerings(notes, rh=True):
+	'''
+	Given a monotonic NoteStream or list of Notes (either ascending or descending), finds the
+	best fingering for every pair of start and end fingers using dynamic programming.
+
+	Returns a list of tuples (fingering, score) in the same format as finger_monotonic, but with
+	at most one fingering for each (start finger, end finger) pair. Pairs that cannot be
+	fingered are left out. When several fingerings share the best score, the one that
+	finger_monotonic would list first is chosen, so both functions agree on every pair.
+
+	Runs in O(n) time and memory for n notes, instead of growing every partial fingering.
+	'''
+	transitions, best = get_chunk_tables(notes, rh)
+	# every pair that can be fingered, ordered by end finger and then start finger
+	ends, starts = np.nonzero(best[0].T != constants.FORBIDDEN)
+	traced = trace_fingerings(transitions, best, starts + 1, ends + 1)
+	fingerings = [(fingering, float(best[0][start, end]) / max(len(best) - 1, 1))
+		for fingering, start, end in zip(traced.tolist(), starts, ends)]
+
 	return sorted(fingerings, key=lambda f: f[1], reverse=True)
 
+def get_chunk_tables(notes, rh=True):
+	'''
+	Given a NoteStream or list of Notes, returns (transitions, best) where transitions is
+	from get_transition_matrices and best[i][f, e] is the best total comfort of notes[i:] when
+	notes[i] is played with finger f + 1 and the last note is played with finger e + 1.
+	So best[0] holds the best total for every pair of start and end fingers.
+	'''
+	if not isinstance(notes, notestream.NoteStream):
+		notes = notestream.from_notes(notes)
+	transitions = get_transition_matrices(notes, rh)
+
+	best = np.empty((len(notes), 5, 5))
+	best[-1] = np.where(np.eye(5, dtype=bool), 0.0, constants.FORBIDDEN)
+	for i in range(len(notes) - 2, -1, -1):
+		best[i] = np.max(transitions[i][:, :, np.newaxis] + best[i+1][np.newaxis, :, :], axis=1)
+	return (transitions, best)
+
+def trace_fingering(transitions, best, start_finger, end_finger):
+	'''
+	Given the tables from get_chunk_tables, returns the best fingering from start_finger to
+	end_finger. It walks forward, always taking the lowest finger that keeps the best score,
+	which matches the order in which finger_monotonic generates fingerings.
+	'''
+	return trace_fingerings(transitions, best, [start_finger], [end_finger])[0].tolist()
+
+def trace_fingerings(transitions, best, start_fingers, end_fingers):
+	'''
+	Like trace_fingering, but for every pair of start_fingers[k] and end_fingers[k] at once.
+	Each note is a single step over all pairs. Returns an array of shape (pairs, len(best))
+	with one fingering per row.
+	'''
+	prev = np.asarray(start_fingers, dtype=int) - 1
+	end = np.asarray(end_fingers, dtype=int) - 1
+	fingerings = np.empty((len(prev), len(best)), dtype=int)
+	fingerings[:, 0] = prev
+	for i in range(len(transitions)):
+		# scores[k, f] is the best total of pair k when note i + 1 is played with finger f + 1
+		scores = transitions[i][prev, :] + best[i+1][:, end].T
+		prev = np.argmax(scores == best[i][prev, end][:, np.newaxis], axis=1)
+		fingerings[:, i+1] = prev
+	return fingerings + 1
+
+def k_best_fingerings(notes, rh=True):
+	'''
+	Given a monotonic NoteStream or list of Notes, generates distinct fingerings in order of
+	score, as (fingering, score) tuples in the same format as finger_monotonic. Each fingering
+	is only found when it is asked for, so taking the first k costs time proportional to k
+	rather than to the number of valid fingerings. For example:
+
+		fingerings = list(itertools.islice(k_best_fingerings(notes), 5))
+	'''
+	if not isinstance(notes, notestream.NoteStream):
+		notes = notestream.from_notes(notes)
+	for fingering, total in k_best_paths(get_transition_matrices(notes, rh)):
+		yield (fingering, total / max(len(notes) - 1, 1))
+
+def k_best_paths(weights, stats=None):
+	'''
+	Given an (n - 1, 5, 5) array where weights[i][f, g] is the score of playing note i with
+	finger f + 1 and note i + 1 with finger g + 1, generates every fingering of the n notes
+	that avoids constants.FORBIDDEN, as (fingering, total score) tuples from best to worst.
+
+	This is a best-first search over partial fingerings, where each partial fingering is
+	ranked by its score so far plus the best score of any way to finish it. That best score is
+	computed backwards once, like the table in get_chunk_tables, so it is exact and the search
+	never takes a wrong turn: each fingering is found after about n steps. Partial fingerings
+	are stored as linked lists, so extending one does not copy it. If stats is an
+	instrument.Stats, the peak number of partial fingerings in the search is added to it.
+	'''
+	n = len(weights) + 1
+	remaining = np.zeros((n, 5))
+	for i in range(n - 2, -1, -1):
+		remaining[i] = np.max(weights[i] + remaining[i+1][np.newaxis, :], axis=1)
+
+	# entries are (-estimate, -length, tie breaker, score so far, finger, previous entry)
+	heap = [(-remaining[0][f], -1, f, 0.0, f, None) for f in range(5) if remaining[0][f] != constants.FORBIDDEN]
+	heapq.heapify(heap)
+	count = 5
+	while heap:
+		entry = heapq.heappop(heap)
+		length, score, f = -entry[1], entry[3], entry[4]
+		if length == n:
+			fingering = []
+			while entry is not None:
+				fingering.append(entry[4] + 1)
+				entry = entry[5]
+			yield (fingering[::-1], float(score))
+			continue
+		for g in range(5):
+			weight = weights[length - 1][f, g]
+			if weight != constants.FORBIDDEN and remaining[length][g] != constants.FORBIDDEN:
+				# longer partial fingerings go first on ties, so the search finishes them
+				heapq.heappush(heap, (-(score + weight + remaining[length][g]), -(length + 1), count, score + weight, g, entry))
+				count += 1
+		if stats is not None:
+			stats.peak('partial_fingerings', len(heap))
+
+def get_transition_matrices(notes, rh=True):
+	'''
+	Given a NoteStream without rests, returns an array of shape (len(notes) - 1, 5, 5) where
+	entry [i, prev_finger - 1, finger - 1] is the comfort score of playing note i with prev_finger
+	followed by note i + 1 with finger, or constants.FORBIDDEN if that finger pair is unacceptable.
+
+	If rh is True, uses right hand fingers. Otherwise, uses left hand fingers.
+	'''
+	distance = np.clip(np.diff(notes.ps), -13, 13).astype(int) # CLAMP DOWN TO 13
+	ascending = distance >= 0
+	lower_color = np.where(ascending, notes.color[:-1], notes.color[1:])
+	higher_color = np.where(ascending, notes.color[1:], notes.color[:-1])
+	table = constants.COMFORT_RH if rh else constants.COMFORT_LH
+
+	# the compiled tables are indexed from the lower note, so flip descending pairs
+	matrices = table[np.abs(distance), lower_color, higher_color]
+	matrices[~ascending] = matrices[~ascending].transpose(0, 2, 1)
+	return matrices
+
+def get_transition_matrix(prev_ps, prev_color, ps, color, rh=True):
+	'''
+	Like get_transition_matrices, but for a single pair of notes given by their pitch space
+	values and color indices. Returns a 5x5 array indexed by [prev_finger - 1, finger - 1].
+	'''
+	distance = int(max(min(ps - prev_ps, 13), -13)) # CLAMP DOWN TO 13
+	table = constants.COMFORT_RH if rh else constants.COMFORT_LH
+	if distance >= 0:
+		return table[distance, prev_color, color]
+	return table[-distance, color, prev_color].T
+
+def get_transition_scores(prev_note, note, rh=True):
+	'''
+	Given two consecutive Notes, returns a dictionary mapping (prev_finger, finger) to the
+	comfort score of playing prev_note with prev_finger followed by note with finger.
+
+	If rh is True, uses right hand fingers. Otherwise, uses left hand fingers. Unacceptable
+	finger pairs are not included.
+	'''
+	distance = max(min(note.pitch.ps - prev_note.pitch.ps, 13), -13) # CLAMP DOWN TO 13
+	prev_color = get_color(prev_note)
+	color = get_color(note)
+
+	# the comfort table only has ascending right hand pairs, so flip the order of notes
+	# for descending pairs and the order of colors for the left hand
+	if rh:
+		if distance >= 0:
+			finger_pairs = constants.COMFORT[(distance, prev_color, color)]
+		else:
+			finger_pairs = constants.COMFORT[(-distance, color, prev_color)]
+	else:
+		if distance >= 0:
+			finger_pairs = constants.COMFORT[(distance, color, prev_color)]
+		else:
+			finger_pairs = constants.COMFORT[(-distance, prev_color, color)]
+
+	if (rh and distance >= 0) or (not rh and distance < 0):
+		return dict(finger_pairs)
+	return {(finger, prev_finger): score for (prev_finger, finger), score in finger_pairs.items()}
+
 def get_color(note):
 	'''
 	Given a Note object, returns 'white' if the corresponding piano key is white
@@ -71,25 +280,37 @@ def get_color(note):
 		return 'white'
 	return 'black'
 
-def annotate_score(score, fingering, offset=0, rh=True):
+def annotate_score(score, fingering, offset=0, rh=True, in_place=False):
 	'''
-	Makes a new score by adding fingering numbers according to an array of fingerings.
+	Adds fingering numbers to a score according to an array of fingerings.
 	If offset if specified, starts adding fingering after offset number of notes
 	from the beginning of the score.
 
+	Returns a new score with the fingerings, unless in_place is True. In that case score itself
+	is annotated and returned, which avoids copying large scores.
+
 	Replaces chords with a single note. If rh is True, chooses the top note. Otherwise,
 	chooses the bottom note.
 	'''
-	new_score = copy.deepcopy(score)
+	from music21 import articulations, chord
+	if not in_place:
+		score = copy.deepcopy(score)
+	# flatten once, rather than once per note. flat has to stay referenced, since it is the
+	# activeSite used to replace chords.
+	flat = score.flat
+	notes = list(flat.notes)
 	for i in range(len(fingering)):
+		current_note = notes[i+offset]
 		# replace chords with a single Note, top note if right hand, else bottom note
-		if isinstance(score.flat.notes[i+offset], chord.Chord):
+		if isinstance(current_note, chord.Chord):
 			if rh:
 				index = -1
 			else:
 				index = 0
-			score.flat.notes[i+offset].activeSite.replace(score.flat.notes[i+offset], score.flat.notes[i+offset].notes[index])
-		score.flat.notes[i+offset].articulations.append(articulations.Fingering(fingering[i]))
+			replacement = current_note.notes[index]
+			current_note.activeSite.replace(current_note, replacement)
+			current_note = replacement
+		current_note.articulations.append(articulations.Fingering(fingering[i]))
 	return score
 
 ################################################################################
@@ -99,154 +320,261 @@ def annotate_score(score, fingering, offset=0, rh=True):
 ################################################################################
 
 def test_c_maj_scale_up():
+	from music21 import converter
 	c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
 	fingerings = finger_monotonic(c_maj_scale.parts[0].flat.notes[:15])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_b_maj_scale_up():
+	from music21 import converter
 	b_maj_scale = converter.parse('./data/scales/bmaj.mxl')
 	fingerings = finger_monotonic(b_maj_scale.parts[0].flat.notes[:15])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_f_maj_scale_up():
+	from music21 import converter
 	f_maj_scale = converter.parse('./data/scales/fmaj.mxl')
 	fingerings = finger_monotonic(f_maj_scale.parts[0].flat.notes[:15])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_c_sharp_maj_scale_up():
+	from music21 import converter
 	c_sharp_maj_scale = converter.parse('./data/scales/csharpmaj.mxl')
 	fingerings = finger_monotonic(c_sharp_maj_scale.parts[0].flat.notes[:15])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_c_maj_scale_up_lh():
+	from music21 import converter
 	c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
 	fingerings = finger_monotonic(c_maj_scale.parts[1].flat.notes[:15], False)
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_b_maj_scale_up_lh():
+	from music21 import converter
 	b_maj_scale = converter.parse('./data/scales/bmaj.mxl')
 	fingerings = finger_monotonic(b_maj_scale.parts[1].flat.notes[:15], False)
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_f_maj_scale_up_lh():
+	from music21 import converter
 	f_maj_scale = converter.parse('./data/scales/fmaj.mxl')
 	fingerings = finger_monotonic(f_maj_scale.parts[1].flat.notes[:15], False)
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_c_sharp_maj_scale_up_lh():
+	from music21 import converter
 	c_sharp_maj_scale = converter.parse('./data/scales/csharpmaj.mxl')
 	fingerings = finger_monotonic(c_sharp_maj_scale.parts[1].flat.notes[:15], False)
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_c_maj_scale_down():
+	from music21 import converter
 	c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
 	fingerings = finger_monotonic(c_maj_scale.parts[0].flat.notes[14:])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_b_maj_scale_down():
+	from music21 import converter
 	b_maj_scale = converter.parse('./data/scales/bmaj.mxl')
 	fingerings = finger_monotonic(b_maj_scale.parts[0].flat.notes[14:])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_f_maj_scale_down():
+	from music21 import converter
 	f_maj_scale = converter.parse('./data/scales/fmaj.mxl')
 	fingerings = finger_monotonic(f_maj_scale.parts[0].flat.notes[14:])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_c_sharp_maj_scale_down():
+	from music21 import converter
 	c_sharp_maj_scale = converter.parse('./data/scales/csharpmaj.mxl')
 	fingerings = finger_monotonic(c_sharp_maj_scale.parts[0].flat.notes[14:])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_c_maj_arpeggio_up():
+	from music21 import converter
 	c_maj_arpeggio = converter.parse('./data/arpeggios/cmaj.mxl')
 	fingerings = finger_monotonic(c_maj_arpeggio.parts[0].flat.notes[:7])
 	print(len(fingerings))
 	print(fingerings[:5])
 
 def test_a_maj_arpeggio_up():
+	from music21 import converter
 	a_maj_arpeggio = converter.parse('./data/arpeggios/amaj.mxl')
 	fingerings = finger_monotonic(a_maj_arpeggio.parts[0].flat.notes[:7])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_b_maj_arpeggio_up():
+	from music21 import converter
 	b_maj_arpeggio = converter.parse('./data/arpeggios/bmaj.mxl')
 	fingerings = finger_monotonic(b_maj_arpeggio.parts[0].flat.notes[:7])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_c_sharp_maj_arpeggio_up():
+	from music21 import converter
 	c_sharp_maj_arpeggio = converter.parse('./data/arpeggios/csharpmaj.mxl')
 	fingerings = finger_monotonic(c_sharp_maj_arpeggio.parts[0].flat.notes[:7])
 	print(len(fingerings))
 	print(fingerings[:5])
 
 def test_b_flat_min_arpeggio_up():
+	from music21 import converter
 	b_flat_min_arpeggio = converter.parse('./data/arpeggios/bflatmin.mxl')
 	fingerings = finger_monotonic(b_flat_min_arpeggio.parts[0].flat.notes[:7])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_c_maj_arpeggio_down():
+	from music21 import converter
 	c_maj_arpeggio = converter.parse('./data/arpeggios/cmaj.mxl')
 	fingerings = finger_monotonic(c_maj_arpeggio.parts[0].flat.notes[6:])
 	print(len(fingerings))
 	print(fingerings[:5])
 
 def test_a_maj_arpeggio_down():
+	from music21 import converter
 	a_maj_arpeggio = converter.parse('./data/arpeggios/amaj.mxl')
 	fingerings = finger_monotonic(a_maj_arpeggio.parts[0].flat.notes[6:])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_b_maj_arpeggio_down():
+	from music21 import converter
 	b_maj_arpeggio = converter.parse('./data/arpeggios/bmaj.mxl')
 	fingerings = finger_monotonic(b_maj_arpeggio.parts[0].flat.notes[6:])
 	print(len(fingerings))
 	print(fingerings[:3])
 
 def test_c_sharp_maj_arpeggio_down():
+	from music21 import converter
 	c_sharp_maj_arpeggio = converter.parse('./data/arpeggios/csharpmaj.mxl')
 	fingerings = finger_monotonic(c_sharp_maj_arpeggio.parts[0].flat.notes[6:])
 	print(len(fingerings))
 	print(fingerings[:5])
 
 def test_b_flat_min_arpeggio_down():
+	from music21 import converter
 	b_flat_min_arpeggio = converter.parse('./data/arpeggios/bflatmin.mxl')
 	fingerings = finger_monotonic(b_flat_min_arpeggio.parts[0].flat.notes[6:])
 	print(len(fingerings))
 	print(fingerings[:3])
 
+def test_k_best_fingerings():
+	from music21 import converter
+	import itertools
+	c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
+	for notes in [c_maj_scale.parts[0].flat.notes[:15], c_maj_scale.parts[0].flat.notes[14:]]:
+		fingerings = finger_monotonic(notes)
+		k_best = list(itertools.islice(k_best_fingerings(notes), 50))
+		assert(np.allclose([score for fingering, score in k_best], [score for fingering, score in fingerings[:50]]))
+		assert(len(set(tuple(fingering) for fingering, score in k_best)) == 50)
+		# every score belongs to its fingering
+		scores = dict((tuple(fingering), score) for fingering, score in fingerings)
+		assert(all(abs(scores[tuple(fingering)] - score) < 1e-9 for fingering, score in k_best))
+
+def test_beam():
+	from music21 import converter, note
+	c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
+	notes = c_maj_scale.parts[0].flat.notes[:10]
+	fingerings = finger_monotonic(notes)
+	for beam in [1, 3, 10]:
+		beam_fingerings, complete = finger_monotonic(notes, beam=beam)
+		assert(complete)
+		assert(len(beam_fingerings) <= 5 * beam)
+		assert(beam_fingerings[0][1] == fingerings[0][1])
+		# with one per finger, the beam keeps the best fingering ending on each finger
+		if beam == 1:
+			best = dict()
+			for fingering, score in fingerings:
+				best.setdefault(fingering[-1], score)
+			assert(sorted(score for fingering, score in beam_fingerings) == sorted(best.values()))
+	assert(finger_monotonic(notes, beam=10 ** 9) == (fingerings, True))
+
+	# leaps of more than an octave can only be played from 1 to 5, so two in a row are
+	# impossible and only the first two notes can be fingered
+	impossible = [note.Note('C3'), note.Note('D4'), note.Note('E5')]
+	assert(finger_monotonic(impossible) == [])
+	partial, complete = finger_monotonic(impossible, beam=2)
+	assert(not complete)
+	assert(len(partial) > 0 and all(len(fingering) == 2 for fingering, score in partial))
+
+def test_count_partial_fingerings():
+	from music21 import converter
+	c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
+	notes = c_maj_scale.parts[0].flat.notes[:8]
+	for rh in [True, False]:
+		created = 5 + sum(len(finger_monotonic(notes[:k], rh)) for k in range(2, len(notes) + 1))
+		assert(count_partial_fingerings(notes, rh) == created)
+
+def test_comfort_tables():
+	# the compiled tables should match COMFORT exactly, including which pairs are missing
+	from music21 import note
+	for distance in range(14):
+		for color_1 in constants.COLORS:
+			for color_2 in constants.COLORS:
+				finger_pairs = constants.COMFORT.get((distance, color_1, color_2), {})
+				for finger_1 in range(1, 6):
+					for finger_2 in range(1, 6):
+						index = (distance, constants.COLORS.index(color_1), constants.COLORS.index(color_2))
+						rh_score = constants.COMFORT_RH[index + (finger_1 - 1, finger_2 - 1)]
+						lh_score = constants.COMFORT_LH[(distance, index[2], index[1], finger_2 - 1, finger_1 - 1)]
+						assert(rh_score == lh_score)
+						assert(rh_score == finger_pairs.get((finger_1, finger_2), constants.FORBIDDEN))
+
+	# and get the same transitions as the dictionary lookup for both hands and directions
+	pitches = ['C4', 'C#4', 'D4', 'E-4', 'G4', 'A#4', 'C5', 'F#5', 'E6']
+	for rh in [True, False]:
+		for prev_pitch in pitches:
+			for pitch in pitches:
+				prev_note, current_note = note.Note(prev_pitch), note.Note(pitch)
+				if abs(current_note.pitch.ps - prev_note.pitch.ps) in [6, 11, 12] and \
+						get_color(prev_note) != get_color(current_note):
+					continue # not in COMFORT
+				finger_pairs = get_transition_scores(prev_note, current_note, rh)
+				matrix = get_transition_matrices(notestream.from_notes([prev_note, current_note]), rh)[0]
+				for prev_finger in range(1, 6):
+					for finger in range(1, 6):
+						expected = finger_pairs.get((prev_finger, finger), constants.FORBIDDEN)
+						assert(matrix[prev_finger - 1, finger - 1] == expected)
+
 def test_get_color():
+	from music21 import note
 	assert(get_color(note.Note('C4')) == 'white')
 	assert(get_color(note.Note('C#4')) == 'black')
 
 def show_c_maj_scale_up():
+	from music21 import converter
 	c_maj_scale = converter.parse('./data/scales/cmaj.mxl')
 	fingerings = finger_monotonic(c_maj_scale.parts[0].flat.notes[:15])
 	new_score = annotate_score(c_maj_scale.parts[0], fingerings[0][0])
 	new_score.show()
 
 def show_c_sharp_maj_scale_down():
+	from music21 import converter
 	c_sharp_maj_scale = converter.parse('./data/scales/csharpmaj.mxl')
 	fingerings = finger_monotonic(c_sharp_maj_scale.parts[0].flat.notes[14:])
 	new_score = annotate_score(c_sharp_maj_scale.parts[0], fingerings[0][0], offset=14)
 	new_score.show()
 
 # test_get_color()
+# test_comfort_tables()
+# test_k_best_fingerings()
+# test_count_partial_fingerings()
+# test_beam()
 
 # SCALES
 
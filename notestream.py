@@ -0,0 +1,179 @@
+import constants
+import hashlib
+import numpy as np
+import os
+
+# Change this whenever from_part or from_score would extract different arrays, so that
+# cached note streams made by the old rules are no longer used.
+EXTRACTION_VERSION = 1
+FIELDS = ['ps', 'color', 'duration', 'offset', 'is_rest', 'index']
+
+class NoteStream:
+    '''
+    A compact, array-backed view of a single-hand part, with one entry per note or rest.
+
+    Each attribute is a NumPy array with one entry per element:
+        ps: pitch space value of the note (nan for rests)
+        color: index of the key color in constants.COLORS (-1 for rests)
+        duration: length in quarter notes
+        offset: position in quarter notes from the start of the part
+        is_rest: True for rests
+        index: position of the element in part.flat.notesAndRests
+
+    Indexing a NoteStream with an integer array or slice returns a new NoteStream with
+    just those elements, so chunks can be represented as arrays of indices.
+    '''
+    def __init__(self, ps, color, duration, offset, is_rest, index):
+        self.ps = ps
+        self.color = color
+        self.duration = duration
+        self.offset = offset
+        self.is_rest = is_rest
+        self.index = index
+
+    def __len__(self):
+        return len(self.ps)
+
+    def __getitem__(self, key):
+        return NoteStream(self.ps[key], self.color[key], self.duration[key], self.offset[key],
+            self.is_rest[key], self.index[key])
+
+    def note_indices(self):
+        '''
+        Returns the indices of the elements that are not rests.
+        '''
+        return np.flatnonzero(~self.is_rest)
+
+    def without_rests(self):
+        '''
+        Returns a NoteStream containing only the notes.
+        '''
+        return self[self.note_indices()]
+
+def from_part(part, rh=True):
+    '''
+    Given a single-hand piano part, returns a NoteStream of its notes and rests, flattening
+    the part only once.
+
+    Chords are replaced by a single note from that chord. If rh is True, we choose the top
+    note. Otherwise, we choose the bottom note.
+    '''
+    from music21 import chord, note
+    elements = part.flat.notesAndRests
+    ps = np.full(len(elements), np.nan)
+    duration = np.zeros(len(elements))
+    offset = np.zeros(len(elements))
+    is_rest = np.zeros(len(elements), dtype=bool)
+
+    for i, element in enumerate(elements):
+        duration[i] = element.duration.quarterLength
+        offset[i] = element.offset
+        if isinstance(element, note.Rest):
+            is_rest[i] = True
+            continue
+        if isinstance(element, chord.Chord):
+            if rh:
+                element = element.notes[-1] # set current note to highest note in chord
+            else:
+                element = element.notes[0] # set current note to lowest note in chord
+        ps[i] = element.pitch.ps
+
+    return NoteStream(ps, get_colors(ps, is_rest), duration, offset, is_rest, np.arange(len(elements)))
+
+def from_score(score):
+    '''
+    Returns the NoteStreams of the first two parts of a piano score. The first part is
+    extracted for the right hand and the second for the left hand.
+    '''
+    return [from_part(part, i == 0) for i, part in enumerate(score.parts[:2])]
+
+def load(path, cache_dir):
+    '''
+    Returns from_score for the score file at path, without parsing it if it is in cache_dir.
+
+    Cache files are named after a hash of the contents of the score and EXTRACTION_VERSION,
+    so they stop being used as soon as either changes. A missing or unreadable cache file is
+    replaced by parsing the score again.
+    '''
+    with open(path, 'rb') as f:
+        key = hashlib.sha256(f.read())
+    key.update(b'notestream-%d' % EXTRACTION_VERSION)
+    cache_path = os.path.join(cache_dir, key.hexdigest() + '.npz')
+
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as arrays:
+                return [NoteStream(*[arrays['%s_%d' % (field, i)] for field in FIELDS])
+                    for i in range(int(arrays['parts']))]
+        except (OSError, KeyError, ValueError):
+            pass
+
+    # music21 is only imported when the cache cannot be used
+    from music21 import converter
+    note_streams = from_score(converter.parse(path))
+    arrays = {'%s_%d' % (field, i): getattr(note_stream, field)
+        for i, note_stream in enumerate(note_streams) for field in FIELDS}
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so other processes never read a partial file
+    partial_path = '%s.%d.partial.npz' % (cache_path[:-len('.npz')], os.getpid())
+    np.savez(partial_path, parts=len(note_streams), **arrays)
+    os.replace(partial_path, cache_path)
+    return note_streams
+
+def from_notes(notes):
+    '''
+    Given a list of Notes, such as a slice of part.flat.notes, returns a NoteStream with
+    one entry per note. index is the position in the list.
+    '''
+    ps = np.array([n.pitch.ps for n in notes], dtype=float)
+    is_rest = np.zeros(len(notes), dtype=bool)
+    return NoteStream(ps, get_colors(ps, is_rest), np.array([n.duration.quarterLength for n in notes], dtype=float),
+        np.array([n.offset for n in notes], dtype=float), is_rest, np.arange(len(notes)))
+
+def from_pitches(ps):
+    '''
+    Given a sequence of pitch space values (MIDI note numbers for notes without microtones),
+    returns a NoteStream with one quarter note for each pitch.
+    '''
+    ps = np.asarray(ps, dtype=float)
+    is_rest = np.zeros(len(ps), dtype=bool)
+    return NoteStream(ps, get_colors(ps, is_rest), np.ones(len(ps)), np.arange(len(ps), dtype=float), is_rest,
+        np.arange(len(ps)))
+
+def get_colors(ps, is_rest):
+    '''
+    Returns the index in constants.COLORS of the key color for each pitch, or -1 for rests.
+    '''
+    pitch_class = np.mod(np.round(np.nan_to_num(ps)), 12)
+    colors = np.where(np.isin(pitch_class, constants.BLACK_PITCH_CLASSES), constants.COLORS.index('black'),
+        constants.COLORS.index('white'))
+    return np.where(is_rest, -1, colors).astype(np.int8)
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_load_cache():
+    import shutil
+    import tempfile
+    cache_dir = tempfile.mkdtemp()
+    path = os.path.join(cache_dir, 'score.mxl')
+    shutil.copy('./data/scales/bmaj.mxl', path)
+
+    parsed = load(path, cache_dir)
+    cached = load(path, cache_dir)
+    assert(len(os.listdir(cache_dir)) == 2)
+    for parsed_stream, cached_stream in zip(parsed, cached):
+        for field in FIELDS:
+            assert(np.array_equal(getattr(parsed_stream, field), getattr(cached_stream, field), equal_nan=True))
+
+    # a changed score gets a new cache file
+    shutil.copy('./data/scales/cmaj.mxl', path)
+    changed = load(path, cache_dir)
+    assert(len(os.listdir(cache_dir)) == 3)
+    assert(not np.array_equal(changed[0].ps, parsed[0].ps))
+    shutil.rmtree(cache_dir)
+
+# test_load_cache()
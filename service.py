@@ -0,0 +1,611 @@
+'''
+Local fingering service that keeps its state warm between requests.
+
+    python service.py serve --port 8765
+    python service.py serve --socket /tmp/fingering.sock
+    python service.py load --url http://127.0.0.1:8765 --requests 2000 --concurrency 16
+
+The server only listens on the local machine and never makes network requests of its own.
+It imports everything and builds the comfort tables and chord shape index once at startup,
+and keeps one chunkcache.ChunkCache for the long parts of every request.
+
+A request with bad input, such as malformed JSON, an unknown engine or a rest_flag that is
+not a number, gets status 400. Any other error gets status 500.
+
+Endpoints:
+    POST /finger    fingers a score. The body is one of
+                        JSON note arrays: {"parts": [{"pitches": [60, 62, ...], "rh": true}],
+                            "engine": "chunk", "rest_flag": -1}
+                        a MIDI file, with Content-Type audio/midi, read with midifile
+                        a MusicXML or MXL file, with any other Content-Type
+                    The response is JSON with the fingers, note indices and normalized score
+                    of each part.
+    GET /stats      latency and throughput counters as JSON
+    GET /health     returns {"ok": true}
+
+Parts with at most --batch-notes notes are handed to a Batcher, which waits up to
+--batch-window milliseconds for parts from other requests and then solves them together with
+batchsolve.solve_batch. Longer parts are solved right away in the thread of their request.
+
+The load subcommand is a test client that sends random note arrays from several threads and
+prints the latency and throughput it saw, along with the counters of the server.
+'''
+import argparse
+import collections
+import http.client
+import http.server
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import batchsolve
+import chords
+import chunkcache
+import finger
+import midifile
+import notestream
+import numpy as np
+
+ENGINES = ['chunk', 'viterbi']
+MIDI_TYPES = ('audio/midi', 'audio/x-midi')
+
+class Job:
+    '''
+    One part waiting to be solved, and its result once it is.
+    '''
+    def __init__(self, note_stream, rh, engine, rest_flag):
+        self.note_stream = note_stream
+        self.rh = rh
+        self.engine = engine
+        self.rest_flag = rest_flag
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class Batcher:
+    '''
+    Solves small parts from concurrent requests together, in a single thread.
+
+    The first part to arrive starts a batch, which is solved once max_size parts have been
+    added or window seconds have passed, whichever is first. A request waits for its parts
+    with wait.
+    '''
+    def __init__(self, solve_batch, window=0.005, max_size=256):
+        self.solve_batch = solve_batch
+        self.window = window
+        self.max_size = max_size
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        self.jobs.put(job)
+        return job
+
+    def run(self):
+        while True:
+            batch = [self.jobs.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                results = self.solve_batch(batch)
+            except Exception as e:
+                for job in batch:
+                    job.error = e
+                    job.done.set()
+                continue
+            for job, result in zip(batch, results):
+                job.result = result
+                job.done.set()
+
+class BadRequest(ValueError):
+    '''
+    Raised for a request that cannot be fingered as given. The handler answers it with 400.
+    '''
+
+class ServiceStats:
+    '''
+    Thread-safe counters of the service. Latencies of the last 10000 requests are kept for
+    percentiles. Every counter starts at 0, so as_dict always has the same keys.
+    '''
+    COUNTERS = ['requests', 'errors', 'parts', 'notes', 'batches', 'batched_parts', 'direct_parts']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counts = collections.Counter(dict.fromkeys(self.COUNTERS, 0))
+        self.latencies = collections.deque(maxlen=10000)
+
+    def add(self, **counts):
+        with self.lock:
+            self.counts.update(counts)
+
+    def add_request(self, seconds, ok=True):
+        with self.lock:
+            self.counts['requests'] += 1
+            if not ok:
+                self.counts['errors'] += 1
+            self.latencies.append(seconds)
+
+    def as_dict(self):
+        with self.lock:
+            uptime = time.time() - self.started
+            metrics = dict(self.counts)
+            latencies = np.array(self.latencies)
+        metrics['uptime_seconds'] = uptime
+        metrics['requests_per_second'] = metrics['requests'] / uptime if uptime > 0 else 0
+        metrics['mean_batch_size'] = metrics['batched_parts'] / max(metrics['batches'], 1)
+        for percentile in [50, 95, 99]:
+            metrics['latency_p%d_ms' % percentile] = float(np.percentile(latencies, percentile)) * 1000 \
+                if len(latencies) > 0 else 0.0
+        return metrics
+
+class FingeringService:
+    '''
+    The state shared by every request: the chunk cache, the batcher and the counters.
+    '''
+    def __init__(self, batch_notes=500, batch_window=0.005, max_batch=256, cache_size=65536, preload_music21=True):
+        self.batch_notes = batch_notes
+        self.cache = chunkcache.ChunkCache(cache_size)
+        self.stats = ServiceStats()
+        self.batcher = Batcher(self.solve_batch, batch_window, max_batch)
+        self.warm(preload_music21)
+
+    def warm(self, music21=True):
+        '''
+        Does the work that would otherwise slow down the first requests. Nothing is counted
+        in the stats.
+        '''
+        chords.get_shape_index(True)
+        chords.get_shape_index(False)
+        self.solve_jobs([Job(notestream.from_pitches([60, 62, 64, 62, 60]), True, engine, -1) for engine in ENGINES])
+        if music21:
+            import music21.converter
+
+    def solve_batch(self, jobs):
+        '''
+        Solves a batch from the batcher with solve_jobs and counts it in the stats.
+        '''
+        self.stats.add(batches=1, batched_parts=len(jobs))
+        return self.solve_jobs(jobs)
+
+    def solve_jobs(self, jobs):
+        '''
+        Returns the FingeringResult of each job. Jobs with the same engine and rest_flag are
+        solved in one call to batchsolve.solve_batch.
+        '''
+        groups = collections.defaultdict(list)
+        for i, job in enumerate(jobs):
+            groups[(job.engine, job.rest_flag)].append(i)
+        results = [None] * len(jobs)
+        for (engine, rest_flag), group in groups.items():
+            solved = batchsolve.solve_batch([jobs[i].note_stream for i in group], [jobs[i].rh for i in group],
+                rest_flag, engine)
+            for i, result in zip(group, solved):
+                results[i] = result
+        return results
+
+    def finger(self, note_streams, hands, engine='chunk', rest_flag=-1):
+        '''
+        Solves each part, through the batcher if it is small enough, and returns the
+        FingeringResults in order.
+        '''
+        if engine not in ENGINES:
+            raise BadRequest('engine must be one of %s, not %r' % (', '.join(ENGINES), engine))
+        jobs = [Job(note_stream, rh, engine, rest_flag) for note_stream, rh in zip(note_streams, hands)]
+        for job in jobs:
+            if len(job.note_stream) <= self.batch_notes:
+                self.batcher.submit(job)
+            else:
+                self.stats.add(direct_parts=1)
+                # the cache locks itself, only while looking up and adding chunks
+                job.result = finger.solve(job.note_stream, job.rh, job.rest_flag, job.engine, cache=self.cache)
+                job.done.set()
+        for job in jobs:
+            job.done.wait()
+            if job.error is not None:
+                raise job.error
+        self.stats.add(parts=len(jobs), notes=sum(len(job.result.fingers) for job in jobs))
+        return [job.result for job in jobs]
+
+    def handle(self, body, content_type, query):
+        '''
+        Fingers the body of a POST /finger request and returns the response as a dictionary.
+        Raises BadRequest if the request cannot be read.
+        '''
+        engine = query.get('engine', 'chunk')
+        rest_flag = get_rest_flag(query.get('rest_flag', -1))
+        if content_type == 'application/json':
+            try:
+                request = json.loads(body)
+                engine = request.get('engine', engine)
+                rest_flag = get_rest_flag(request.get('rest_flag', rest_flag))
+                parts = request['parts']
+                note_streams = [notestream.from_pitches(get_pitches(part['pitches'])) for part in parts]
+                hands = [get_hand(part.get('rh', i % 2 == 0)) for i, part in enumerate(parts)]
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                raise BadRequest('bad JSON request: %s: %s' % (type(e).__name__, e))
+        else:
+            try:
+                if content_type in MIDI_TYPES:
+                    midi_notes = midifile.parse(body)
+                    note_streams = [midifile.to_note_stream(midi_notes, selected, rh)
+                        for selected, rh in zip(midifile.get_hands(midi_notes), [True, False])]
+                    hands = [True, False]
+                else:
+                    note_streams = parse_musicxml(body)
+                    hands = [True, False][:len(note_streams)]
+            except ImportError:
+                raise
+            except Exception as e:
+                raise BadRequest('could not read the score: %s: %s' % (type(e).__name__, e))
+
+        results = self.finger(note_streams, hands, engine, rest_flag)
+        return {'parts': [{
+            'rh': rh,
+            'fingers': result.fingers.tolist(),
+            'note_indices': result.note_indices.tolist(),
+            'normalized_score': float(result.normalized_score),
+        } for rh, result in zip(hands, results)]}
+
+def get_rest_flag(value):
+    '''
+    Returns rest_flag from a query string or JSON value as a float, raising BadRequest if it
+    is not a number.
+    '''
+    # JSON true and false are ints in Python
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise BadRequest('rest_flag must be a number, not %r' % (value,))
+    try:
+        return float(value)
+    except ValueError:
+        raise BadRequest('rest_flag must be a number, not %r' % (value,))
+
+def get_hand(value):
+    '''
+    Returns the rh of a JSON part, raising BadRequest if it is not true or false.
+    '''
+    if not isinstance(value, bool):
+        raise BadRequest('rh must be true or false, not %r' % (value,))
+    return value
+
+def get_pitches(pitches):
+    '''
+    Returns the pitches of a JSON part, raising BadRequest if they are not a list of MIDI
+    note numbers.
+    '''
+    if not isinstance(pitches, list) or not all(isinstance(p, (int, float)) and not isinstance(p, bool) for p in pitches):
+        raise BadRequest('pitches must be a list of numbers')
+    return pitches
+
+def parse_musicxml(body):
+    '''
+    Returns the NoteStreams of a MusicXML or compressed MXL file given as bytes.
+    '''
+    from music21 import converter
+    # MXL files are zip archives
+    suffix = '.mxl' if body[:2] == b'PK' else '.musicxml'
+    handle, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(body)
+        return notestream.from_score(converter.parse(path))
+    finally:
+        os.remove(path)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.server.service.stats.as_dict())
+        elif self.path == '/health':
+            self.send_json(200, {'ok': True})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        if url.path != '/finger':
+            self.send_json(404, {'error': 'not found'})
+            return
+        start = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_type = self.headers.get('Content-Type', '').split(';')[0].strip()
+        query = dict(urllib.parse.parse_qsl(url.query))
+        service = self.server.service
+        try:
+            response = service.handle(body, content_type, query)
+        except Exception as e:
+            service.stats.add_request(time.perf_counter() - start, ok=False)
+            status = 400 if isinstance(e, BadRequest) else 500
+            self.send_json(status, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        seconds = time.perf_counter() - start
+        service.stats.add_request(seconds)
+        response['seconds'] = seconds
+        self.send_json(200, response)
+
+    def send_json(self, status, value):
+        data = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host='127.0.0.1', port=8765, socket_path=None):
+    '''
+    Returns a server for service on a local TCP port, or on a Unix socket if socket_path is
+    given. Call serve_forever on it to start.
+    '''
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, Handler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class Client:
+    '''
+    A client for the service at url, such as http://127.0.0.1:8765, or at a Unix socket given
+    as unix:/path/to/socket. Each Client keeps one connection open, so use one per thread.
+    '''
+    def __init__(self, url='http://127.0.0.1:8765', timeout=60):
+        if url.startswith('unix:'):
+            self.connection = UnixHTTPConnection(url[len('unix:'):], timeout)
+        else:
+            parsed = urllib.parse.urlparse(url)
+            self.connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=timeout)
+
+    def request(self, method, path, body=None, content_type='application/json'):
+        headers = {'Content-Type': content_type} if body is not None else {}
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        value = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError('%d: %s' % (response.status, value.get('error')))
+        return value
+
+    def finger_pitches(self, parts, engine='chunk'):
+        '''
+        Fingers a list of (pitches, rh) pairs.
+        '''
+        body = json.dumps({'parts': [{'pitches': list(pitches), 'rh': rh} for pitches, rh in parts], 'engine': engine})
+        return self.request('POST', '/finger', body.encode())
+
+    def finger_file(self, path, engine='chunk'):
+        '''
+        Fingers a MIDI, MusicXML or MXL file.
+        '''
+        with open(path, 'rb') as f:
+            body = f.read()
+        content_type = MIDI_TYPES[0] if path.lower().endswith(midifile.EXTENSIONS) else 'application/vnd.recordare.musicxml'
+        return self.request('POST', '/finger?engine=%s' % engine, body, content_type)
+
+    def stats(self):
+        return self.request('GET', '/stats')
+
+    def close(self):
+        self.connection.close()
+
+def random_pitches(rng, length):
+    # a random walk, as in bench.random_walk
+    return (60 + np.cumsum(rng.integers(-4, 5, size=length))).clip(36, 96).tolist()
+
+def load_test(url, requests=1000, concurrency=8, notes=(16, 64), engine='chunk', seed=0):
+    '''
+    Sends requests random note arrays from concurrency threads, each with one part of
+    between notes[0] and notes[1] notes, and returns the latency and throughput it saw.
+    '''
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def work(thread):
+        rng = np.random.default_rng(seed + thread)
+        client = Client(url)
+        try:
+            while True:
+                with lock:
+                    if next(counter, None) is None:
+                        return
+                pitches = random_pitches(rng, int(rng.integers(notes[0], notes[1] + 1)))
+                start = time.perf_counter()
+                try:
+                    client.finger_pitches([(pitches, True)], engine)
+                except Exception:
+                    with lock:
+                        errors[0] += 1
+                    client.close()
+                    client = Client(url)
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+        finally:
+            client.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed > 0 else 0,
+        'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+        'latency_p95_ms': float(np.percentile(latencies, 95)) if len(latencies) else 0.0,
+        'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local fingering service.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve = subparsers.add_parser('serve', help='run the service')
+    serve.add_argument('--host', default='127.0.0.1', help='local address to listen on (default: 127.0.0.1)')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--socket', default=None, help='listen on this Unix socket instead of a port')
+    serve.add_argument('--batch-notes', type=int, default=500, help='longest part that is batched (default: 500)')
+    serve.add_argument('--batch-window', type=float, default=5, help='milliseconds to wait for a batch to fill (default: 5)')
+    serve.add_argument('--max-batch', type=int, default=256, help='most parts in a batch (default: 256)')
+    serve.add_argument('--no-music21', action='store_true', help='do not import music21 until a MusicXML request')
+
+    load = subparsers.add_parser('load', help='load test a running service')
+    load.add_argument('--url', default='http://127.0.0.1:8765', help='service URL, or unix:PATH for a Unix socket')
+    load.add_argument('--requests', type=int, default=1000)
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--notes', type=int, nargs=2, default=[16, 64], help='range of notes per request')
+    load.add_argument('--engine', choices=ENGINES, default='chunk')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        service = FingeringService(args.batch_notes, args.batch_window / 1000, args.max_batch,
+            preload_music21=not args.no_music21)
+        server = make_server(service, args.host, args.port, args.socket)
+        print('listening on %s' % (args.socket or '%s:%d' % (args.host, args.port)))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+
+    results = load_test(args.url, args.requests, args.concurrency, args.notes, args.engine)
+    print(json.dumps(results, indent=1))
+    client = Client(args.url)
+    print(json.dumps(client.stats(), indent=1))
+    client.close()
+    return 1 if results['errors'] else 0
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def test_service():
+    service = FingeringService(batch_window=0.02, preload_music21=False)
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+    try:
+        client = Client(url)
+        scale = [60, 62, 64, 65, 67, 69, 71, 72, 71, 69, 67, 65, 64, 62, 60]
+        response = client.finger_pitches([(scale, True), (scale, False)])
+        for part, rh in zip(response['parts'], [True, False]):
+            assert(part['fingers'] == finger.solve(notestream.from_pitches(scale), rh).fingers.tolist())
+        client.close()
+
+        # bad input is the client's fault, and is not counted as a success
+        for body in [b'{"parts": [{"pitches": [60], "rh": "yes"}]}', b'{"parts": [], "rest_flag": "long"}',
+                b'{"parts": [{"pitches": "C4"}]}', b'{"engine": "guess", "parts": []}', b'not json']:
+            client.connection.request('POST', '/finger', body, {'Content-Type': 'application/json'})
+            response = client.connection.getresponse()
+            response.read()
+            assert(response.status == 400)
+        client.close()
+
+        results = load_test(url, requests=200, concurrency=8)
+        assert(results['requests'] == 200 and results['errors'] == 0)
+        stats = Client(url).stats()
+        # concurrent requests were solved together
+        assert(stats['mean_batch_size'] > 1)
+        assert(stats['requests'] == 206 and stats['errors'] == 5)
+        # the warm-up is not counted
+        assert(stats['parts'] == stats['batched_parts'] + stats['direct_parts'] == 202)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_internal_error():
+    service = FingeringService(preload_music21=False)
+
+    def fail(*args):
+        raise RuntimeError('solver failed')
+
+    service.finger = fail
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = Client('http://127.0.0.1:%d' % server.server_address[1])
+        try:
+            client.finger_pitches([([60, 62], True)])
+            assert(False)
+        except RuntimeError as e:
+            assert(str(e).startswith('500'))
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_service_files():
+    from music21 import converter
+    service = FingeringService(preload_music21=False)
+    directory = tempfile.mkdtemp()
+    socket_path = os.path.join(directory, 'service.sock')
+    server = make_server(service, socket_path=socket_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = Client('unix:' + socket_path)
+        midi_path = os.path.join(directory, 'bmaj.mid')
+        converter.parse('./data/scales/bmaj.mxl').write('midi', fp=midi_path)
+        from_midi = client.finger_file(midi_path)
+        from_musicxml = client.finger_file('./data/scales/bmaj.mxl')
+        assert([part['fingers'] for part in from_midi['parts']] == [part['fingers'] for part in from_musicxml['parts']])
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+# test_service()
+# test_internal_error()
+# test_service_files()
+
+if __name__ == '__main__':
+    sys.exit(main())
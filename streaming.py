@@ -0,0 +1,147 @@
+import constants
+import monotonic
+import numpy as np
+
+class FixedLagFingerer:
+    '''
+    Fingers notes one at a time, as they are played, using the same comfort model as the
+    viterbi engine in finger.py.
+
+    Each call to push runs one step of the forward pass, then commits the finger of the note
+    played lag notes ago from the best fingering so far. Fingerings that disagree with a
+    committed finger are dropped, so later commits always stay consistent with earlier ones.
+    If no valid fingering can reach a note, the hand is reset as in flush, and the pair of
+    notes around the reset may be an unacceptable transition.
+
+    Only the last lag + 1 fingers of the best fingering ending on each finger are kept, so
+    memory does not grow with the length of the stream.
+
+    If rh is True, uses right hand fingers. Otherwise, uses left hand fingers.
+    '''
+    def __init__(self, rh=True, lag=8):
+        if lag < 0:
+            raise ValueError('lag must be at least 0')
+        self.rh = rh
+        self.lag = lag
+        self.count = 0          # number of notes pushed so far
+        self.start = 0          # index of the first note in self.paths
+        self.best = None        # best total comfort of the notes so far ending on each finger
+        self.paths = None       # paths[f] holds the uncommitted fingers of the best fingering ending on f + 1
+        self.prev_ps = None
+        self.prev_color = None
+        self.resets = 0         # number of times no valid fingering could reach the next note
+
+    def push(self, ps):
+        '''
+        Adds the next note, given by its pitch space value (the MIDI note number for notes
+        without microtones). Returns a list of (note index, finger) pairs that were committed,
+        which has one pair once more than lag notes have been pushed and none before that.
+        '''
+        color = constants.COLORS.index('black') if round(ps) % 12 in constants.BLACK_PITCH_CLASSES \
+            else constants.COLORS.index('white')
+        committed = []
+
+        if self.best is None:
+            self.best = np.zeros(5)
+            self.paths = np.arange(5).reshape(5, 1)
+        else:
+            matrix = monotonic.get_transition_matrix(self.prev_ps, self.prev_color, ps, color, self.rh)
+            # scores[p, f] is the total when the previous note is played with p and this note with f
+            scores = self.best[:, np.newaxis] + matrix
+            best = scores.max(axis=0)
+            if np.all(best == constants.FORBIDDEN):
+                # no valid fingering reaches this note, so the hand has to be reset
+                self.resets += 1
+                committed = self.flush()
+                return committed + self.push(ps)
+            pointers = scores.argmax(axis=0)
+            self.best = best
+            self.paths = np.hstack([self.paths[pointers], np.arange(5).reshape(5, 1)])
+
+        self.count += 1
+        self.prev_ps = ps
+        self.prev_color = color
+
+        if self.paths.shape[1] > self.lag:
+            finger = self.paths[np.argmax(self.best), 0]
+            committed.append((self.start, int(finger) + 1))
+            # drop fingerings that disagree with the committed finger
+            self.best = np.where(self.paths[:, 0] == finger, self.best, constants.FORBIDDEN)
+            self.paths = self.paths[:, 1:]
+            self.start += 1
+        return committed
+
+    def flush(self):
+        '''
+        Commits the fingers of every note that has not been committed yet and starts a new
+        phrase, so the next note can be played with any finger. This can be called on long
+        rests, when the hand is free to move.
+        Returns a list of (note index, finger) pairs.
+        '''
+        committed = []
+        if self.best is not None:
+            path = self.paths[np.argmax(self.best)]
+            committed = [(self.start + i, int(finger) + 1) for i, finger in enumerate(path)]
+        self.start = self.count
+        self.best = None
+        self.paths = None
+        self.prev_ps = None
+        self.prev_color = None
+        return committed
+
+################################################################################
+#                                                                              #
+#                                   TESTS                                      #
+#                                                                              #
+################################################################################
+
+def finger_stream(pitches, rh=True, lag=8):
+    fingerer = FixedLagFingerer(rh, lag)
+    committed = []
+    for ps in pitches:
+        committed.extend(fingerer.push(ps))
+    committed.extend(fingerer.flush())
+    assert([i for i, finger in committed] == list(range(len(pitches))))
+    return [finger for i, finger in committed], fingerer.resets
+
+def test_long_lag_matches_viterbi():
+    import glob
+    import finger
+    import notestream
+    from music21 import converter
+    for path in glob.glob('./data/*/*.mxl'):
+        for note_stream, rh in zip(notestream.from_score(converter.parse(path)), [True, False]):
+            notes = note_stream.without_rests()
+            assert(finger_stream(notes.ps, rh, lag=len(notes))[0] == finger.viterbi(notes, rh)[0])
+
+def test_short_lag_is_valid():
+    import random
+    import notestream
+    random.seed(0)
+    pitches = [60]
+    for i in range(5000):
+        pitches.append(min(max(pitches[-1] + random.randint(-7, 7), 36), 84))
+    transitions = monotonic.get_transition_matrices(notestream.from_pitches(pitches))
+    for lag in [0, 1, 4, 16]:
+        fingering, resets = finger_stream(pitches, lag=lag)
+        invalid = sum(transitions[i, fingering[i] - 1, fingering[i+1] - 1] == constants.FORBIDDEN
+            for i in range(len(pitches) - 1))
+        # only transitions across a reset can be unacceptable
+        assert(invalid <= resets)
+        print(lag, resets)
+
+def test_latency():
+    import random
+    import time
+    random.seed(0)
+    fingerer = FixedLagFingerer(lag=16)
+    ps = 60
+    start = time.time()
+    for i in range(20000):
+        ps = min(max(ps + random.randint(-5, 5), 36), 84)
+        fingerer.push(ps)
+    print('%.1f microseconds per note' % ((time.time() - start) / 20000 * 1e6))
+
+# test_long_lag_matches_viterbi()
+# test_short_lag_is_valid()
+# test_latency()